@@ -22,5 +22,7 @@
 __VERSION__ = "0.3.2"
 
 from pyswip.prolog import Prolog as Prolog
+from pyswip.prolog import CancelToken as CancelToken
+from pyswip.objects import ObjectRef as ObjectRef
 from pyswip.easy import *
 from pyswip.core import *
@@ -676,6 +676,13 @@ PL_Q_NODEBUG = 0x04  # use this one
 PL_Q_CATCH_EXCEPTION = 0x08  # handle exceptions in C
 PL_Q_PASS_EXCEPTION = 0x10  # pass to parent environment
 PL_Q_DETERMINISTIC = 0x20  # call was deterministic
+PL_Q_EXT_STATUS = 0x40  # return extended status
+
+# PL_next_solution() return codes with PL_Q_EXT_STATUS
+PL_S_EXCEPTION = -1  # query raised exception
+PL_S_FALSE = 0  # query failed
+PL_S_TRUE = 1  # query succeeded with choicepoint
+PL_S_LAST = 2  # query succeeded without choicepoint
 
 #        /*******************************
 #        *         BLOBS        *
@@ -690,6 +697,15 @@ PL_Q_DETERMINISTIC = 0x20  # call was deterministic
 # define PL_BLOB_NOCOPY  0x04        /* do not copy the data */
 # define PL_BLOB_WCHAR   0x08        /* wide character string */
 
+PL_BLOB_MAGIC_B = 0x75293A00
+PL_BLOB_VERSION = 1
+PL_BLOB_MAGIC = PL_BLOB_MAGIC_B | PL_BLOB_VERSION
+
+PL_BLOB_UNIQUE = 0x01
+PL_BLOB_TEXT = 0x02
+PL_BLOB_NOCOPY = 0x04
+PL_BLOB_WCHAR = 0x08
+
 #        /*******************************
 #        *      CHAR BUFFERS    *
 #        *******************************/
@@ -839,6 +855,10 @@ PL_discard_foreign_frame = _lib.PL_discard_foreign_frame
 PL_discard_foreign_frame.argtypes = [fid_t]
 PL_discard_foreign_frame.restype = None
 
+PL_close_foreign_frame = _lib.PL_close_foreign_frame
+PL_close_foreign_frame.argtypes = [fid_t]
+PL_close_foreign_frame.restype = None
+
 PL_put_chars = _lib.PL_put_chars
 PL_put_chars.argtypes = [term_t, c_int, c_size_t, c_char_p]
 PL_put_chars.restype = c_int
@@ -904,6 +924,10 @@ PL_get_long = _lib.PL_get_long
 PL_get_long.argtypes = [term_t, POINTER(c_long)]
 PL_get_long.restype = c_int
 
+PL_get_int64 = _lib.PL_get_int64
+PL_get_int64.argtypes = [term_t, POINTER(c_int64)]
+PL_get_int64.restype = c_int
+
 PL_get_float = _lib.PL_get_float
 PL_get_float.argtypes = [term_t, c_double_p]
 PL_get_float.restype = c_int
@@ -992,6 +1016,10 @@ PL_cleanup.restype = c_int
 PL_unify_integer = _lib.PL_unify_integer
 PL_unify_atom_chars = _lib.PL_unify_atom_chars
 
+PL_unify_int64 = _lib.PL_unify_int64
+PL_unify_int64.argtypes = [term_t, c_int64]
+PL_unify_int64.restype = c_int
+
 PL_unify_float = _lib.PL_unify_float
 PL_unify_float.argtypes = [term_t, c_double]
 PL_unify_float.restype = c_int
@@ -1099,6 +1127,22 @@ PL_put_integer = _lib.PL_put_integer
 PL_put_integer.argtypes = [term_t, c_long]
 PL_put_integer.restype = None
 
+PL_put_int64 = _lib.PL_put_int64
+PL_put_int64.argtypes = [term_t, c_int64]
+PL_put_int64.restype = c_int
+
+PL_put_float = _lib.PL_put_float
+PL_put_float.argtypes = [term_t, c_double]
+PL_put_float.restype = c_int
+
+PL_put_bool = _lib.PL_put_bool
+PL_put_bool.argtypes = [term_t, c_int]
+PL_put_bool.restype = c_int
+
+PL_put_atom = _lib.PL_put_atom
+PL_put_atom.argtypes = [term_t, atom_t]
+PL_put_atom.restype = c_int
+
 PL_put_functor = _lib.PL_put_functor
 PL_put_functor.argtypes = [term_t, functor_t]
 PL_put_functor.restype = None
@@ -1129,6 +1173,10 @@ PL_exception = _lib.PL_exception
 PL_exception.argtypes = [qid_t]
 PL_exception.restype = term_t
 
+PL_raise_exception = _lib.PL_raise_exception
+PL_raise_exception.argtypes = [term_t]
+PL_raise_exception.restype = c_int
+
 PL_register_foreign = _lib.PL_register_foreign
 PL_register_foreign = check_strings(0, None)(PL_register_foreign)
 
@@ -1143,6 +1191,66 @@ PL_new_atom.restype = atom_t
 
 PL_new_atom = check_strings(0, None)(PL_new_atom)
 
+PL_new_atom_mbchars = _lib.PL_new_atom_mbchars
+PL_new_atom_mbchars.argtypes = [c_int, c_size_t, c_char_p]
+PL_new_atom_mbchars.restype = atom_t
+
+# PL_EXPORT(int)         PL_put_dict(term_t h, atom_t tag, size_t len,
+#                                    const atom_t *keys, term_t values);
+PL_put_dict = _lib.PL_put_dict
+PL_put_dict.argtypes = [term_t, atom_t, c_size_t, POINTER(atom_t), term_t]
+PL_put_dict.restype = c_int
+
+PL_blob_release_t = CFUNCTYPE(c_int, atom_t)
+
+
+class PL_blob_t(Structure):
+    _fields_ = [
+        ("magic", c_size_t),
+        ("flags", c_size_t),
+        ("name", c_char_p),
+        ("release", PL_blob_release_t),
+        ("compare", c_void_p),
+        ("write", c_void_p),
+        ("acquire", c_void_p),
+        ("save", c_void_p),
+        ("load", c_void_p),
+        ("padding", c_size_t),
+        # private fields of SWI-Prolog, with room to spare
+        ("reserved", c_void_p * 16),
+    ]
+
+
+# The blob types are passed as addresses, so the types returned by PL_get_blob can be compared
+PL_put_blob = _lib.PL_put_blob
+PL_put_blob.argtypes = [term_t, c_void_p, c_size_t, c_void_p]
+PL_put_blob.restype = c_int
+
+PL_unify_blob = _lib.PL_unify_blob
+PL_unify_blob.argtypes = [term_t, c_void_p, c_size_t, c_void_p]
+PL_unify_blob.restype = c_int
+
+PL_get_blob = _lib.PL_get_blob
+PL_get_blob.argtypes = [
+    term_t,
+    POINTER(c_void_p),
+    POINTER(c_size_t),
+    POINTER(c_void_p),
+]
+PL_get_blob.restype = c_int
+
+PL_blob_data = _lib.PL_blob_data
+PL_blob_data.argtypes = [atom_t, POINTER(c_size_t), POINTER(c_void_p)]
+PL_blob_data.restype = c_void_p
+
+# Returns the dict key for a small integer
+if hasattr(_lib, "_PL_cons_small_int"):
+    PL_cons_small_int = _lib._PL_cons_small_int
+    PL_cons_small_int.argtypes = [c_int64]
+    PL_cons_small_int.restype = atom_t
+else:
+    PL_cons_small_int = None
+
 PL_new_functor = _lib.PL_new_functor
 PL_new_functor.argtypes = [atom_t, c_int]
 PL_new_functor.restype = functor_t
@@ -1184,6 +1292,23 @@ PL_thread_attach_engine = _lib.PL_thread_attach_engine
 PL_thread_attach_engine.argtypes = [c_void_p]
 PL_thread_attach_engine.restype = c_int
 
+# PL_set_engine() return codes
+PL_ENGINE_SET = 0  # engine set successfully
+PL_ENGINE_INVAL = 2  # engine doesn't exist
+PL_ENGINE_INUSE = 3  # engine is in use
+
+PL_create_engine = _lib.PL_create_engine
+PL_create_engine.argtypes = [c_void_p]
+PL_create_engine.restype = PL_engine_t
+
+PL_set_engine = _lib.PL_set_engine
+PL_set_engine.argtypes = [PL_engine_t, POINTER(PL_engine_t)]
+PL_set_engine.restype = c_int
+
+PL_destroy_engine = _lib.PL_destroy_engine
+PL_destroy_engine.argtypes = [PL_engine_t]
+PL_destroy_engine.restype = c_int
+
 
 class _mbstate_t_value(Union):
     _fields_ = [("__wch", wint_t), ("__wchb", c_char * 4)]
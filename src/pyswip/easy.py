@@ -19,8 +19,17 @@
 # SOFTWARE.
 
 import inspect
-from typing import Union, Callable, Optional
-
+from typing import Union, Callable, Optional, TypeVar, Generic
+
+from pyswip.encoder import (
+    atom_encoder,
+    string_encoder,
+    text_encoder,
+    put_list,
+    dict_keys,
+    quote_text,
+)
+from pyswip.objects import registry as objects
 from pyswip.core import (
     PL_new_atom,
     PL_register_atom,
@@ -31,13 +40,6 @@ from pyswip.core import (
     PL_compare,
     PL_get_chars,
     PL_copy_term_ref,
-    PL_unify_atom,
-    PL_unify_string_chars,
-    PL_unify_integer,
-    PL_unify_bool,
-    PL_unify_float,
-    PL_unify_list,
-    PL_unify_nil,
     PL_term_type,
     PL_put_term,
     PL_new_functor,
@@ -47,14 +49,14 @@ from pyswip.core import (
     PL_new_term_refs,
     PL_get_arg,
     PL_cons_functor_v,
-    PL_put_atom_chars,
-    PL_put_integer,
+    PL_put_atom,
     PL_put_functor,
-    PL_put_nil,
-    PL_cons_list,
     PL_get_long,
+    PL_get_int64,
+    PL_get_bool,
     PL_get_float,
     PL_is_list,
+    PL_is_variable,
     PL_get_list,
     PL_register_foreign_in_module,
     PL_call,
@@ -68,6 +70,7 @@ from pyswip.core import (
     PL_STRINGS_MARK,
     PL_TERM,
     PL_DICT,
+    PL_BLOB,
     PL_ATOM,
     PL_STRING,
     PL_INTEGER,
@@ -92,6 +95,7 @@ from pyswip.core import (
     functor_t,
     c_int,
     c_long,
+    c_int64,
     c_double,
     foreign_t,
     term_t,
@@ -102,6 +106,8 @@ from pyswip.core import (
 
 integer_types = (int,)
 
+_T = TypeVar("_T")
+
 
 class InvalidTypeError(TypeError):
     def __init__(self, *args):
@@ -238,43 +244,9 @@ class Variable:
         else:
             t = PL_copy_term_ref(self.handle)
 
-        self._fun(value, t)
+        unifyTerm(t, value)
         self.handle = t
 
-    def _fun(self, value, t):
-        if type(value) == Atom:
-            fun = PL_unify_atom
-            value = value.handle
-        elif isinstance(value, str):
-            fun = PL_unify_string_chars
-            value = value.encode()
-        elif type(value) == int:
-            fun = PL_unify_integer
-        elif type(value) == bool:
-            fun = PL_unify_bool
-        elif type(value) == float:
-            fun = PL_unify_float
-        elif type(value) == list:
-            fun = PL_unify_list
-        else:
-            raise TypeError(
-                "Cannot unify {} with value {} due to the value unknown type {}".format(
-                    self, value, type(value)
-                )
-            )
-
-        if type(value) == list:
-            a = PL_new_term_ref(self.handle)
-            list_term = t
-            for element in value:
-                tail_term = PL_new_term_ref(self.handle)
-                fun(list_term, a, tail_term)
-                self._fun(element, a)
-                list_term = tail_term
-            PL_unify_nil(list_term)
-        else:
-            fun(t, value)
-
     def get_value(self):
         return getTerm(self.handle)
 
@@ -306,6 +278,87 @@ class Variable:
         return self.handle
 
 
+class TermRef:
+    """A handle to a Prolog term which is converted only on demand
+
+    Foreign predicates registered with ``raw=True`` receive their arguments as ``TermRef`` objects.
+    """
+
+    __slots__ = ("handle",)
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    @property
+    def type(self) -> int:
+        """Type of the term, one of ``PL_VARIABLE``, ``PL_ATOM``, ``PL_INTEGER``, etc."""
+        return PL_term_type(self.handle)
+
+    def is_variable(self) -> bool:
+        return bool(PL_is_variable(self.handle))
+
+    def get_int(self) -> int:
+        """If the term is an integer, return it, otherwise raise InvalidTypeError."""
+        return getInt64(self.handle)
+
+    def get_float(self) -> float:
+        """If the term is a number, return it as a float, otherwise raise InvalidTypeError."""
+        return getFloat(self.handle)
+
+    def get_bool(self) -> bool:
+        """If the term is ``true`` or ``false``, return it as a bool, otherwise raise InvalidTypeError."""
+        return getBoolean(self.handle)
+
+    def get_str(self) -> str:
+        """If the term is an atom or a string, return its text, otherwise raise InvalidTypeError."""
+        return getText(self.handle)
+
+    def get_object(self):
+        """If the term references a Python object, return it, otherwise raise InvalidTypeError."""
+        obj = objects.get(self.handle, _NOT_AN_OBJECT)
+        if obj is _NOT_AN_OBJECT:
+            raise InvalidTypeError("object")
+        return obj
+
+    def get_value(self):
+        """Returns the term converted as in :py:func:`getTerm`"""
+        return getTerm(self.handle)
+
+    value = property(get_value)
+
+    def unify(self, value) -> bool:
+        """Unifies the term with the given value, returns whether the unification succeeded
+
+        A ``str`` value is unified as a Prolog string, use :py:class:`Atom` to unify an atom.
+        """
+        return unifyTerm(self.handle, value)
+
+    def __repr__(self):
+        return f"TermRef({self.handle})"
+
+
+class Out(Generic[_T]):
+    """An output argument of a foreign predicate registered with ``typed=True``
+
+    The callable sets :py:attr:`value`, which is unified with the Prolog argument when the callable succeeds.
+    The argument is left unbound if :py:attr:`value` is ``None``.
+    The value is unified the same way as :py:meth:`TermRef.unify`,
+    so a ``str`` value is unified as a Prolog string and an :py:class:`Atom` as an atom.
+
+    >>> def score(x: int, name: str, out: Out[float]):
+    ...     out.value = x / len(name)
+    >>> Prolog.register_foreign(score, typed=True)
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Optional[_T] = None):
+        self.value = value
+
+    def __repr__(self):
+        return f"Out({self.value!r})"
+
+
 class Functor(object):
     __slots__ = "handle", "name", "arity", "args", "__value", "a0"
     func = {}
@@ -412,29 +465,44 @@ _not = Functor("not", 1)
 _comma = Functor(",", 2)
 
 
+def unifyTerm(term, value) -> bool:
+    """Unifies the term with the given Python value, returns whether the unification succeeded.
+
+    Strings are unified as Prolog strings.
+    """
+    return string_encoder.unify(term, value)
+
+
 def putTerm(term, value):
-    if isinstance(value, Term):
-        PL_put_term(term, value.handle)
-    elif isinstance(value, str):
-        PL_put_atom_chars(term, value)
-    elif isinstance(value, int):
-        PL_put_integer(term, value)
-    elif isinstance(value, Variable):
-        value.put(term)
-    elif isinstance(value, list):
-        putList(term, value)
-    elif isinstance(value, Functor):
-        PL_put_functor(term, value.handle)
-    else:
-        raise Exception(f"Not implemented for type: {type(value)}")
+    """Puts the Python value to the term. Strings are put as atoms."""
+    atom_encoder.put(term, value)
+
+
+def putList(l, ls, putItem=None):  # noqa: E741
+    put_list(l, ls, putItem or atom_encoder.put)
+
+
+def _put_handle(encoder, term, value):
+    PL_put_term(term, value.handle)
+
 
+def _put_atom(encoder, term, value):
+    PL_put_atom(term, value.handle)
 
-def putList(l, ls):  # noqa: E741
-    PL_put_nil(l)
-    for item in reversed(ls):
-        a = PL_new_term_ref()  # PL_new_term_refs(len(ls))
-        putTerm(a, item)
-        PL_cons_list(l, a, l)
+
+def _put_functor(encoder, term, value):
+    PL_put_functor(term, value.handle)
+
+
+for _encoder in (atom_encoder, string_encoder):
+    _encoder.register(Term, _put_handle)
+    _encoder.register(TermRef, _put_handle)
+    _encoder.register(Variable, _put_handle)
+    _encoder.register(Atom, _put_atom)
+    _encoder.register(Functor, _put_functor)
+
+text_encoder.register(Atom, lambda encoder, value: quote_text(value.chars, "'"))
+text_encoder.register(Variable, lambda encoder, value: value.chars)
 
 
 def getAtomChars(t):
@@ -490,6 +558,33 @@ def getString(t):
         raise InvalidTypeError("string")
 
 
+def getInt64(t) -> int:
+    """If t is an integer which fits in 64 bits, return it, otherwise raise InvalidTypeError."""
+    i = c_int64()
+    if PL_get_int64(t, byref(i)):
+        return i.value
+    else:
+        raise InvalidTypeError("integer")
+
+
+def getBoolean(t) -> bool:
+    """If t is ``true`` or ``false``, return it as a bool, otherwise raise InvalidTypeError."""
+    b = c_int()
+    if PL_get_bool(t, byref(b)):
+        return bool(b.value)
+    else:
+        raise InvalidTypeError("bool")
+
+
+def getText(t) -> str:
+    """If t is an atom or a string, return its text, otherwise raise InvalidTypeError."""
+    s = c_char_p()
+    if PL_get_chars(t, byref(s), CVT_ATOM | CVT_STRING | REP_UTF8):
+        return s.value.decode()
+    else:
+        raise InvalidTypeError("text")
+
+
 def getTerm(t):
     if t is None:
         return None
@@ -497,6 +592,8 @@ def getTerm(t):
         p = PL_term_type(t)
         if p < PL_TERM:
             res = _getterm_router[p](t)
+        elif p == PL_BLOB:
+            res = getBlob(t)
         elif PL_is_list(t):
             res = getList(t)
         elif p == PL_DICT:
@@ -506,9 +603,24 @@ def getTerm(t):
         return res
 
 
+def getBlob(t):
+    """Returns the Python object referenced by the blob, or the blob as an :py:class:`Atom`."""
+    obj = objects.get(t, _NOT_AN_OBJECT)
+    if obj is _NOT_AN_OBJECT:
+        return getAtom(t)
+    return obj
+
+
+# Marks blobs which do not reference a Python object
+_NOT_AN_OBJECT = object()
+
+
 def getDict(term):
     """
     Return term as a dictionary.
+
+    The values are converted with :py:func:`getTerm`, so strings are returned as ``bytes``,
+    as everywhere else.
     """
 
     if isinstance(term, Term):
@@ -517,23 +629,26 @@ def getDict(term):
         raise ArgumentTypeError((str(Term), str(int)), str(type(term)))
 
     f = functor_t()
-    if PL_get_functor(term, byref(f)):
-        args = []
-        arity = PL_functor_arity(f.value)
-        a0 = PL_new_term_refs(arity)
-        for i, a in enumerate(range(1, arity + 1)):
-            if PL_get_arg(a, term, a0 + i):
-                args.append(getTerm(a0 + i))
-            else:
-                raise Exception("Missing arg")
-
-        it = iter(args[1:])
-        d = {k.value: v for v, k in zip(it, it)}
+    if not PL_get_functor(term, byref(f)):
+        return getFunctor(term)
 
+    # the arguments of a dict are the tag, followed by value, key pairs
+    size = PL_functor_arity(f.value) // 2
+    d = {}
+    if not size:
         return d
-    else:
-        res = getFunctor(term)
-        return res
+    values = PL_new_term_refs(size)
+    key = PL_new_term_ref()
+    a = atom_t()
+    for i in range(size):
+        PL_get_arg(2 * i + 2, term, values + i)
+        PL_get_arg(2 * i + 3, term, key)
+        if PL_get_atom(key, byref(a)):
+            k = dict_keys.name(a.value, key)
+        else:
+            k = getInt64(key)
+        d[k] = getTerm(values + i)
+    return d
 
 
 def getList(x):
@@ -0,0 +1,428 @@
+# Copyright (c) 2007-2024 Yüce Tekol and PySwip Contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Conversion of Python values to Prolog terms and Prolog source text.
+
+An encoder keeps a handler per Python type. The handler for a type is looked up along its MRO once,
+and the result is cached, so converting a value costs a dictionary lookup and the handler call.
+Handlers receive the encoder, so containers convert their items with the same encoder.
+"""
+
+import re
+from typing import Callable, Dict, Union
+
+from pyswip.core import (
+    PL_put_int64,
+    PL_put_float,
+    PL_put_bool,
+    PL_put_chars,
+    PL_put_nil,
+    PL_put_dict,
+    PL_cons_list,
+    PL_chars_to_term,
+    PL_new_term_ref,
+    PL_new_term_refs,
+    PL_new_atom_mbchars,
+    PL_unregister_atom,
+    PL_register_atom,
+    PL_get_chars,
+    PL_cons_small_int,
+    PL_unify,
+    PL_ATOM,
+    PL_STRING,
+    REP_UTF8,
+    CVT_ATOM,
+    byref,
+    atom_t,
+    c_char,
+    c_char_p,
+    cast,
+)
+
+__all__ = (
+    "Encoder",
+    "TermEncoder",
+    "TextEncoder",
+    "KeyCache",
+    "dict_keys",
+    "atom_encoder",
+    "string_encoder",
+    "text_encoder",
+    "put_list",
+    "put_buffer",
+    "put_bytes",
+    "put_dict",
+    "quote_text",
+)
+
+
+class Encoder:
+    """Keeps the conversion handlers for Python types
+
+    A handler is registered for a type, or for the name of an attribute.
+    Attribute handlers are used for types without a handler in their MRO which have the attribute,
+    e.g., ``tolist`` for NumPy arrays.
+    """
+
+    __slots__ = "_handlers", "_attributes", "_cache"
+
+    def __init__(self) -> None:
+        self._handlers = {}
+        self._attributes = {}
+        self._cache = {}
+
+    def register(self, key: Union[type, str], handler: Callable) -> None:
+        """Registers the handler for the type or the attribute name"""
+        if isinstance(key, str):
+            self._attributes[key] = handler
+        else:
+            self._handlers[key] = handler
+        self._cache.clear()
+
+    def copy(self):
+        encoder = type(self)()
+        encoder._handlers.update(self._handlers)
+        encoder._attributes.update(self._attributes)
+        return encoder
+
+    def lookup(self, type_: type) -> Callable:
+        """Returns the handler for the type, raises TypeError if there is none"""
+        handler = self._cache.get(type_)
+        if handler is not None:
+            return handler
+        for base in type_.__mro__:
+            handler = self._handlers.get(base)
+            if handler is not None:
+                break
+        else:
+            for name, attribute_handler in self._attributes.items():
+                if hasattr(type_, name):
+                    handler = attribute_handler
+                    break
+            else:
+                raise TypeError(f"Cannot convert a value of type: {type_}")
+        self._cache[type_] = handler
+        return handler
+
+
+class TermEncoder(Encoder):
+    """Puts Python values to term refs"""
+
+    __slots__ = ()
+
+    def put(self, term, value) -> None:
+        try:
+            handler = self._cache[type(value)]
+        except KeyError:
+            handler = self.lookup(type(value))
+        handler(self, term, value)
+
+    def unify(self, term, value) -> bool:
+        t = PL_new_term_ref()
+        self.put(t, value)
+        return bool(PL_unify(term, t))
+
+
+class TextEncoder(Encoder):
+    """Converts Python values to Prolog source text"""
+
+    __slots__ = ()
+
+    def text(self, value) -> str:
+        try:
+            handler = self._cache[type(value)]
+        except KeyError:
+            handler = self.lookup(type(value))
+        return handler(self, value)
+
+
+def put_list(term, items, put_item: Callable) -> None:
+    """Puts the items as a list, converting each item with ``put_item(term, item)``"""
+    PL_put_nil(term)
+    # the list cell copies the head, so a single term ref is enough
+    head = PL_new_term_ref()
+    for item in reversed(items):
+        put_item(head, item)
+        PL_cons_list(term, head, term)
+
+
+def put_buffer(term, value, put_item: Callable) -> None:
+    """Puts a typed buffer, such as an ``array.array`` or a one dimensional NumPy array, as a list
+
+    Numeric buffers are converted with ``tolist`` and put with a single function for all items.
+    Other buffers are converted item by item with ``put_item``.
+    """
+    typecode = getattr(value, "typecode", None)
+    if typecode is not None:
+        kind = _TYPECODE_KINDS.get(typecode)
+    elif getattr(value, "ndim", 1) == 1:
+        kind = getattr(getattr(value, "dtype", None), "kind", None)
+    else:
+        kind = None
+    put_item = _BUFFER_PUTTERS.get(kind, put_item)
+    items = value.tolist()
+    if isinstance(items, list):
+        put_list(term, items, put_item)
+    else:
+        # a NumPy scalar
+        put_item(term, items)
+
+
+def put_bytes(term, value) -> None:
+    """Puts bytes, a bytearray or a memoryview as a Prolog string of the byte codes, without decoding it"""
+    if isinstance(value, bytes):
+        PL_put_chars(term, PL_STRING, len(value), value)
+        return
+    value = memoryview(value)
+    if value.readonly or not value.c_contiguous:
+        value = value.tobytes()
+        PL_put_chars(term, PL_STRING, len(value), value)
+    else:
+        data = (c_char * value.nbytes).from_buffer(value)
+        PL_put_chars(term, PL_STRING, value.nbytes, cast(data, c_char_p))
+
+
+def put_dict(term, value: Dict, put_item: Callable) -> None:
+    """Puts the dictionary as an SWI-Prolog dict without a tag
+
+    The keys must be strings, :py:class:`Atom` objects or small integers.
+    The atoms of string keys are cached in :py:data:`dict_keys`.
+    """
+    size = len(value)
+    keys = (atom_t * size)()
+    values = PL_new_term_refs(size)
+    created = []
+    try:
+        for i, (key, item) in enumerate(value.items()):
+            keys[i] = _dict_key(key, created)
+            put_item(values + i, item)
+        if not PL_put_dict(term, 0, size, keys, values):
+            raise ValueError(f"Cannot convert the dictionary: {value!r}")
+    finally:
+        for atom in created:
+            PL_unregister_atom(atom)
+
+
+class KeyCache:
+    """Caches the atoms of dict keys, in both directions
+
+    The cached atoms are registered, so they are not garbage collected while they are in the cache.
+    Entries are never evicted: once the cache is full, the atoms of new keys are created and released on each use.
+    """
+
+    __slots__ = "size", "_atoms", "_names"
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._atoms = {}
+        self._names = {}
+
+    def atom(self, name: str, created: list):
+        """Returns the atom for the name, appends it to ``created`` if the caller must unregister it"""
+        atom = self._atoms.get(name)
+        if atom is None:
+            text = name.encode()
+            # the new atom is registered, the cache keeps that reference
+            atom = PL_new_atom_mbchars(REP_UTF8, len(text), text)
+            if len(self._atoms) < self.size:
+                self._atoms[name] = atom
+            else:
+                created.append(atom)
+        return atom
+
+    def name(self, atom, term) -> str:
+        """Returns the text of the atom, which is the value of the term"""
+        name = self._names.get(atom)
+        if name is None:
+            s = c_char_p()
+            PL_get_chars(term, byref(s), CVT_ATOM | REP_UTF8)
+            name = s.value.decode()
+            if len(self._names) < self.size:
+                PL_register_atom(atom)
+                self._names[atom] = name
+        return name
+
+    def __len__(self) -> int:
+        return len(self._atoms) + len(self._names)
+
+
+dict_keys = KeyCache(16384)
+
+
+def _dict_key(key, created: list):
+    if isinstance(key, str):
+        return dict_keys.atom(key, created)
+    if isinstance(key, int) and not isinstance(key, bool):
+        if PL_cons_small_int is None:
+            raise TypeError(
+                "Integer dictionary keys are not supported by this SWI-Prolog"
+            )
+        return PL_cons_small_int(key)
+    handle = getattr(key, "handle", None)
+    if handle is None:
+        raise TypeError(f"Invalid dictionary key: {key!r}")
+    return handle
+
+
+def _put_int(encoder, term, value) -> None:
+    if -(2**63) <= value < 2**63:
+        PL_put_int64(term, value)
+    else:
+        PL_chars_to_term(str(value), term)
+
+
+def _put_float(encoder, term, value) -> None:
+    PL_put_float(term, value)
+
+
+def _put_bool(encoder, term, value) -> None:
+    PL_put_bool(term, value)
+
+
+def _put_bool_int(encoder, term, value) -> None:
+    # putTerm has always put booleans as the integers 1 and 0
+    PL_put_int64(term, int(value))
+
+
+def _put_atom_text(encoder, term, value) -> None:
+    text = value.encode()
+    PL_put_chars(term, PL_ATOM | REP_UTF8, len(text), text)
+
+
+def _put_string_text(encoder, term, value) -> None:
+    text = value.encode()
+    PL_put_chars(term, PL_STRING | REP_UTF8, len(text), text)
+
+
+def _put_bytes(encoder, term, value) -> None:
+    put_bytes(term, value)
+
+
+def _put_sequence(encoder, term, value) -> None:
+    put_list(term, value, encoder.put)
+
+
+def _put_buffer(encoder, term, value) -> None:
+    put_buffer(term, value, encoder.put)
+
+
+def _put_dict(encoder, term, value) -> None:
+    put_dict(term, value, encoder.put)
+
+
+# Maps array.array type codes to NumPy dtype kinds
+_TYPECODE_KINDS = {
+    **dict.fromkeys("bhilq", "i"),
+    **dict.fromkeys("BHILQ", "u"),
+    **dict.fromkeys("fd", "f"),
+}
+
+# Puts an item of a buffer of the given kind
+_BUFFER_PUTTERS = {
+    "f": PL_put_float,
+    "i": PL_put_int64,
+    "u": lambda term, value: _put_int(None, term, value),
+    "b": PL_put_bool,
+}
+
+
+_RE_CONTROL_CHAR = re.compile(r"[\x00-\x1f\x7f]")
+
+
+def quote_text(text: str, quote: str = '"') -> str:
+    """Quotes the text as a Prolog string (``"``) or quoted atom (``'``), escaping backslashes, quotes and control characters"""
+    text = text.replace("\\", "\\\\").replace(quote, "\\" + quote)
+    text = _RE_CONTROL_CHAR.sub(lambda m: f"\\x{ord(m.group()):x}\\", text)
+    return f"{quote}{text}{quote}"
+
+
+def _text_str(encoder, value) -> str:
+    return quote_text(value)
+
+
+def _text_bytes(encoder, value) -> str:
+    # the byte codes, like put_bytes does
+    return quote_text(bytes(value).decode("latin-1"))
+
+
+def _text_sequence(encoder, value) -> str:
+    inner = ",".join(encoder.text(v) for v in value)
+    return f"[{inner}]"
+
+
+def _text_dict(encoder, value) -> str:
+    inner = ",".join(
+        f"{_text_dict_key(encoder, k)}:{encoder.text(v)}" for k, v in value.items()
+    )
+    return f"_{{{inner}}}"
+
+
+def _text_dict_key(encoder, key) -> str:
+    if isinstance(key, str):
+        return quote_text(key, "'")
+    return encoder.text(key)
+
+
+def _text_bool(encoder, value) -> str:
+    return "1" if value else "0"
+
+
+def _text_object(encoder, value) -> str:
+    return str(value)
+
+
+# Puts strings as atoms, used for the arguments of queries and predicates
+atom_encoder = TermEncoder()
+for _type, _handler in (
+    (int, _put_int),
+    (float, _put_float),
+    (bool, _put_bool_int),
+    (str, _put_atom_text),
+    (bytes, _put_bytes),
+    (bytearray, _put_bytes),
+    (memoryview, _put_bytes),
+    (list, _put_sequence),
+    (tuple, _put_sequence),
+    (dict, _put_dict),
+):
+    atom_encoder.register(_type, _handler)
+atom_encoder.register("tolist", _put_buffer)
+
+# Puts strings as Prolog strings, used to unify values returned from Python
+string_encoder = atom_encoder.copy()
+string_encoder.register(str, _put_string_text)
+string_encoder.register(bool, _put_bool)
+
+# Converts values to Prolog source text for format_prolog
+text_encoder = TextEncoder()
+for _type, _handler in (
+    (object, _text_object),
+    (bool, _text_bool),
+    (str, _text_str),
+    (bytes, _text_bytes),
+    (bytearray, _text_bytes),
+    (list, _text_sequence),
+    (tuple, _text_sequence),
+    (dict, _text_dict),
+):
+    text_encoder.register(_type, _handler)
+
+del _type, _handler
@@ -0,0 +1,136 @@
+# Copyright (c) 2007-2024 Yüce Tekol and PySwip Contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Passing Python objects to Prolog by reference.
+
+An object wrapped in :py:class:`ObjectRef` is put to Prolog as a blob, which refers to the object in a registry.
+Prolog code can store the blob and pass it around like an atom. Foreign predicates receive the object itself,
+looked up in O(1) without any conversion.
+The registry drops its reference when Prolog garbage collects the blob, so ``len(registry)`` is the number of
+objects still referenced from Prolog.
+
+>>> def matrix_rows(matrix, n):
+...     n.unify(len(matrix))
+>>> Prolog.register_foreign(matrix_rows)
+>>> features = [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+>>> Prolog.predicate("nb_setval", 2).exists("features", ObjectRef(features))
+True
+>>> Prolog.once("nb_getval(features, M), matrix_rows(M, N)")["N"]
+3
+"""
+
+from typing import Any
+
+from pyswip.core import (
+    PL_blob_t,
+    PL_blob_release_t,
+    PL_put_blob,
+    PL_get_blob,
+    PL_blob_data,
+    PL_BLOB_MAGIC,
+    PL_BLOB_UNIQUE,
+    addressof,
+    byref,
+    c_size_t,
+    c_void_p,
+    sizeof,
+)
+from pyswip.encoder import atom_encoder, string_encoder, text_encoder
+
+__all__ = ("ObjectRef", "ObjectRegistry", "registry")
+
+
+class ObjectRef:
+    """Wraps a Python object, so it is passed to Prolog by reference"""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any) -> None:
+        self.obj = obj
+
+    def __repr__(self):
+        return f"ObjectRef({self.obj!r})"
+
+
+class ObjectRegistry:
+    """Keeps the Python objects referenced from Prolog, indexed by the content of their blobs
+
+    The blob of an object holds its ``id``, and the blob type is unique, so passing the same object again
+    results in the same blob.
+    """
+
+    __slots__ = "_objects", "_release", "_blob_type", "_address"
+
+    def __init__(self, name: str) -> None:
+        self._objects = {}
+        # the callback and the blob type must stay alive as long as the library
+        self._release = PL_blob_release_t(self._released)
+        self._blob_type = PL_blob_t(
+            magic=PL_BLOB_MAGIC,
+            flags=PL_BLOB_UNIQUE,
+            name=name.encode(),
+            release=self._release,
+        )
+        self._address = addressof(self._blob_type)
+
+    def put(self, term, obj: Any) -> None:
+        """Puts a blob referencing the object to the term"""
+        key = c_size_t(id(obj))
+        self._objects[key.value] = obj
+        if not PL_put_blob(term, byref(key), sizeof(key), self._address):
+            raise ValueError(f"Cannot create a blob for the object: {obj!r}")
+
+    def get(self, term, default=None) -> Any:
+        """Returns the object referenced by the term, or ``default`` if the term is not a blob of this registry"""
+        data = c_void_p()
+        blob_type = c_void_p()
+        if not PL_get_blob(term, byref(data), None, byref(blob_type)):
+            return default
+        if blob_type.value != self._address:
+            return default
+        return self._objects[c_size_t.from_address(data.value).value]
+
+    def _released(self, atom) -> int:
+        data = PL_blob_data(atom, None, None)
+        if data:
+            self._objects.pop(c_size_t.from_address(data).value, None)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+
+registry = ObjectRegistry("python_object")
+
+
+def _put_object(encoder, term, value) -> None:
+    registry.put(term, value.obj)
+
+
+def _text_object(encoder, value) -> str:
+    raise TypeError(
+        "Objects cannot be passed in query text, pass them to predicate handles or foreign predicates"
+    )
+
+
+atom_encoder.register(ObjectRef, _put_object)
+string_encoder.register(ObjectRef, _put_object)
+text_encoder.register(ObjectRef, _text_object)
@@ -22,10 +22,27 @@
 Provides the basic Prolog interface.
 """
 
+import asyncio
+import collections
 import functools
 import inspect
+import itertools
 import re
-from typing import Union, Generator, Callable, Optional, Tuple
+import threading
+import time
+import typing
+import weakref
+from typing import (
+    Union,
+    Generator,
+    Callable,
+    Optional,
+    Tuple,
+    Sequence,
+    List,
+    Dict,
+    Iterable,
+)
 from pathlib import Path
 
 from pyswip.utils import resolve_path
@@ -36,6 +53,9 @@ from pyswip.core import (
     PL_Q_NODEBUG,
     PL_Q_CATCH_EXCEPTION,
     PL_Q_NORMAL,
+    PL_Q_EXT_STATUS,
+    PL_S_EXCEPTION,
+    PL_S_FALSE,
     PL_FA_NONDETERMINISTIC,
     CFUNCTYPE,
     PL_initialise,
@@ -44,6 +64,12 @@ from pyswip.core import (
     PL_chars_to_term,
     PL_call,
     PL_discard_foreign_frame,
+    PL_close_foreign_frame,
+    PL_foreign_control,
+    PL_foreign_context,
+    PL_retry,
+    PL_FIRST_CALL,
+    PL_PRUNED,
     PL_new_term_refs,
     PL_put_chars,
     PL_predicate,
@@ -55,16 +81,59 @@ from pyswip.core import (
     PL_thread_self,
     PL_thread_attach_engine,
     PL_register_foreign_in_module,
+    PL_get_arg,
+    PL_unify,
+    PL_unify_int64,
+    PL_unify_float,
+    PL_unify_bool,
+    PL_unify_atom,
+    PL_unify_string_chars,
+    PL_raise_exception,
+    PL_create_engine,
+    PL_set_engine,
+    PL_destroy_engine,
+    PL_ENGINE_SET,
+    PL_engine_t,
+    byref,
     foreign_t,
     term_t,
     control_t,
 )
 
 
-__all__ = "PrologError", "NestedQueryError", "Prolog"
+__all__ = (
+    "PrologError",
+    "NestedQueryError",
+    "QueryTimeout",
+    "InferenceLimitExceeded",
+    "QueryCancelled",
+    "CancelToken",
+    "Snapshot",
+    "KeyedTable",
+    "ChangeFeed",
+    "MaterializedView",
+    "Prolog",
+    "Predicate",
+)
 
 
 RE_PLACEHOLDER = re.compile(r"%p")
+AGGREGATES = "count", "sum", "max", "min", "bag", "set"
+RE_AGGREGATE = re.compile(r"\s*([a-z]+)\s*(?:\((.*)\))?\s*", re.DOTALL)
+RE_VARIABLE = re.compile(
+    r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\b([A-Z_][A-Za-z0-9_]*)"""
+)
+RE_TABLE_NAME = re.compile(r"[a-z][A-Za-z0-9_]*")
+RE_INDICATOR = re.compile(r"\s*([a-z][A-Za-z0-9_]*)\s*/\s*(\d+)\s*")
+RE_QUALIFIED_INDICATOR = re.compile(
+    r"\s*(?:([a-z][A-Za-z0-9_]*)\s*:)?\s*([a-z][A-Za-z0-9_]*)\s*/\s*(\d+)\s*"
+)
+TABLE_MODES = "variant", "subsumptive", "incremental", "shared"
+RE_CALL_MODE = re.compile(
+    r"\s*(?:([a-z][A-Za-z0-9_]*)\s*:)?\s*([a-z][A-Za-z0-9_]*)\s*\(\s*([-+?](?:\s*,\s*[-+?])*)\s*\)\s*"
+)
+# prolog_listen/2 channels of the clause updates, see ChangeFeed
+FEED_CHANNELS = "assert", "retract", "erase"
 
 
 class PrologError(Exception):
@@ -73,13 +142,499 @@ class PrologError(Exception):
 
 class NestedQueryError(PrologError):
     """
-    SWI-Prolog does not accept nested queries, that is, opening a query while the previous one was not closed.
-    As this error may be somewhat difficult to debug in foreign code, it is automatically treated inside PySwip
+    SWI-Prolog does not accept nested queries on the same engine, that is, opening a query while the previous one was not closed.
+    PySwip runs nested queries on temporary engines.
+    This error is raised if a temporary engine cannot be created, e.g., with a single-threaded SWI-Prolog build.
     """
 
     pass
 
 
+class QueryTimeout(PrologError):
+    """Raised when a query exceeds its time limit"""
+
+    pass
+
+
+class InferenceLimitExceeded(PrologError):
+    """Raised when a query exceeds its inference limit"""
+
+    pass
+
+
+class QueryCancelled(PrologError):
+    """Raised when a query is cancelled using a :py:class:`CancelToken`"""
+
+    pass
+
+
+_HELPER_DYNAMIC = [
+    "pyswip_running/2",
+    "pyswip_feed_predicate/5",
+    "pyswip_view/4",
+]
+
+_HELPER_CLAUSES = [
+    """
+    pyrun(GoalString,BindingList) :-
+        (read_term_from_atom(GoalString, Goal, [variable_names(BindingList)]),
+        call(Goal))
+    """,
+    """
+    pyswip_call_with_limits(Goal, Timeout, MaxInferences) :-
+        (   MaxInferences == inf
+        ->  LimitedGoal = Goal
+        ;   LimitedGoal = pyswip_call_with_inference_limit(Goal, MaxInferences)
+        ),
+        (   Timeout == inf
+        ->  call(LimitedGoal)
+        ;   setup_call_cleanup(
+                alarm(Timeout, throw(time_limit_exceeded), Alarm, [install(true)]),
+                LimitedGoal,
+                remove_alarm(Alarm)
+            )
+        )
+    """,
+    """
+    pyswip_cancellable(Id, Goal) :-
+        thread_self(Me),
+        setup_call_cleanup(
+            assertz(pyswip_running(Id, Me)),
+            (   pyswip_token_cancelled(Id)
+            ->  throw(pyswip_cancelled)
+            ;   call(Goal)
+            ),
+            retractall(pyswip_running(Id, _))
+        )
+    """,
+    """
+    pyswip_cancel(Id) :-
+        forall(
+            pyswip_running(Id, Thread),
+            catch(thread_signal(Thread, pyswip_cancel_signal(Id)), _, true)
+        )
+    """,
+    """
+    pyswip_cancel_signal(Id) :-
+        thread_self(Me),
+        (   pyswip_running(Id, Me)
+        ->  throw(pyswip_cancelled)
+        ;   true
+        )
+    """,
+    """
+    pyswip_load_table(M, Name, Arity, Rows) :-
+        dynamic(M:Name/Arity),
+        forall(member(Row, Rows), (Head =.. [Name|Row], assertz(M:Head)))
+    """,
+    """
+    pyswip_redirect(M, Shadow, Name, Arity) :-
+        functor(Head, Name, Arity),
+        dynamic(Shadow:Name/Arity),
+        dynamic(M:Name/Arity),
+        transaction((retractall(M:Head), assertz((M:Head :- Shadow:Head))))
+    """,
+    """
+    pyswip_key_pattern(M, Name, Arity, Key, K, M:Pattern) :-
+        functor(Pattern, Name, Arity),
+        arg(Key, Pattern, K)
+    """,
+    """
+    pyswip_upsert(M, Name, Arity, Key, Row) :-
+        Head =.. [Name|Row],
+        arg(Key, Head, K),
+        pyswip_key_pattern(M, Name, Arity, Key, K, Pattern),
+        retractall(Pattern),
+        assertz(M:Head)
+    """,
+    """
+    pyswip_bulk_upsert(M, Name, Arity, Key, Rows) :-
+        forall(member(Row, Rows), pyswip_upsert(M, Name, Arity, Key, Row))
+    """,
+    """
+    pyswip_delete(M, Name, Arity, Key, K) :-
+        pyswip_key_pattern(M, Name, Arity, Key, K, Pattern),
+        retract(Pattern),
+        !
+    """,
+    """
+    pyswip_get(M, Name, Arity, Key, K, Row) :-
+        pyswip_key_pattern(M, Name, Arity, Key, K, Pattern),
+        once(Pattern),
+        Pattern = _:Head,
+        Head =.. [_|Row]
+    """,
+    """
+    pyswip_feed_event(Id, Action, Ref) :-
+        (   blob(Ref, clause),
+            clause_property(Ref, predicate(PI)),
+            pyswip_feed_predicate(Id, PI, Index, Queue, MaxLen)
+        ->  (   MaxLen \\== inf,
+                message_queue_property(Queue, size(Size)),
+                Size >= MaxLen
+            ->  flag(Queue, Dropped, Dropped + 1)
+            ;   functor(Action, Name, _),
+                (   sub_atom(Name, 0, _, _, assert)
+                ->  Kind = assert
+                ;   Kind = Name
+                ),
+                (   catch(clause(Head0, Body, Ref), _, fail)
+                ->  strip_module(Head0, _, Head),
+                    Head =.. [_|Args],
+                    (   Body == true
+                    ->  Event = e(Index, Kind, Args)
+                    ;   Event = r(Index, Kind, Args)
+                    )
+                ;   Event = e(Index, Kind)
+                ),
+                thread_send_message(Queue, Event)
+            )
+        ;   true
+        )
+    """,
+    """
+    pyswip_feed_drain(Queue, Events, Dropped) :-
+        flag(Queue, Dropped, 0),
+        findall(
+            Event,
+            (   repeat,
+                (   thread_get_message(Queue, Event0, [timeout(0)])
+                ->  Event = Event0
+                ;   !,
+                    fail
+                )
+            ),
+            Events
+        )
+    """,
+    """
+    pyswip_feed_size(Queue, Size) :-
+        message_queue_property(Queue, size(Size))
+    """,
+    """
+    pyswip_view_create(Id, Text, Names, Deps, Incremental) :-
+        term_string(Goal, Text, [variable_names(Bindings)]),
+        maplist(pyswip_view_var(Bindings), Names, Template),
+        (   pyswip_view_pure(Goal, Deps)
+        ->  atom_concat(pyswip_view_rows_, Id, Name),
+            length(Names, Arity),
+            dynamic(pyswip_views:(Name/Arity)),
+            Row =.. [Name|Template],
+            Store = pyswip_views:Row,
+            Incremental = true
+        ;   Store = none,
+            Incremental = false
+        ),
+        assertz(pyswip_view(Id, Template, Goal, Store))
+    """,
+    """
+    pyswip_view_var(Bindings, Name, Var) :-
+        memberchk(Name=Var, Bindings)
+    """,
+    """
+    pyswip_view_pure(Goal, Deps) :-
+        (   Goal = (A, B)
+        ->  pyswip_view_pure(A, Deps),
+            pyswip_view_pure(B, Deps)
+        ;   callable(Goal),
+            strip_module(user:Goal, M, G),
+            functor(G, Name, Arity),
+            (   memberchk(M:(Name/Arity), Deps)
+            ->  true
+            ;   predicate_property(M:G, built_in),
+                \\+ predicate_property(M:G, meta_predicate(_))
+            )
+        )
+    """,
+    """
+    pyswip_view_pin(Goal, Fact, Rest) :-
+        (   Goal = (A, B)
+        ->  (   pyswip_view_pin(A, Fact, RestA),
+                Rest = (RestA, B)
+            ;   pyswip_view_pin(B, Fact, RestB),
+                Rest = (A, RestB)
+            )
+        ;   strip_module(user:Goal, M, G),
+            Fact = M:G,
+            Rest = true
+        )
+    """,
+    """
+    pyswip_view_full(Id, Rows) :-
+        pyswip_view(Id, Template, Goal, Store),
+        findall(Template, Goal, Rows0),
+        sort(Rows0, Rows),
+        (   Store = M:Row
+        ->  functor(Row, Name, Arity),
+            functor(Any, Name, Arity),
+            retractall(M:Any),
+            forall(member(Template, Rows), assertz(Store))
+        ;   true
+        )
+    """,
+    """
+    pyswip_view_update(Id, FeedId, Queue, Mode, Added, Removed) :-
+        pyswip_feed_drain(Queue, Events, Dropped),
+        (   Dropped =:= 0,
+            pyswip_view(Id, _, _, _:_),
+            forall(member(Event, Events), Event = e(_, _, _))
+        ->  Mode = delta,
+            pyswip_view_delta(Id, FeedId, Events, Added, Removed)
+        ;   Mode = full,
+            pyswip_view_full(Id, Added),
+            Removed = []
+        )
+    """,
+    """
+    pyswip_view_delta(Id, FeedId, Events, Added, Removed) :-
+        findall(
+            Kind-(M:Head),
+            (   member(e(Index, Kind, Args), Events),
+                pyswip_feed_predicate(FeedId, M:(Name/_), Index, _, _),
+                Head =.. [Name|Args]
+            ),
+            Changes
+        ),
+        findall(
+            T,
+            (   member(Kind-Fact, Changes),
+                Kind \\== assert,
+                pyswip_view(Id, T, G, S),
+                pyswip_view_pin(G, Fact, _),
+                call(S)
+            ),
+            Removed0
+        ),
+        sort(Removed0, Removed1),
+        findall(T, (member(T, Removed1), pyswip_view(Id, T, G, _), \\+ G), Removed),
+        findall(
+            T,
+            (   member(assert-Fact, Changes),
+                pyswip_view(Id, T, G, _),
+                pyswip_view_pin(G, Fact, Rest),
+                call(Rest)
+            ),
+            Added0
+        ),
+        sort(Added0, Added1),
+        findall(
+            T,
+            (   member(T, Added1),
+                pyswip_view(Id, T, G, S),
+                \\+ S,
+                \\+ \\+ G
+            ),
+            Added
+        ),
+        pyswip_view(Id, Template, _, Store),
+        forall(member(Template, Removed), retract(Store)),
+        forall(member(Template, Added), assertz(Store))
+    """,
+    """
+    pyswip_view_drop(Id) :-
+        (   retract(pyswip_view(Id, _, _, M:Row))
+        ->  functor(Row, Name, Arity),
+            abolish(M:(Name/Arity))
+        ;   retractall(pyswip_view(Id, _, _, _))
+        )
+    """,
+    """
+    pyswip_snapshot_open(Thread, Replies, Commit) :-
+        message_queue_create(_, [alias(Replies)]),
+        thread_create(pyswip_snapshot_run(Replies, Commit), _, [alias(Thread)])
+    """,
+    """
+    pyswip_snapshot_run(Replies, Commit) :-
+        (   Commit == true
+        ->  Goal = transaction(pyswip_snapshot_serve(Replies))
+        ;   Goal = snapshot(pyswip_snapshot_serve(Replies))
+        ),
+        catch(
+            (   call(Goal)
+            ->  Result = true
+            ;   Result = false
+            ),
+            Error,
+            Result = error(Error)
+        ),
+        thread_send_message(Replies, Result)
+    """,
+    """
+    pyswip_snapshot_serve(Replies) :-
+        thread_get_message(Request),
+        (   Request == commit
+        ->  true
+        ;   Request == rollback
+        ->  fail
+        ;   pyswip_snapshot_handle(Request, Replies),
+            pyswip_snapshot_serve(Replies)
+        )
+    """,
+    """
+    pyswip_snapshot_handle(Request, Replies) :-
+        (   Request = update(Action, Clause)
+        ->  catch(ignore(call(Action, Clause)), Error, true),
+            (   var(Error)
+            ->  thread_send_message(Replies, true)
+            ;   thread_send_message(Replies, error(Error))
+            )
+        ;   Request = query(Id, Bindings, Goal)
+        ->  catch(
+                (   call(Goal),
+                    thread_send_message(Replies, solution(Bindings)),
+                    pyswip_snapshot_wait(Id, Replies)
+                ->  true
+                ;   thread_send_message(Replies, done)
+                ),
+                Error,
+                thread_send_message(Replies, error(Error))
+            )
+        ;   thread_send_message(
+                Replies,
+                error(domain_error(pyswip_snapshot_request, Request))
+            )
+        )
+    """,
+    """
+    pyswip_snapshot_wait(Id, Replies) :-
+        thread_get_message(Request),
+        (   Request == next(Id)
+        ->  fail
+        ;   Request == stop(Id)
+        ->  thread_send_message(Replies, stopped)
+        ;   memberchk(Request, [commit, rollback])
+        ->  thread_self(Me),
+            thread_send_message(Me, Request)
+        ;   pyswip_snapshot_handle(Request, Replies),
+            pyswip_snapshot_wait(Id, Replies)
+        )
+    """,
+    """
+    pyswip_snapshot_post(Thread, Replies, Request, Reply) :-
+        thread_send_message(Thread, Request),
+        thread_get_message(Replies, Reply0),
+        (   Reply0 = error(Error)
+        ->  throw(Error)
+        ;   Reply = Reply0
+        )
+    """,
+    """
+    pyswip_snapshot_update(Thread, Replies, Action, Text) :-
+        term_string(Clause, Text),
+        pyswip_snapshot_post(Thread, Replies, update(Action, Clause), _)
+    """,
+    """
+    pyswip_snapshot_query(Thread, Replies, Id, Text, Reply) :-
+        term_string(Goal, Text, [variable_names(Bindings)]),
+        pyswip_snapshot_post(Thread, Replies, query(Id, Bindings, Goal), Reply)
+    """,
+    """
+    pyswip_snapshot_next(Thread, Replies, Id, Reply) :-
+        pyswip_snapshot_post(Thread, Replies, next(Id), Reply)
+    """,
+    """
+    pyswip_snapshot_stop(Thread, Replies, Id) :-
+        pyswip_snapshot_post(Thread, Replies, stop(Id), _)
+    """,
+    """
+    pyswip_snapshot_close(Thread, Replies, Mode, Result) :-
+        call_cleanup(
+            (   thread_send_message(Thread, Mode),
+                thread_get_message(Replies, Result0)
+            ),
+            (   thread_join(Thread, _),
+                message_queue_destroy(Replies)
+            )
+        ),
+        (   Result0 = error(Error)
+        ->  throw(Error)
+        ;   Result = Result0
+        )
+    """,
+    """
+    pyswip_table_stats(M, Name, Arity, Variant, Answers, Bytes) :-
+        current_table(M:Goal, Trie),
+        functor(Goal, Name, Arity),
+        copy_term(Goal, Copy),
+        numbervars(Copy, 0, _),
+        format(atom(Variant), "~W", [Copy, [numbervars(true), quoted(true)]]),
+        (   trie_property(Trie, value_count(Answers))
+        ->  true
+        ;   Answers = 0
+        ),
+        (   trie_property(Trie, size(Bytes))
+        ->  true
+        ;   Bytes = 0
+        )
+    """,
+    """
+    pyswip_index_report(M, Name, Arity, Clauses, Dynamic, Indexes, Keys) :-
+        functor(Head, Name, Arity),
+        (   predicate_property(M:Head, number_of_clauses(Clauses))
+        ->  true
+        ;   Clauses = 0
+        ),
+        (   predicate_property(M:Head, dynamic)
+        ->  Dynamic = true
+        ;   Dynamic = false
+        ),
+        (   predicate_property(M:Head, indexed(Indexed))
+        ->  findall(I, (member(X, Indexed), format(atom(I), "~q", [X])), Indexes)
+        ;   Indexes = []
+        ),
+        findall(
+            Count,
+            (   between(1, Arity, P),
+                aggregate_all(
+                    count,
+                    distinct(Key, (
+                        catch(clause(M:Head, _), _, fail),
+                        arg(P, Head, A),
+                        nonvar(A),
+                        (   atomic(A)
+                        ->  Key = A
+                        ;   functor(A, F, FA),
+                            Key = F/FA
+                        )
+                    )),
+                    Count
+                )
+            ),
+            Keys
+        )
+    """,
+    """
+    pyswip_warm_index(M, Pattern) :-
+        functor(Pattern, Name, Arity),
+        functor(Sample, Name, Arity),
+        once((
+            catch(clause(M:Sample, _), _, fail),
+            forall(arg(P, Pattern, +), (arg(P, Sample, A), nonvar(A)))
+        )),
+        findall(
+            GoalArg,
+            (   arg(P, Sample, SampleArg),
+                (   arg(P, Pattern, +)
+                ->  GoalArg = SampleArg
+                ;   true
+                )
+            ),
+            GoalArgs
+        ),
+        Goal =.. [Name|GoalArgs],
+        \\+ \\+ clause(M:Goal, _)
+    """,
+    """
+    pyswip_call_with_inference_limit(Goal, MaxInferences) :-
+        call_with_inference_limit(Goal, MaxInferences, Result),
+        (   Result == inference_limit_exceeded
+        ->  throw(inference_limit_exceeded)
+        ;   true
+        )
+    """,
+]
+
+
 def __initialize():
     args = []
     args.append("./")
@@ -97,94 +652,120 @@ def __initialize():
             "PL_initialise returned %d" % result
         )
 
+    _call_goal(f"dynamic(({','.join(_HELPER_DYNAMIC)}))")
+    for clause in _HELPER_CLAUSES:
+        _call_goal(f"asserta(({clause}))")
+
+
+def _call_goal(goal: str) -> bool:
+    """Calls the goal without opening a query, so it can be used while another query is open"""
     swipl_fid = PL_open_foreign_frame()
-    swipl_load = PL_new_term_ref()
-    PL_chars_to_term(
-        """
-        asserta(pyrun(GoalString,BindingList) :-
-            (read_term_from_atom(GoalString, Goal, [variable_names(BindingList)]),
-            call(Goal))).
-        """,
-        swipl_load,
-    )
-    PL_call(swipl_load, None)
+    swipl_goal = PL_new_term_ref()
+    PL_chars_to_term(goal, swipl_goal)
+    result = PL_call(swipl_goal, None)
     PL_discard_foreign_frame(swipl_fid)
+    return bool(result)
 
 
 __initialize()
 
 
 # NOTE: These imports MUST come after _initialize is called!!
-from pyswip.easy import getTerm, Atom, Variable  # noqa: E402
+from pyswip.easy import (  # noqa: E402
+    getTerm,
+    putTerm,
+    unifyTerm,
+    getAtom,
+    getFloat,
+    getInt64,
+    getBoolean,
+    getText,
+    Atom,
+    Functor,
+    TermRef,
+    Out,
+    InvalidTypeError,
+)
+from pyswip.encoder import atom_encoder, text_encoder  # noqa: E402
+from pyswip.tables import CHUNK_SIZE, table_source  # noqa: E402
 
 
 class Prolog:
     """Provides the entry point for the Prolog interface"""
 
-    # We keep track of open queries to avoid nested queries.
-    _queryIsOpen = False
     _cwraps = []
+    # Helper predicates compiled from goal templates, see _compile_goal
+    _compiled_goals = collections.OrderedDict()
+    _compiled_goal_ids = itertools.count()
+    # Maximum number of compiled helper predicates, the least recently used ones are abolished
+    compiled_goals_size = 256
+    # Predicate handles, see predicate
+    _predicates = {}
+    # Number of times the query limits were exceeded, see limit_counters
+    _limit_counters = {"timeout": 0, "max_inferences": 0, "cancelled": 0}
+    # The shadow modules of the predicates replaced by replace_predicate, oldest first
+    _replaced = {}
+    _replace_lock = threading.Lock()
 
     class _QueryWrapper(object):
-        def __init__(self):
-            if Prolog._queryIsOpen:
-                raise NestedQueryError("The last query was not closed")
-
         def __call__(self, query, maxresult, catcherrors, normalize):
-            Prolog._init_prolog_thread()
-            swipl_fid = PL_open_foreign_frame()
-
-            swipl_args = PL_new_term_refs(2)
-            swipl_goalCharList = swipl_args
-            swipl_bindingList = swipl_args + 1
-
-            PL_put_chars(
-                swipl_goalCharList, PL_STRING | REP_UTF8, -1, query.encode("utf-8")
+            def decode(swipl_args):
+                swipl_list = PL_copy_term_ref(swipl_args + 1)
+                return _decode_bindings(swipl_list, normalize)
+
+            return self.run(
+                _pyrun_predicate(),
+                functools.partial(_put_goal, query),
+                decode,
+                query,
+                maxresult,
+                catcherrors,
             )
 
-            swipl_predicate = PL_predicate("pyrun", 2, None)
-
-            plq = PL_Q_NODEBUG | PL_Q_CATCH_EXCEPTION if catcherrors else PL_Q_NORMAL
-            swipl_qid = PL_open_query(None, plq, swipl_predicate, swipl_args)
-
-            Prolog._queryIsOpen = True  # From now on, the query will be considered open
+        def run(
+            self, swipl_predicate, put_args, decode, description, maxresult, catcherrors
+        ):
+            Prolog._init_prolog_thread()
+            # A query opened while another one is open runs on a temporary engine,
+            # which is made current only while the query is running.
+            engine = _engines.acquire() if _query_state.open_queries else None
+            _query_state.open_queries += 1
             try:
-                while maxresult and PL_next_solution(swipl_qid):
-                    maxresult -= 1
-                    swipl_list = PL_copy_term_ref(swipl_bindingList)
-                    t = getTerm(swipl_list)
-                    if normalize:
-                        try:
-                            v = t.value
-                        except AttributeError:
-                            v = {}
-                            for r in [x.value for x in t]:
-                                r = normalize_values(r)
-                                v.update(r)
-                        yield v
-                    else:
-                        yield t
-
-                if PL_exception(swipl_qid):
-                    term = getTerm(PL_exception(swipl_qid))
-
-                    raise PrologError(
-                        "".join(
-                            [
-                                "Caused by: '",
-                                query,
-                                "'. ",
-                                "Returned: '",
-                                str(term),
-                                "'.",
-                            ]
-                        )
+                with _EngineContext(engine):
+                    swipl_fid = PL_open_foreign_frame()
+                    try:
+                        swipl_args = put_args()
+                    except BaseException:
+                        PL_discard_foreign_frame(swipl_fid)
+                        raise
+                    plq = (
+                        PL_Q_NODEBUG | PL_Q_CATCH_EXCEPTION
+                        if catcherrors
+                        else PL_Q_NORMAL
                     )
-
-            finally:  # This ensures that, whatever happens, we close the query
-                PL_cut_query(swipl_qid)
-                PL_discard_foreign_frame(swipl_fid)
-                Prolog._queryIsOpen = False
+                    swipl_qid = PL_open_query(None, plq, swipl_predicate, swipl_args)
+
+                try:
+                    while maxresult:
+                        with _EngineContext(engine):
+                            if not PL_next_solution(swipl_qid):
+                                break
+                            result = decode(swipl_args)
+                        maxresult -= 1
+                        yield result
+
+                    with _EngineContext(engine):
+                        if PL_exception(swipl_qid):
+                            raise _query_error(description, PL_exception(swipl_qid))
+
+                finally:  # This ensures that, whatever happens, we close the query
+                    with _EngineContext(engine):
+                        PL_cut_query(swipl_qid)
+                        PL_discard_foreign_frame(swipl_fid)
+            finally:
+                _query_state.open_queries -= 1
+                if engine is not None:
+                    _engines.release(engine)
 
     @classmethod
     def _init_prolog_thread(cls):
@@ -286,6 +867,179 @@ class Prolog:
         params = ",".join(terms)
         next(cls.query(f"dynamic(({params}))", catcherrors=catcherrors))
 
+    @classmethod
+    def table(
+        cls,
+        *indicators: str,
+        mode: Union[str, Sequence[str], None] = None,
+        catcherrors: bool = False,
+    ) -> None:
+        """Enables tabling for the predicate(s)
+
+        See `table/1 <https://www.swi-prolog.org/pldoc/doc_for?object=table/1>`_ in SWI-Prolog documentation.
+
+        :param indicators: One or more predicate indicators, e.g. ``"path/2"``
+        :param mode:
+            The tabling mode, or a sequence of modes, one of ``"variant"`` (the default),
+            ``"subsumptive"``, ``"incremental"`` and ``"shared"``.
+            The dynamic predicates an incrementally tabled predicate depends on
+            must be declared incremental as well, e.g. ``Prolog.dynamic("edge/2 as incremental")``.
+        :param catcherrors: Catches the exception raised during goal execution
+
+        :raises ValueError: if no indicators were given or the mode is not valid.
+
+        >>> Prolog.table("path/2", mode="subsumptive")
+        >>> Prolog.assertz("edge(a, b)")
+        >>> Prolog.assertz("path(X, Y) :- edge(X, Y)")
+        >>> Prolog.assertz("path(X, Y) :- path(X, Z), edge(Z, Y)")
+        >>> list(Prolog.query("path(a, Y)"))
+        [{'Y': 'b'}]
+        """
+        if not indicators:
+            raise ValueError("One or more predicate indicators must be given")
+        if isinstance(mode, str):
+            mode = [mode]
+        modes = list(mode or ())
+        for m in modes:
+            if m not in TABLE_MODES:
+                raise ValueError(
+                    f"Invalid tabling mode: {m!r}, expected one of {', '.join(TABLE_MODES)}"
+                )
+        spec = ",".join(indicators)
+        if modes:
+            spec = f"({spec}) as ({','.join(modes)})"
+        next(cls.query(f"table(({spec}))", catcherrors=catcherrors))
+
+    @classmethod
+    def abolish_tables(cls, pred: Optional[str] = None) -> None:
+        """Removes the answer tables, so the memory they use is reclaimed
+
+        :param pred:
+            Predicate indicator, e.g. ``"path/2"`` or ``"graph:path/2"``, to remove only the tables of that predicate.
+            By default, all tables are removed.
+
+        :raises ValueError: if the indicator is not valid.
+        """
+        if pred is None:
+            cls.exists("abolish_all_tables")
+            return
+        m = RE_QUALIFIED_INDICATOR.fullmatch(pred)
+        if not m:
+            raise ValueError(f"Invalid predicate indicator: {pred!r}")
+        module, name, arity = m.groups()
+        cls.exists(
+            f"functor(H, {name}, {arity}), abolish_table_subgoals({module or 'user'}:H)"
+        )
+
+    @classmethod
+    def table_stats(cls) -> List[dict]:
+        """Returns the statistics of the answer tables
+
+        Each table is described by a dictionary with the following keys:
+
+        * ``module``: Module of the tabled predicate
+        * ``predicate``: Predicate indicator, e.g. ``"path/2"``
+        * ``variant``: The call the table was created for, e.g. ``"path(a,A)"``
+        * ``answers``: Number of answers in the table
+        * ``bytes``: Memory used by the table, in bytes
+
+        The numbers are read using `trie_property/2 <https://www.swi-prolog.org/pldoc/doc_for?object=trie_property/2>`_.
+        """
+        stats = cls.predicate("pyswip_table_stats", 6)
+        return [
+            {
+                "module": module,
+                "predicate": f"{name}/{arity}",
+                "variant": variant,
+                "answers": answers,
+                "bytes": size,
+            }
+            for module, name, arity, variant, answers, size in stats(*[None] * 6)
+        ]
+
+    @classmethod
+    def index_report(cls, pred: str) -> dict:
+        """Returns the clause indexes of the predicate and how well its arguments discriminate the clauses
+
+        The returned dictionary has the following keys:
+
+        * ``predicate``: The qualified predicate indicator
+        * ``clauses``: Number of clauses
+        * ``dynamic``: Whether the predicate is dynamic
+        * ``indexes``: The indexes created so far, as reported by the ``indexed`` property of
+          `predicate_property/2 <https://www.swi-prolog.org/pldoc/doc_for?object=predicate_property/2>`_
+        * ``arguments``: A list with a dictionary for each argument, with the ``position`` of the argument,
+          the number of distinct ``keys`` in the clause heads and the ``selectivity``,
+          which is the number of keys divided by the number of clauses.
+          An argument with a selectivity close to 1 is a good candidate for an index.
+
+        :param pred: Predicate indicator, e.g. ``"rate/3"`` or ``"app:rate/3"``
+
+        :raises ValueError: if the indicator is not valid.
+
+        >>> Prolog.assertz("rate(usd, eur, 0.9)")
+        >>> Prolog.assertz("rate(usd, gbp, 0.8)")
+        >>> report = Prolog.index_report("rate/3")
+        >>> report["clauses"], [a["keys"] for a in report["arguments"]]
+        (2, [1, 2, 2])
+        """
+        m = RE_QUALIFIED_INDICATOR.fullmatch(pred)
+        if not m:
+            raise ValueError(f"Invalid predicate indicator: {pred!r}")
+        module, name, arity = m.groups()
+        module = module or "user"
+        arity = int(arity)
+        result = cls.predicate("pyswip_index_report", 7).once(
+            module, name, arity, None, None, None, None
+        )
+        _, _, _, clauses, dynamic, indexes, keys = result
+        return {
+            "predicate": f"{module}:{name}/{arity}",
+            "clauses": clauses,
+            "dynamic": dynamic == "true",
+            "indexes": indexes,
+            "arguments": [
+                {
+                    "position": position,
+                    "keys": count,
+                    "selectivity": count / clauses if clauses else 0.0,
+                }
+                for position, count in enumerate(keys)
+            ],
+        }
+
+    @classmethod
+    def warm_indexes(cls, patterns: Sequence[str]) -> int:
+        """Creates the clause indexes for the given call modes, so the first queries do not wait for them
+
+        SWI-Prolog creates the indexes just in time, when a predicate is called with the arguments bound.
+        For each pattern, the first clause with the ``+`` arguments bound is looked up using
+        `clause/2 <https://www.swi-prolog.org/pldoc/doc_for?object=clause/2>`_
+        with those arguments, which creates the index without running the clause body.
+
+        Returns the number of patterns for which the lookup was done.
+        A predicate without a clause which has the ``+`` arguments bound is skipped.
+
+        :param patterns:
+            Call modes, such as ``"rate(+, -, -)"`` or ``"app:session(-, +)"``.
+            Each argument is one of ``+`` (bound), ``-`` or ``?``.
+
+        :raises ValueError: if a pattern is not valid.
+
+        >>> Prolog.assertz("rate(usd, eur, 0.9)")
+        >>> Prolog.warm_indexes(["rate(+, -, -)", "rate(-, +, -)"])
+        2
+        """
+        goals = []
+        for pattern in patterns:
+            m = RE_CALL_MODE.fullmatch(pattern)
+            if not m:
+                raise ValueError(f"Invalid call mode: {pattern!r}")
+            module, name, modes = m.groups()
+            modes = ",".join(mode.strip() for mode in modes.split(","))
+            goals.append(f"pyswip_warm_index({module or 'user'}, {name}({modes}))")
+        return sum(cls.exists(goal) for goal in goals)
+
     @classmethod
     def retract(cls, format: str, *args, catcherrors: bool = False) -> None:
         """
@@ -404,6 +1158,10 @@ class Prolog:
         maxresult: int = -1,
         catcherrors: bool = True,
         normalize: bool = True,
+        timeout: Optional[float] = None,
+        max_inferences: Optional[int] = None,
+        cancel: Optional["CancelToken"] = None,
+        tables: Optional[Dict[str, Iterable]] = None,
     ) -> Generator:
         """Run a prolog query and return a generator
 
@@ -421,6 +1179,30 @@ class Prolog:
             Catches the exception raised during goal execution
         :param normalize:
             Return normalized values
+        :param timeout:
+            Maximum time in seconds the query may run.
+            If the limit is exceeded, :py:class:`QueryTimeout` is raised.
+            The limit applies to the whole query, including the time between the solutions,
+            and it is removed when the query is closed.
+            See `alarm/4 <https://www.swi-prolog.org/pldoc/doc_for?object=alarm/4>`_.
+        :param max_inferences:
+            Maximum number of inferences the query may use.
+            If the limit is exceeded, :py:class:`InferenceLimitExceeded` is raised.
+            See `call_with_inference_limit/3 <https://www.swi-prolog.org/pldoc/doc_for?object=call_with_inference_limit/3>`_.
+        :param cancel:
+            A token to cancel the query from another thread.
+            If the query is cancelled, :py:class:`QueryCancelled` is raised.
+        :param tables:
+            Parameter tables visible only to this query, as a dictionary of predicate names to rows.
+            Each row is a list or tuple of the arguments, or a single value for tables with one argument.
+            The rows are asserted as the clauses of a dynamic predicate in a private module,
+            so they are indexed like the other dynamic predicates.
+            The predicates of the query are looked up in that module first, but the context module
+            of the query stays ``user``.
+            The tables are removed when the query is closed.
+
+        If a limit or a cancel token is given, the exceptions raised during goal execution are always caught.
+        The number of times the limits were exceeded is returned by :py:meth:`Prolog.limit_counters`.
 
         .. Note::
             Currently, If no arguments given, the format string is used as the raw query, even if it contains a placeholder.
@@ -435,114 +1217,2220 @@ class Prolog:
         False
         >>> print(sorted(Prolog.query("father(michael,X)")))
         [{'X': 'gina'}, {'X': 'john'}]
+        >>> list(Prolog.query("repeat, fail", timeout=0.1))
+        Traceback (most recent call last):
+        ...
+        pyswip.prolog.QueryTimeout: Caused by: ...
+        >>> sorted(Prolog.query("father(michael,X), allowed(X)", tables={"allowed": ["john"]}))
+        [{'X': 'john'}]
         """
-        if args:
-            query = format_prolog(format, args)
-        else:
-            query = format
-        return cls._QueryWrapper()(query, maxresult, catcherrors, normalize)
+        if not tables:
+            query, guarded = prepare_query(
+                format, args, timeout, max_inferences, cancel
+            )
+            return cls._QueryWrapper()(
+                query, maxresult, catcherrors or guarded, normalize
+            )
+
+        def run(module):
+            query, guarded = prepare_query(
+                format, args, timeout, max_inferences, cancel, module=module
+            )
+            return cls._QueryWrapper()(
+                query, maxresult, catcherrors or guarded, normalize
+            )
+
+        return _TableScope(tables).run(run)
 
     @classmethod
-    @functools.cache
-    def _callback_wrapper(cls, arity, nondeterministic):
-        ps = [foreign_t] + [term_t] * arity
-        if nondeterministic:
-            return CFUNCTYPE(*(ps + [control_t]))
-        return CFUNCTYPE(*ps)
+    def snapshot(cls) -> "Snapshot":
+        """Returns a context manager to run queries against hypothetical updates
+
+        The updates made using the returned :py:class:`Snapshot` are visible only to the queries
+        run using the same snapshot, and they are discarded at the end of the block.
+
+        >>> Prolog.assertz("stock(apple, 3)")
+        >>> with Prolog.snapshot() as s:
+        ...     s.retract("stock(apple, _)")
+        ...     s.assertz("stock(apple, 0)")
+        ...     list(s.query("stock(apple, N)"))
+        [{'N': 0}]
+        >>> list(Prolog.query("stock(apple, N)"))
+        [{'N': 3}]
+        """
+        return Snapshot()
 
     @classmethod
-    @functools.cache
-    def _foreign_wrapper(cls, fun, nondeterministic=False):
-        def wrapper(*args):
-            if nondeterministic:
-                args = [getTerm(arg) for arg in args[:-1]] + [args[-1]]
-            else:
-                args = [getTerm(arg) for arg in args]
-            r = fun(*args)
-            return True if r is None else r
+    def transaction(cls) -> "Snapshot":
+        """Returns a context manager to apply the updates as a unit
+
+        The updates made using the returned :py:class:`Snapshot` are visible only to the queries
+        run using the same snapshot until the end of the block.
+        Then they are committed using
+        `transaction/1 <https://www.swi-prolog.org/pldoc/doc_for?object=transaction/1>`_.
+        If the block raises an exception, the updates are discarded.
+
+        >>> with Prolog.transaction() as t:
+        ...     t.assertz("stock(pear, 5)")
+        ...     t.assertz("stock(plum, 2)")
+        >>> sorted(Prolog.query("stock(pear, N)"))
+        [{'N': 5}]
+        """
+        return Snapshot(commit=True)
 
-        return wrapper
+    @classmethod
+    def limit_counters(cls, *, reset: bool = False) -> dict:
+        """Returns the number of times the query limits were exceeded
+
+        The returned dictionary has the following keys:
+
+        * ``timeout``: Number of :py:class:`QueryTimeout` errors
+        * ``max_inferences``: Number of :py:class:`InferenceLimitExceeded` errors
+        * ``cancelled``: Number of :py:class:`QueryCancelled` errors
+
+        :param reset: Reset the counters to zero after returning them
+        """
+        counters = dict(cls._limit_counters)
+        if reset:
+            for key in cls._limit_counters:
+                cls._limit_counters[key] = 0
+        return counters
 
     @classmethod
-    def register_foreign(
+    def once(
         cls,
-        func: Callable,
-        /,
-        name: str = "",
-        arity: Optional[int] = None,
-        *,
-        module: str = "",
-        nondeterministic: bool = False,
-    ):
-        """
-        Registers a Python callable as a Prolog predicate
+        format: str,
+        *args,
+        catcherrors: bool = True,
+        normalize: bool = True,
+        timeout: Optional[float] = None,
+        max_inferences: Optional[int] = None,
+        cancel: Optional["CancelToken"] = None,
+        tables: Optional[Dict[str, Iterable]] = None,
+    ) -> Optional[dict]:
+        """Run a prolog query and return its first solution
 
-        :param func:
-            Callable to be registered. The callable should return a value in ``foreign_t``, ``True`` or ``False`` or ``None``.
-            Returning ``None`` is equivalent to returning ``True``.
-        :param name:
-            Name of the callable. If the name is not specified, it is derived from ``func.__name__``.
-        :param arity:
-            Number of parameters of the callable. If not specified, it is derived from the callable signature.
-        :param module:
-            Name of the module to register the predicate. By default, the current module.
-        :param nondeterministic:
-            Set the foreign callable as nondeterministic
+        Unlike ``next(Prolog.query(...))``, the query is run to its first solution and closed
+        without creating a generator.
+
+        :param format:
+            The format to be used to generate the query.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``format`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+        :param normalize:
+            Return normalized values
+        :param timeout:
+            Maximum time in seconds the query may run, see :py:meth:`Prolog.query`
+        :param max_inferences:
+            Maximum number of inferences the query may use, see :py:meth:`Prolog.query`
+        :param cancel:
+            A token to cancel the query from another thread, see :py:meth:`Prolog.query`
+        :param tables:
+            Parameter tables visible only to this query, see :py:meth:`Prolog.query`
+
+        :returns: A dict with variables as keys, or ``None`` if the query has no solutions.
+
+        >>> Prolog.assertz("father(michael,john)")
+        >>> Prolog.once("father(michael,X)")
+        {'X': 'john'}
+        >>> Prolog.once("father(michael,olivia)") is None
+        True
         """
-        if not callable(func):
-            raise ValueError("func is not callable")
-        module = module or None
-        flags = PL_FA_NONDETERMINISTIC if nondeterministic else 0
-        if arity is None:
-            arity = len(inspect.signature(func).parameters)
-            if nondeterministic:
-                arity -= 1
-        if not name:
-            name = func.__name__
 
-        cwrap = cls._callback_wrapper(arity, nondeterministic)
-        # TODO: check func
-        fwrap = cls._foreign_wrapper(func, nondeterministic)
-        fwrap = cwrap(fwrap)
-        cls._cwraps.append(fwrap)
-        return PL_register_foreign_in_module(module, name, arity, fwrap, flags)
+        def decode(swipl_args):
+            return _decode_bindings(swipl_args + 1, normalize)
 
+        with _TableScope(tables) if tables else _NO_TABLES as module:
+            format, guarded = prepare_query(
+                format, args, timeout, max_inferences, cancel, module=module
+            )
+            catcherrors = catcherrors or guarded
+            return cls._call_once(
+                _pyrun_predicate(),
+                functools.partial(_put_goal, format),
+                decode,
+                format,
+                catcherrors,
+            )
 
-def normalize_values(values):
-    from pyswip.easy import Atom, Functor
+    @classmethod
+    def exists(
+        cls,
+        format: str,
+        *args,
+        catcherrors: bool = True,
+        timeout: Optional[float] = None,
+        max_inferences: Optional[int] = None,
+        cancel: Optional["CancelToken"] = None,
+        tables: Optional[Dict[str, Iterable]] = None,
+    ) -> bool:
+        """Returns whether the prolog query has a solution
 
-    if isinstance(values, Atom):
-        return values.value
-    if isinstance(values, Functor):
-        normalized = str(values.name.value)
-        if values.arity:
-            normalized_args = [str(normalize_values(arg)) for arg in values.args]
-            normalized = normalized + "(" + ", ".join(normalized_args) + ")"
-        return normalized
-    elif isinstance(values, dict):
-        return {key: normalize_values(v) for key, v in values.items()}
-    elif isinstance(values, (list, tuple)):
-        return [normalize_values(v) for v in values]
-    return values
+        The bindings of the solution are not converted to Python values.
 
+        :param format:
+            The format to be used to generate the query.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``format`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+        :param timeout:
+            Maximum time in seconds the query may run, see :py:meth:`Prolog.query`
+        :param max_inferences:
+            Maximum number of inferences the query may use, see :py:meth:`Prolog.query`
+        :param cancel:
+            A token to cancel the query from another thread, see :py:meth:`Prolog.query`
+        :param tables:
+            Parameter tables visible only to this query, see :py:meth:`Prolog.query`
 
-def make_prolog_str(value) -> str:
-    if isinstance(value, str):
-        return f'"{value}"'
-    elif isinstance(value, list):
-        inner = ",".join(make_prolog_str(v) for v in value)
-        return f"[{inner}]"
-    elif isinstance(value, Atom):
-        # TODO: escape atom nome
-        return f"'{value.chars}'"
-    elif isinstance(value, Variable):
-        # TODO: escape variable name
-        return value.chars
-    elif value is True:
-        return "1"
-    elif value is False:
-        return "0"
-    return str(value)
+        >>> Prolog.assertz("father(michael,john)")
+        >>> Prolog.exists("father(michael,john)")
+        True
+        >>> Prolog.exists("father(michael,%p)", Atom("olivia"))
+        False
+        """
+        with _TableScope(tables) if tables else _NO_TABLES as module:
+            format, guarded = prepare_query(
+                format, args, timeout, max_inferences, cancel, module=module
+            )
+            catcherrors = catcherrors or guarded
+            r = cls._call_once(
+                _pyrun_predicate(),
+                functools.partial(_put_goal, format),
+                None,
+                format,
+                catcherrors,
+            )
+        return r is not None
+
+    @classmethod
+    def _call_once(cls, swipl_predicate, put_args, decode, description, catcherrors):
+        """Runs the predicate to its first solution
+
+        Returns the decoded arguments, ``True`` if ``decode`` is ``None``, or ``None`` if there are no solutions.
+        """
+        cls._init_prolog_thread()
+        engine = _engines.acquire() if _query_state.open_queries else None
+        _query_state.open_queries += 1
+        try:
+            with _EngineContext(engine):
+                swipl_fid = PL_open_foreign_frame()
+                try:
+                    swipl_args = put_args()
+                except BaseException:
+                    PL_discard_foreign_frame(swipl_fid)
+                    raise
+                plq = (
+                    PL_Q_NODEBUG | PL_Q_CATCH_EXCEPTION if catcherrors else PL_Q_NORMAL
+                )
+                swipl_qid = PL_open_query(
+                    None, plq | PL_Q_EXT_STATUS, swipl_predicate, swipl_args
+                )
+                try:
+                    status = PL_next_solution(swipl_qid)
+                    if status == PL_S_EXCEPTION or status == PL_S_FALSE:
+                        if PL_exception(swipl_qid):
+                            raise _query_error(description, PL_exception(swipl_qid))
+                        return None
+                    return True if decode is None else decode(swipl_args)
+                finally:
+                    PL_cut_query(swipl_qid)
+                    PL_discard_foreign_frame(swipl_fid)
+        finally:
+            _query_state.open_queries -= 1
+            if engine is not None:
+                _engines.release(engine)
+
+    @classmethod
+    def predicate(cls, name: str, arity: int, *, module: str = "") -> "Predicate":
+        """Returns a handle to the predicate with the given name and arity
+
+        The handle resolves the predicate once and calls it directly with Python arguments,
+        without parsing a goal string.
+        Handles are cached, so calling this method again with the same arguments returns the same handle.
+
+        :param name: Name of the predicate
+        :param arity: Number of arguments of the predicate
+        :param module: Name of the module of the predicate. By default, the ``user`` module.
+
+        >>> Prolog.assertz("graph:edge(a, b)")
+        >>> Prolog.assertz("graph:edge(a, c)")
+        >>> edge = Prolog.predicate("edge", 2, module="graph")
+        >>> list(edge("a", None))
+        [('a', 'b'), ('a', 'c')]
+        >>> edge.exists("a", "c")
+        True
+        """
+        key = (name, arity, module)
+        pred = cls._predicates.get(key)
+        if pred is None:
+            pred = Predicate(name, arity, module=module)
+            cls._predicates[key] = pred
+        return pred
+
+    @classmethod
+    def select(
+        cls,
+        template: str,
+        *args,
+        where: str,
+        order_by: Union[str, Sequence[str], None] = None,
+        distinct: bool = False,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        catcherrors: bool = True,
+        normalize: bool = True,
+    ) -> Generator:
+        """Run a query with ordering, deduplication and pagination done in Prolog
+
+        The solution modifiers are compiled to the predicates in
+        `library(solution_sequences) <https://www.swi-prolog.org/pldoc/man?section=solutionsequences>`_,
+        so only the final rows are converted and returned to Python.
+
+        :param template:
+            The variables to return, e.g. ``"X"`` or ``"X-Y"``.
+            Only the variables in the template are included in the results.
+            ``distinct`` removes duplicates with respect to the template.
+        :param args:
+            Arguments to replace the placeholders in the ``where`` string
+        :param where:
+            The goal to run.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param order_by:
+            A variable name or a sequence of variable names to sort the solutions by.
+            The sort order is ascending, prefix a name with ``-`` to sort in descending order.
+            See `order_by/2 <https://www.swi-prolog.org/pldoc/doc_for?object=order_by/2>`_.
+        :param distinct:
+            Skip solutions which were seen before.
+            See `distinct/2 <https://www.swi-prolog.org/pldoc/doc_for?object=distinct/2>`_.
+        :param limit:
+            Maximum number of solutions to return.
+            See `limit/2 <https://www.swi-prolog.org/pldoc/doc_for?object=limit/2>`_.
+        :param offset:
+            Number of solutions to skip.
+            See `offset/2 <https://www.swi-prolog.org/pldoc/doc_for?object=offset/2>`_.
+        :param catcherrors:
+            Catches the exception raised during goal execution
+        :param normalize:
+            Return normalized values
+
+        :raises ValueError: if ``limit`` or ``offset`` is negative.
+
+        >>> Prolog.assertz("person(jane, 32)")
+        >>> Prolog.assertz("person(joe, 45)")
+        >>> Prolog.assertz("person(jill, 27)")
+        >>> list(Prolog.select("X", where="person(X, Age)", order_by="-Age", limit=2))
+        [{'X': 'joe'}, {'X': 'jane'}]
+        """
+        if args:
+            where = format_prolog(where, args)
+        query = compile_select(
+            template,
+            where,
+            order_by=order_by,
+            distinct=distinct,
+            limit=limit,
+            offset=offset,
+        )
+        names = template_variables(template)
+        results = cls.query(query, catcherrors=catcherrors, normalize=normalize)
+        if not normalize:
+            # The raw solutions are lists of Name=Value terms
+            return (
+                [b for b in r if str(b.args[0].value) in names]
+                if isinstance(r, list)
+                else r
+                for r in results
+            )
+        return ({k: r[k] for k in names if k in r} for r in results)
+
+    @classmethod
+    def _compile_goal(cls, body: str, nargs: int, nresults: int) -> str:
+        """Asserts a helper predicate for the given goal template and returns its name
+
+        The placeholders (``%p``) in the ``body`` become the first ``nargs`` arguments of the helper,
+        followed by ``nresults`` result arguments named ``PySwipResult0_``, ``PySwipResult1_``, etc.
+        The helper is asserted once per template, so calling it again does not re-parse the goal.
+        The helpers are asserted in the ``pyswip_goals`` module and their bodies are run in the ``user`` module.
+        At most :py:attr:`compiled_goals_size` helpers are kept, the least recently used one is abolished
+        when a new one is asserted.
+        Returns the module qualified name of the helper.
+        """
+        key = (body, nargs, nresults)
+        name = cls._compiled_goals.get(key)
+        if name is not None:
+            cls._compiled_goals.move_to_end(key)
+            return name
+        params = [f"PySwipArg{i}_" for i in range(nargs)]
+        if nargs:
+            frags = RE_PLACEHOLDER.split(body)
+            if len(frags) - 1 != nargs:
+                raise ValueError(
+                    "Number of arguments must match the number of placeholders"
+                )
+            body = "".join(f + p for f, p in zip(frags, params)) + frags[-1]
+        params.extend(f"PySwipResult{i}_" for i in range(nresults))
+        name = f"pyswip_goals:pyswip_goal_{next(cls._compiled_goal_ids)}"
+        cls.assertz(f"{name}({', '.join(params)}) :- user:({body})")
+        cls._compiled_goals[key] = name
+        while len(cls._compiled_goals) > cls.compiled_goals_size:
+            (_, evicted_nargs, evicted_nresults), evicted = cls._compiled_goals.popitem(
+                last=False
+            )
+            _call_goal(f"abolish({evicted}/{evicted_nargs + evicted_nresults})")
+        return name
+
+    @classmethod
+    def _aggregate(cls, spec: str, goal: str, args: Tuple, catcherrors: bool):
+        body = f"aggregate_all({spec}, ({goal}), PySwipResult0_)"
+        name = cls._compile_goal(body, len(args), 1)
+        params = ", ".join(["%p"] * len(args) + ["Result"])
+        r = cls.once(f"{name}({params})", *args, catcherrors=catcherrors)
+        return None if r is None else r["Result"]
+
+    @classmethod
+    def count(cls, goal: str, *args, catcherrors: bool = True) -> int:
+        """Returns the number of solutions of the goal
+
+        The solutions are counted in Prolog using `aggregate_all/3 <https://www.swi-prolog.org/pldoc/doc_for?object=aggregate_all/3>`_,
+        no bindings are transferred to Python.
+
+        :param goal:
+            The goal to count the solutions of.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+
+        >>> Prolog.assertz("person(jane, 32)")
+        >>> Prolog.assertz("person(joe, 45)")
+        >>> Prolog.count("person(_, _)")
+        2
+        >>> Prolog.count("person(_, Age), Age > %p", 40)
+        1
+        """
+        return cls._aggregate("count", goal, args, catcherrors)
+
+    @classmethod
+    def sum(cls, expr: str, goal: str, *args, catcherrors: bool = True):
+        """Returns the sum of ``expr`` for all solutions of the goal
+
+        Returns ``0`` if the goal has no solutions.
+
+        :param expr: The arithmetic expression to sum
+        :param goal:
+            The goal to aggregate.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+
+        >>> Prolog.sum("Age", "person(_, Age)")
+        77
+        """
+        return cls._aggregate(f"sum({expr})", goal, args, catcherrors)
+
+    @classmethod
+    def max(cls, expr: str, goal: str, *args, catcherrors: bool = True):
+        """Returns the maximum of ``expr`` for all solutions of the goal
+
+        Returns ``None`` if the goal has no solutions.
+
+        :param expr: The expression to maximize
+        :param goal:
+            The goal to aggregate.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+
+        >>> Prolog.max("Age", "person(_, Age)")
+        45
+        """
+        return cls._aggregate(f"max({expr})", goal, args, catcherrors)
+
+    @classmethod
+    def min(cls, expr: str, goal: str, *args, catcherrors: bool = True):
+        """Returns the minimum of ``expr`` for all solutions of the goal
+
+        Returns ``None`` if the goal has no solutions.
+
+        :param expr: The expression to minimize
+        :param goal:
+            The goal to aggregate.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+
+        >>> Prolog.min("Age", "person(_, Age)")
+        32
+        """
+        return cls._aggregate(f"min({expr})", goal, args, catcherrors)
+
+    @classmethod
+    def bag(cls, template: str, goal: str, *args, catcherrors: bool = True) -> list:
+        """Returns the list of ``template`` for all solutions of the goal, including duplicates
+
+        :param template: The term to collect
+        :param goal:
+            The goal to aggregate.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+
+        >>> Prolog.bag("Name", "person(Name, _)")
+        ['jane', 'joe']
+        """
+        return cls._aggregate(f"bag({template})", goal, args, catcherrors)
+
+    @classmethod
+    def set(cls, template: str, goal: str, *args, catcherrors: bool = True) -> list:
+        """Returns the sorted list of ``template`` for all solutions of the goal, without duplicates
+
+        :param template: The term to collect
+        :param goal:
+            The goal to aggregate.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+
+        >>> Prolog.set("Name", "person(Name, _)")
+        ['jane', 'joe']
+        """
+        return cls._aggregate(f"set({template})", goal, args, catcherrors)
+
+    @classmethod
+    def group_by(
+        cls, key: str, aggregate: str, goal: str, *args, catcherrors: bool = True
+    ) -> dict:
+        """Groups the solutions of the goal by ``key`` and aggregates each group
+
+        Grouping and aggregation are done in Prolog, only one row per group is transferred to Python.
+        List keys are returned as tuples.
+
+        :param key: The term to group by
+        :param aggregate:
+            One of ``count``, ``sum(Expr)``, ``max(Expr)``, ``min(Expr)``, ``bag(Template)`` or ``set(Template)``
+        :param goal:
+            The goal to aggregate.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param catcherrors:
+            Catches the exception raised during goal execution
+
+        :raises ValueError: if the aggregate is not supported.
+
+        >>> Prolog.assertz("sale(apple, 3)")
+        >>> Prolog.assertz("sale(pear, 2)")
+        >>> Prolog.assertz("sale(apple, 5)")
+        >>> Prolog.group_by("Item", "sum(Amount)", "sale(Item, Amount)")
+        {'apple': 8, 'pear': 2}
+        """
+        functor, witness = parse_aggregate(aggregate)
+        if functor == "count":
+            spec, witness = "count", "1"
+        else:
+            spec = f"{functor}(PySwipW_)"
+        body = (
+            f"findall(({key})-({witness}), ({goal}), PySwipPairs0_), "
+            "keysort(PySwipPairs0_, PySwipPairs_), "
+            "group_pairs_by_key(PySwipPairs_, PySwipGroups_), "
+            "findall(PySwipKey_-PySwipValue_, "
+            "(member(PySwipKey_-PySwipWs_, PySwipGroups_), "
+            f"aggregate_all({spec}, member(PySwipW_, PySwipWs_), PySwipValue_)), "
+            "PySwipResultPairs_), "
+            "pairs_keys_values(PySwipResultPairs_, PySwipResult0_, PySwipResult1_)"
+        )
+        name = cls._compile_goal(body, len(args), 2)
+        params = ", ".join(["%p"] * len(args) + ["Keys", "Values"])
+        r = cls.once(f"{name}({params})", *args, catcherrors=catcherrors)
+        keys = [tuple(k) if isinstance(k, list) else k for k in r["Keys"]]
+        return dict(zip(keys, r["Values"]))
+
+    @classmethod
+    @functools.cache
+    def _callback_wrapper(cls, arity, nondeterministic):
+        ps = [foreign_t] + [term_t] * arity
+        if nondeterministic:
+            return CFUNCTYPE(*(ps + [control_t]))
+        return CFUNCTYPE(*ps)
+
+    @classmethod
+    @functools.cache
+    def _foreign_wrapper(cls, fun, nondeterministic=False, raw=False):
+        convert = TermRef if raw else getTerm
+
+        def wrapper(*args):
+            if nondeterministic:
+                args = [convert(arg) for arg in args[:-1]] + [args[-1]]
+            else:
+                args = [convert(arg) for arg in args]
+            r = fun(*args)
+            return True if r is None else r
+
+        return wrapper
+
+    @classmethod
+    @functools.cache
+    def _typed_foreign_wrapper(cls, fun, nondeterministic=False):
+        specs = _typed_signature(fun, nondeterministic)
+
+        def wrapper(*args):
+            params = []
+            outs = []
+            for (getter, expected, unify), arg in zip(specs, args):
+                if unify is not None:
+                    out = Out()
+                    outs.append((unify, arg, out))
+                    params.append(out)
+                    continue
+                try:
+                    params.append(getter(arg))
+                except InvalidTypeError:
+                    return _raise_type_error(expected, arg)
+            if nondeterministic:
+                params.append(args[-1])
+            r = fun(*params)
+            if r is not None and not r:
+                return r
+            for unify, arg, out in outs:
+                if out.value is not None and not unify(arg, out.value):
+                    return False
+            return True if r is None else r
+
+        return wrapper
+
+    @classmethod
+    @functools.cache
+    def _generator_wrapper(cls, fun, raw=False, unify=unifyTerm):
+        convert = TermRef if raw else getTerm
+        contexts = _generator_contexts
+
+        def wrapper(*args):
+            terms, context = args[:-1], args[-1]
+            control = PL_foreign_control(context)
+            if control == PL_PRUNED:
+                gen, _ = contexts.release(PL_foreign_context(context))
+                gen.close()
+                return True
+            if control == PL_FIRST_CALL:
+                handle = None
+                gen = fun(*[convert(term) for term in terms])
+                row = next(gen, _END)
+            else:
+                handle = PL_foreign_context(context)
+                gen, row = contexts.get(handle)
+            try:
+                while row is not _END:
+                    found = _unify_row(terms, row, unify)
+                    row = next(gen, _END)
+                    if found:
+                        break
+                else:
+                    found = False
+            except BaseException:
+                if handle is not None:
+                    contexts.release(handle)
+                gen.close()
+                raise
+            if row is _END:
+                # the last answer is deterministic, no choice point is left
+                if handle is not None:
+                    contexts.release(handle)
+                return found
+            if handle is None:
+                handle = contexts.add([gen, row])
+            else:
+                contexts.get(handle)[1] = row
+            return PL_retry(handle)
+
+        return wrapper
+
+    @classmethod
+    @functools.cache
+    def _batched_wrapper(cls, fun):
+        def wrapper(*args):
+            columns = []
+            for arg in args[:-1]:
+                column = getTerm(arg)
+                if not isinstance(column, list):
+                    return _raise_type_error("list", arg)
+                columns.append(normalize_values(column))
+            result = fun(*columns)
+            if result is None:
+                return True
+            tolist = getattr(result, "tolist", None)
+            if tolist is not None:
+                result = tolist()
+            elif not isinstance(result, list):
+                result = list(result)
+            return unifyTerm(args[-1], result)
+
+        return wrapper
+
+    @classmethod
+    def register_foreign(
+        cls,
+        func: Callable,
+        /,
+        name: str = "",
+        arity: Optional[int] = None,
+        *,
+        module: str = "",
+        nondeterministic: bool = False,
+        raw: bool = False,
+        typed: bool = False,
+        batched: bool = False,
+    ):
+        """
+        Registers a Python callable as a Prolog predicate
+
+        :param func:
+            Callable to be registered. The callable should return a value in ``foreign_t``, ``True`` or ``False`` or ``None``.
+            Returning ``None`` is equivalent to returning ``True``.
+        :param name:
+            Name of the callable. If the name is not specified, it is derived from ``func.__name__``.
+        :param arity:
+            Number of parameters of the callable. If not specified, it is derived from the callable signature.
+        :param module:
+            Name of the module to register the predicate. By default, the current module.
+        :param nondeterministic:
+            Set the foreign callable as nondeterministic
+        :param raw:
+            Pass the arguments as :py:class:`TermRef` handles instead of converting them to Python values.
+            The arguments can then be inspected with the typed accessors or unified with ``TermRef.unify``,
+            which avoids the conversion cost for arguments the callable does not need.
+        :param typed:
+            Convert the arguments using the type annotations of the callable.
+            Parameters annotated with ``int``, ``float``, ``str``, ``bool``, :py:class:`Atom` or :py:class:`TermRef`
+            are converted with a fixed getter, and the predicate raises a Prolog ``type_error`` if the argument
+            has a different type. Parameters annotated with ``Out[T]`` receive an :py:class:`Out` object whose value
+            is unified with the argument after the call. Other parameters are converted with ``getTerm``.
+        :param batched:
+            Register a predicate which works on lists, so a whole batch is converted and processed in one call.
+            The predicate has an extra last argument, hence its arity is the number of parameters plus one.
+            The callable is called with a Python list for each parameter and returns a sequence of results,
+            which is unified with the last argument as a list.
+            The values in the lists are normalized, so atoms are passed as ``str``. Objects with a ``tolist`` method,
+            such as NumPy arrays, are converted with it.
+
+        If ``func`` is a generator function, it is registered as a nondeterministic predicate.
+        The generator is called with the arguments and each value it yields is an answer:
+        a tuple of values which is unified with the arguments, or a single value if the predicate has one argument.
+        The generator is closed when the query cuts the predicate.
+
+        >>> def digits(n, d):
+        ...     for i in range(n):
+        ...         yield n, i
+        >>> Prolog.register_foreign(digits)
+        >>> [solution["D"] for solution in Prolog.query("digits(3, D)")]
+        [0, 1, 2]
+
+        >>> def score(xs, names):
+        ...     return [x / len(name) for x, name in zip(xs, names)]
+        >>> Prolog.register_foreign(score, batched=True)
+        >>> Prolog.once("score([10, 20], [ab, abcd], Scores)")
+        {'Scores': [5.0, 5.0]}
+        """
+        if not callable(func):
+            raise ValueError("func is not callable")
+        if raw and typed:
+            raise ValueError("raw and typed cannot be used together")
+        generator = inspect.isgeneratorfunction(func)
+        if generator and typed:
+            raise ValueError("typed is not supported for generator functions")
+        if batched and (raw or typed or generator or nondeterministic):
+            raise ValueError(
+                "batched cannot be used with raw, typed, nondeterministic or generator functions"
+            )
+        module = module or None
+        if arity is None:
+            arity = len(inspect.signature(func).parameters)
+            if nondeterministic and not generator:
+                arity -= 1
+            elif batched:
+                arity += 1
+        nondeterministic = nondeterministic or generator
+        flags = PL_FA_NONDETERMINISTIC if nondeterministic else 0
+        if not name:
+            name = func.__name__
+
+        cwrap = cls._callback_wrapper(arity, nondeterministic)
+        # TODO: check func
+        if generator:
+            fwrap = cls._generator_wrapper(func, raw)
+        elif batched:
+            fwrap = cls._batched_wrapper(func)
+        elif typed:
+            fwrap = cls._typed_foreign_wrapper(func, nondeterministic)
+        else:
+            fwrap = cls._foreign_wrapper(func, nondeterministic, raw)
+        fwrap = cwrap(fwrap)
+        cls._cwraps.append(fwrap)
+        return PL_register_foreign_in_module(module, name, arity, fwrap, flags)
+
+    @classmethod
+    def register_table(
+        cls,
+        name: str,
+        arity: int,
+        source,
+        *,
+        index: Sequence[int] = (0,),
+        module: str = "",
+    ):
+        """
+        Registers a nondeterministic predicate which answers from a Python data source
+
+        The data is not copied to the Prolog database. If an argument at an indexed position is bound,
+        the matching rows are looked up in the source, otherwise the rows are enumerated lazily.
+        Strings in the rows are unified as atoms.
+        Bound atom and string arguments are both looked up by their text,
+        so ``price("pear", P)`` answers like ``price(pear, P)``.
+
+        >>> Prolog.register_table("price", 2, {"apple": 1.5, "pear": 2.0})
+        >>> Prolog.once("price(pear, P)")
+        {'P': 2.0}
+
+        :param name:
+            Name of the predicate
+        :param arity:
+            Number of arguments of the predicate
+        :param source:
+            A mapping from the first column to the rest of the row, a sequence of ``arity`` columns,
+            such as lists or NumPy arrays, or a :py:class:`pyswip.tables.TableSource`.
+        :param index:
+            Positions of the arguments to look up, in order of preference
+        :param module:
+            Name of the module to register the predicate. By default, the current module.
+        """
+        source = table_source(source, arity)
+        index = tuple(index)
+        if any(not 0 <= position < arity for position in index):
+            raise ValueError(f"Index positions must be between 0 and {arity - 1}")
+
+        def table(*terms):
+            rows = None
+            for position in index:
+                term = terms[position]
+                if term.is_variable():
+                    continue
+                try:
+                    # atoms and strings are both looked up by their text
+                    key = term.get_str()
+                except InvalidTypeError:
+                    key = normalize_values(term.value)
+                    try:
+                        hash(key)
+                    except TypeError:
+                        continue
+                    rows = source.lookup(position, key)
+                else:
+                    # the bound argument is kept, since a string doesn't unify with an atom
+                    rows = (
+                        row[:position] + (term,) + row[position + 1 :]
+                        for row in source.lookup(position, key)
+                    )
+                break
+            if rows is None:
+                rows = source.rows()
+            if arity == 1:
+                rows = (row[0] for row in rows)
+            yield from rows
+
+        fwrap = cls._generator_wrapper(table, True, atom_encoder.unify)
+        fwrap = cls._callback_wrapper(arity, True)(fwrap)
+        cls._cwraps.append(fwrap)
+        return PL_register_foreign_in_module(
+            module or None, name, arity, fwrap, PL_FA_NONDETERMINISTIC
+        )
+
+    @classmethod
+    def keyed_table(
+        cls, name: str, arity: int = 2, key: int = 0, *, module: str = ""
+    ) -> "KeyedTable":
+        """Returns a dynamic predicate used as a key-value store, see :py:class:`KeyedTable`
+
+        :param name: Name of the predicate
+        :param arity: Number of arguments of the predicate
+        :param key: Position of the key argument
+        :param module: Name of the module of the predicate. By default, the ``user`` module.
+
+        :raises ValueError: if the name is not valid or ``key`` is not a position of an argument.
+
+        >>> sessions = Prolog.keyed_table("session", arity=2, key=0)
+        >>> sessions.upsert("s1", "active")
+        >>> sessions.upsert("s1", "closed")
+        >>> sessions.get("s1")
+        ('s1', 'closed')
+        """
+        return KeyedTable(name, arity, key, module=module)
+
+    @classmethod
+    def changes(
+        cls, *predicates: str, maxlen: Optional[int] = None, normalize: bool = True
+    ) -> "ChangeFeed":
+        """Returns a feed of the updates of the given dynamic predicates, see :py:class:`ChangeFeed`
+
+        :param predicates:
+            Predicate indicators, e.g. ``"session/2"`` or ``"app:session/2"``.
+            By default, the predicates are in the ``user`` module.
+        :param maxlen:
+            Maximum number of pending events.
+            If the limit is reached, the new events are dropped and counted in :py:attr:`ChangeFeed.dropped`.
+        :param normalize:
+            Return the arguments of the heads as normalized values
+
+        :raises ValueError: if no predicates were given, an indicator is not valid or ``maxlen`` is not positive.
+
+        >>> Prolog.dynamic("session/2")
+        >>> feed = Prolog.changes("session/2")
+        >>> Prolog.assertz("session(s1, active)")
+        >>> feed.poll()
+        {'user:session/2': [('assert', ('s1', 'active'))]}
+        >>> feed.close()
+        """
+        return ChangeFeed(predicates, maxlen=maxlen, normalize=normalize)
+
+    @classmethod
+    def materialize(
+        cls, goal: str, *args, depends_on: Sequence[str], normalize: bool = True
+    ) -> "MaterializedView":
+        """Returns the solutions of the goal, kept up to date with the updates of the given predicates
+
+        See :py:class:`MaterializedView`.
+
+        :param goal:
+            The goal to run.
+            The placeholders (``%p``) are replaced by the ``args`` if one ore more arguments are given.
+        :param args:
+            Arguments to replace the placeholders in the ``goal`` string
+        :param depends_on:
+            Indicators of the dynamic predicates the solutions depend on, e.g. ``["edge/2"]``
+        :param normalize:
+            Return normalized values
+
+        >>> Prolog.dynamic("edge/2")
+        >>> Prolog.assertz("edge(a, b)")
+        >>> view = Prolog.materialize("edge(X, Y)", depends_on=["edge/2"])
+        >>> ("a", "b") in view
+        True
+        >>> Prolog.assertz("edge(b, c)")
+        >>> sorted(view)
+        [('a', 'b'), ('b', 'c')]
+        """
+        if args:
+            goal = format_prolog(goal, args)
+        return MaterializedView(goal, depends_on, normalize=normalize)
+
+    @classmethod
+    def replace_predicate(
+        cls, indicator: str, rows: Iterable, *, module: str = ""
+    ) -> int:
+        """Replaces the clauses of a dynamic predicate with the given facts at once
+
+        The facts are loaded in a shadow module while the queries keep using the current clauses.
+        Then the predicate is redirected to the shadow module in a single
+        `transaction/1 <https://www.swi-prolog.org/pldoc/doc_for?object=transaction/1>`_,
+        so the queries never see an empty or a partially loaded predicate.
+        The running queries finish with the previous facts.
+        The previous facts are kept until the next replacement, so a query which was redirected
+        just before the swap still finds them. Each predicate uses three shadow modules in turn:
+        the current one, the previous one and the one being loaded.
+
+        The predicate is redefined as a single clause calling the shadow module,
+        so it should be updated only using this method afterwards.
+
+        Returns the number of facts loaded.
+
+        :param indicator:
+            Predicate indicator, e.g. ``"rate/3"``
+        :param rows:
+            An iterable of the facts, each a list or tuple of the arguments, or a single value for predicates with one argument.
+            The rows are loaded in chunks, so the iterable may be a generator.
+        :param module:
+            Name of the module of the predicate. By default, the ``user`` module.
+
+        :raises ValueError: if the indicator is not valid or a row does not have ``arity`` values.
+
+        >>> Prolog.replace_predicate("rate/2", [("usd", 1.0), ("eur", 0.9)])
+        2
+        >>> Prolog.once("rate(eur, R)")
+        {'R': 0.9}
+        """
+        m = RE_INDICATOR.fullmatch(indicator)
+        if not m:
+            raise ValueError(f"Invalid predicate indicator: {indicator!r}")
+        name, arity = m.group(1), int(m.group(2))
+        module = module or "user"
+        load = cls.predicate("pyswip_load_table", 4)
+        rows = iter(rows)
+        with cls._replace_lock:
+            shadows = cls._replaced.setdefault((module, name, arity), [])
+            if len(shadows) < 3:
+                shadow = f"pyswip_shadow_{next(_shadow_modules)}"
+            else:
+                # the oldest one was cleared when the current generation was installed
+                shadow = shadows.pop(0)
+            count = 0
+            try:
+                while True:
+                    _, _, chunk = _table_rows(
+                        name, itertools.islice(rows, CHUNK_SIZE), arity
+                    )
+                    if not chunk:
+                        break
+                    load.exists(shadow, name, arity, chunk)
+                    count += len(chunk)
+                cls.predicate("pyswip_redirect", 4).exists(module, shadow, name, arity)
+            except BaseException:
+                _clear_shadow(shadow, name, arity)
+                shadows.insert(0, shadow)
+                raise
+            # A query may have picked the redirect to the previous generation just before the swap,
+            # so the previous generation is kept, and the one before it is cleared to be loaded next
+            shadows.append(shadow)
+            if len(shadows) == 3:
+                _clear_shadow(shadows[0], name, arity)
+        return count
+
+
+class CancelToken:
+    """Cancels a running query from another thread
+
+    Pass the token to :py:meth:`Prolog.query`, :py:meth:`Prolog.once` or :py:meth:`Prolog.exists`
+    and call :py:meth:`cancel` from another thread to stop the query.
+    The query raises :py:class:`QueryCancelled` in the thread running it, and the query is closed.
+    If the token is cancelled before the query starts, the query is not run.
+
+    A token is meant to be used for a single query.
+
+    >>> token = CancelToken()
+    >>> threading.Timer(0.1, token.cancel).start()
+    >>> list(Prolog.query("repeat, fail", cancel=token))
+    Traceback (most recent call last):
+    ...
+    pyswip.prolog.QueryCancelled: Caused by: ...
+    """
+
+    _ids = itertools.count(1)
+    # Tokens which were not garbage collected, see _token_cancelled
+    _tokens = weakref.WeakValueDictionary()
+    _registered = False
+
+    __slots__ = "id", "_cancelled", "__weakref__"
+
+    def __init__(self) -> None:
+        self.id = next(self._ids)
+        self._cancelled = False
+        if not CancelToken._registered:
+            Prolog.register_foreign(
+                _token_cancelled, "pyswip_token_cancelled", 1, raw=True
+            )
+            CancelToken._registered = True
+        CancelToken._tokens[self.id] = self
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether :py:meth:`cancel` was called"""
+        return self._cancelled
+
+    def cancel(self) -> None:
+        """Cancels the query using this token
+
+        The query is interrupted using `thread_signal/2 <https://www.swi-prolog.org/pldoc/doc_for?object=thread_signal/2>`_.
+        This method may be called from any thread.
+        The token is marked as cancelled before the running queries are signalled,
+        and a query checks the mark after it is registered as running,
+        so a query which is about to start is not missed.
+        """
+        self._cancelled = True
+        Prolog._init_prolog_thread()
+        _call_goal(f"pyswip_cancel({self.id})")
+
+    def wrap(self, query: str) -> str:
+        """Wraps the query so it can be cancelled using this token"""
+        query = query.rstrip()
+        if query.endswith("."):
+            query = query[:-1]
+        return f"pyswip_cancellable({self.id}, ({query}))"
+
+    def __repr__(self):
+        return f"CancelToken({self.id})"
+
+
+class Snapshot:
+    """Collects database updates which are visible only to the queries of a block
+
+    Use :py:meth:`Prolog.snapshot` or :py:meth:`Prolog.transaction` to create a snapshot.
+
+    The first update or query of the snapshot starts a Prolog thread which runs
+    `snapshot/1 <https://www.swi-prolog.org/pldoc/doc_for?object=snapshot/1>`_,
+    or `transaction/1 <https://www.swi-prolog.org/pldoc/doc_for?object=transaction/1>`_ for a transaction,
+    until the end of the block.
+    The updates and the queries are sent to that thread, so each update is applied once
+    and the solutions of the queries are fetched one at a time as the generators are advanced.
+    Queries on thread-local predicates see the clauses of the snapshot thread.
+
+    A query opened while another query of the snapshot is not exhausted is nested in it,
+    so advancing the outer query stops the nested one.
+
+    Snapshots and transactions require a SWI-Prolog version with support for transactions.
+    """
+
+    __slots__ = (
+        "commit",
+        "_thread",
+        "_finalizer",
+        "_count",
+        "_queries",
+        "_query_ids",
+        "__weakref__",
+    )
+
+    _ids = itertools.count(1)
+
+    def __init__(self, *, commit: bool = False) -> None:
+        self.commit = commit
+        self._thread = None
+        self._count = 0
+        # Identifiers of the queries suspended at a solution, the innermost last
+        self._queries = []
+        self._query_ids = itertools.count(1)
+
+    def asserta(self, format: str, *args) -> None:
+        """Asserts the clause as the first clause of the predicate, see :py:meth:`Prolog.asserta`"""
+        self._update("asserta", format, args)
+
+    def assertz(self, format: str, *args) -> None:
+        """Asserts the clause as the last clause of the predicate, see :py:meth:`Prolog.assertz`"""
+        self._update("assertz", format, args)
+
+    def retract(self, format: str, *args) -> None:
+        """Removes the first clause matching the term, if there is one, see :py:meth:`Prolog.retract`"""
+        self._update("retract", format, args)
+
+    def retractall(self, format: str, *args) -> None:
+        """Removes all the clauses whose head matches the term, see :py:meth:`Prolog.retractall`"""
+        self._update("retractall", format, args)
+
+    def query(
+        self, format: str, *args, catcherrors: bool = True, normalize: bool = True
+    ) -> Generator:
+        """Run a prolog query with the updates applied and return a generator
+
+        The arguments are the same as :py:meth:`Prolog.query`.
+        """
+        goal = strip_query(format_prolog(format, args) if args else format)
+        return self._solutions(goal, catcherrors, normalize)
+
+    def once(
+        self, format: str, *args, catcherrors: bool = True, normalize: bool = True
+    ) -> Optional[dict]:
+        """Run a prolog query with the updates applied and return its first solution, see :py:meth:`Prolog.once`"""
+        solutions = self.query(
+            format, *args, catcherrors=catcherrors, normalize=normalize
+        )
+        try:
+            return next(solutions, None)
+        finally:
+            solutions.close()
+
+    def exists(self, format: str, *args, catcherrors: bool = True) -> bool:
+        """Returns whether the prolog query has a solution with the updates applied, see :py:meth:`Prolog.exists`"""
+        return (
+            self.once(format, *args, catcherrors=catcherrors, normalize=False)
+            is not None
+        )
+
+    def rollback(self) -> None:
+        """Discards the updates made so far"""
+        self._close("rollback")
+
+    def _open(self) -> Tuple[Atom, Atom]:
+        if self._thread is None:
+            thread = f"pyswip_snapshot_{next(Snapshot._ids)}"
+            Prolog.predicate("pyswip_snapshot_open", 3).exists(
+                Atom(thread), Atom(f"{thread}_replies"), Atom(str(self.commit).lower())
+            )
+            self._thread = thread
+            # a snapshot which is not exited is rolled back when it is garbage collected
+            self._finalizer = weakref.finalize(self, _close_snapshot, thread)
+            self._finalizer.atexit = False
+        return Atom(self._thread), Atom(f"{self._thread}_replies")
+
+    def _close(self, mode: str) -> bool:
+        self._stop(0)
+        thread, self._thread = self._thread, None
+        self._count = 0
+        if thread is None:
+            return True
+        self._finalizer.detach()
+        return _close_snapshot(thread, mode)
+
+    def _update(self, name: str, format: str, args: Tuple) -> None:
+        clause = strip_query(format_prolog(format, args) if args else format)
+        Prolog.predicate("pyswip_snapshot_update", 4).exists(
+            *self._open(), Atom(name), clause
+        )
+        self._count += 1
+
+    def _solutions(self, goal: str, catcherrors: bool, normalize: bool):
+        thread, replies = self._open()
+        query_id = next(self._query_ids)
+        queries = self._queries
+        _, _, _, _, reply = Prolog.predicate("pyswip_snapshot_query", 5).once(
+            thread,
+            replies,
+            query_id,
+            goal,
+            None,
+            catcherrors=catcherrors,
+            normalize=False,
+        )
+        fetch = Prolog.predicate("pyswip_snapshot_next", 4)
+        try:
+            while isinstance(reply, Functor):
+                queries.append(query_id)
+                yield _decode_solution(reply.args[0], normalize)
+                if query_id not in queries:
+                    # the query was stopped by an outer query or the end of the block
+                    return
+                self._stop(queries.index(query_id) + 1)
+                queries.pop()
+                _, _, _, reply = fetch.once(
+                    thread,
+                    replies,
+                    query_id,
+                    None,
+                    catcherrors=catcherrors,
+                    normalize=False,
+                )
+        finally:
+            if query_id in queries:
+                self._stop(queries.index(query_id))
+
+    def _stop(self, index: int) -> None:
+        """Stops the suspended queries from the given position of the stack"""
+        stop = Prolog.predicate("pyswip_snapshot_stop", 3)
+        while len(self._queries) > index:
+            stop.exists(*self._open(), self._queries.pop())
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        commit = self.commit and exc_type is None
+        if not self._close("commit" if commit else "rollback") and commit:
+            raise PrologError("The transaction could not be committed")
+
+    def __len__(self) -> int:
+        return self._count
+
+
+def _close_snapshot(thread: str, mode: str = "rollback") -> bool:
+    _, _, _, result = Prolog.predicate("pyswip_snapshot_close", 4).once(
+        Atom(thread), Atom(f"{thread}_replies"), Atom(mode), None
+    )
+    return result == "true"
+
+
+def _decode_solution(bindings: list, normalize: bool):
+    if not normalize:
+        return bindings
+    solution = {}
+    for binding in bindings:
+        solution.update(normalize_values(binding.value))
+    return solution
+
+
+class KeyedTable:
+    """A dynamic predicate with at most one fact for each key
+
+    Use :py:meth:`Prolog.keyed_table` to create a keyed table.
+
+    Each operation is a single call of a helper predicate with the values as arguments,
+    so no goal is parsed. The facts are looked up by the key argument,
+    which is indexed by SWI-Prolog's just-in-time clause indexing.
+    Strings in the rows are stored as atoms.
+    """
+
+    __slots__ = "name", "arity", "key", "module"
+
+    def __init__(self, name: str, arity: int, key: int, *, module: str = "") -> None:
+        if not RE_TABLE_NAME.fullmatch(name):
+            raise ValueError(f"Invalid table name: {name!r}")
+        if not 0 <= key < arity:
+            raise ValueError(f"key must be between 0 and {arity - 1}")
+        self.name = name
+        self.arity = arity
+        self.key = key
+        self.module = module or "user"
+        Prolog.dynamic(f"{self.module}:{name}/{arity}")
+
+    def upsert(self, *values) -> None:
+        """Replaces the fact with the key of the given row, or adds the row if there is no such fact
+
+        :param values: The arguments of the fact
+        """
+        if len(values) != self.arity:
+            raise ValueError(
+                f"{self} expects {self.arity} values, but {len(values)} were given"
+            )
+        Prolog.predicate("pyswip_upsert", 5).exists(*self._table(), list(values))
+
+    def bulk_upsert(self, rows: Iterable) -> int:
+        """Upserts the rows, in chunks of a single call each
+
+        Returns the number of rows.
+
+        :param rows: An iterable of the rows, each a list or tuple of the arguments
+        """
+        upsert = Prolog.predicate("pyswip_bulk_upsert", 5)
+        rows = iter(rows)
+        count = 0
+        while True:
+            _, _, chunk = _table_rows(
+                self.name, itertools.islice(rows, CHUNK_SIZE), self.arity
+            )
+            if not chunk:
+                return count
+            upsert.exists(*self._table(), chunk)
+            count += len(chunk)
+
+    def delete(self, key) -> bool:
+        """Removes the fact with the given key
+
+        Returns whether there was such a fact.
+        """
+        return Prolog.predicate("pyswip_delete", 5).exists(*self._table(), key)
+
+    def get(self, key, default=None):
+        """Returns the fact with the given key as a tuple, or ``default`` if there is no such fact"""
+        result = Prolog.predicate("pyswip_get", 6).once(*self._table(), key, None)
+        return default if result is None else tuple(result[5])
+
+    def _table(self) -> Tuple[str, str, int, int]:
+        return self.module, self.name, self.arity, self.key + 1
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        args = ", ".join("_" * self.arity)
+        return Prolog.count(f"{self.module}:{self.name}({args})")
+
+    def __str__(self):
+        return f"{self.module}:{self.name}/{self.arity}"
+
+    def __repr__(self):
+        return f"KeyedTable({self})"
+
+
+class ChangeFeed:
+    """Collects the assert, retract and erase events of dynamic predicates
+
+    Use :py:meth:`Prolog.changes` to create a feed.
+
+    The events are received using
+    `prolog_listen/2 <https://www.swi-prolog.org/pldoc/doc_for?object=prolog_listen/2>`_,
+    so the updates made by Prolog code are included.
+    The listener sends each event to a message queue of the feed without calling Python,
+    and :py:meth:`poll` takes all the pending events from the queue in a single call.
+
+    Each event is a tuple of the action, one of ``"assert"``, ``"retract"`` and ``"erase"``,
+    and the arguments of the head of the clause as a tuple,
+    or ``None`` if the clause is not available anymore.
+
+    If the feed is full, the new events are dropped and counted in :py:attr:`dropped`.
+
+    A feed which is not closed is closed when it is garbage collected.
+
+    >>> Prolog.dynamic("session/2")
+    >>> with Prolog.changes("session/2") as feed:
+    ...     feed.subscribe(print)
+    ...     Prolog.assertz("session(s1, active)")
+    ...     feed.flush()
+    user:session/2 [('assert', ('s1', 'active'))]
+    1
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        predicates: Sequence[str],
+        *,
+        maxlen: Optional[int] = None,
+        normalize: bool = True,
+    ):
+        if not predicates:
+            raise ValueError("One or more predicates must be given")
+        if maxlen is not None and maxlen < 1:
+            raise ValueError("maxlen must be a positive integer")
+        indicators = []
+        for indicator in predicates:
+            m = RE_QUALIFIED_INDICATOR.fullmatch(indicator)
+            if not m:
+                raise ValueError(f"Invalid predicate indicator: {indicator!r}")
+            module, name, arity = m.groups()
+            indicators.append((module or "user", name, int(arity)))
+        self.id = next(self._ids)
+        self.predicates = tuple(f"{m}:{n}/{a}" for m, n, a in indicators)
+        self.normalize = normalize
+        self.maxlen = maxlen
+        self.dropped = 0
+        self.queue = f"pyswip_feed_{self.id}"
+        self._pending = []
+        self._callbacks = []
+        Prolog.exists(f"message_queue_create(_, [alias({self.queue})])")
+        for index, (module, name, arity) in enumerate(indicators):
+            # clause_property/2 reports the predicate as Module:(Name/Arity)
+            indicator = f"{module}:({name}/{arity})"
+            Prolog.dynamic(indicator)
+            Prolog.assertz(
+                f"pyswip_feed_predicate({self.id}, {indicator}, {index}, "
+                f"{self.queue}, {'inf' if maxlen is None else maxlen})"
+            )
+        for channel in FEED_CHANNELS:
+            Prolog.exists(f"prolog_listen({channel}, pyswip_feed_event({self.id}))")
+        self._finalizer = weakref.finalize(self, _close_feed, self.id, self.queue)
+        self._finalizer.atexit = False
+
+    @property
+    def closed(self) -> bool:
+        """Whether the feed was closed"""
+        return not self._finalizer.alive
+
+    def subscribe(self, callback: Callable[[str, list], typing.Any]) -> None:
+        """Adds a callback which is called with the predicate indicator and the events by :py:meth:`flush`"""
+        self._callbacks.append(callback)
+
+    def poll(self) -> Dict[str, list]:
+        """Returns the pending events grouped by predicate indicator, in order of occurence, and removes them
+
+        The number of events dropped since the previous poll because the feed was full
+        is added to :py:attr:`dropped`.
+        """
+        self._drain()
+        batch = {}
+        events, self._pending = self._pending, []
+        for indicator, event in events:
+            batch.setdefault(indicator, []).append(event)
+        return batch
+
+    def flush(self) -> int:
+        """Calls the callbacks with the pending events of each predicate
+
+        Returns the number of events.
+        """
+        count = 0
+        for indicator, events in self.poll().items():
+            count += len(events)
+            for callback in self._callbacks:
+                callback(indicator, events)
+        return count
+
+    def close(self) -> None:
+        """Stops listening to the updates, the pending events can still be polled"""
+        if self.closed:
+            return
+        self._drain()
+        self._finalizer()
+
+    async def batches(self, interval: float = 0.05):
+        """Yields the non-empty batches of events, polling the feed every ``interval`` seconds until it is closed
+
+        >>> async for batch in feed.batches():  # doctest: +SKIP
+        ...     update_cache(batch)
+        """
+        while True:
+            batch = self.poll()
+            if batch:
+                yield batch
+            elif self.closed:
+                return
+            else:
+                await asyncio.sleep(interval)
+
+    def _drain(self) -> None:
+        if self.closed:
+            return
+        _, events, dropped = Prolog.predicate("pyswip_feed_drain", 3).once(
+            Atom(self.queue), None, None, normalize=False
+        )
+        self.dropped += dropped
+        for event in events:
+            index, action = event.args[0], event.args[1].value
+            if len(event.args) == 2:
+                row = None
+            elif self.normalize:
+                row = tuple(normalize_values(v) for v in event.args[2])
+            else:
+                row = tuple(event.args[2])
+            self._pending.append((self.predicates[index], (action, row)))
+
+    def __aiter__(self):
+        return self.batches()
+
+    def __len__(self) -> int:
+        if self.closed:
+            return len(self._pending)
+        _, size = Prolog.predicate("pyswip_feed_size", 2).once(Atom(self.queue), None)
+        return len(self._pending) + size
+
+    def __enter__(self) -> "ChangeFeed":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"ChangeFeed({', '.join(self.predicates)})"
+
+
+def _close_feed(feed_id: int, queue: str) -> None:
+    for channel in FEED_CHANNELS:
+        Prolog.exists(f"prolog_unlisten({channel}, pyswip_feed_event({feed_id}))")
+    Prolog.retractall(f"pyswip_feed_predicate({feed_id}, _, _, _, _)")
+    Prolog.exists(f"message_queue_destroy({queue}), flag({queue}, _, 0)")
+
+
+class MaterializedView:
+    """The solutions of a goal, kept in Python and updated when the predicates it depends on change
+
+    Use :py:meth:`Prolog.materialize` to create a view.
+
+    The view listens to the updates of its dependencies using a :py:class:`ChangeFeed`.
+    Reading the view checks whether there are pending updates, which takes constant time,
+    and applies them if there are.
+
+    If the goal is a conjunction of calls to the dependencies and of built-in predicates,
+    the view is :py:attr:`incremental`: the rows are also kept in a dynamic predicate,
+    and each update is applied by running the rest of the goal with the asserted fact in place of
+    a matching call, and by checking again the rows which match a retracted fact.
+    So the cost of an update depends on the rows it affects, not on the size of the view.
+    Otherwise, or if the update cannot be applied that way, e.g. a rule was asserted,
+    the goal is run again and the solutions are compared with the current ones.
+    Either way, the subscribers receive only the added and removed rows.
+
+    Each row is a tuple of the values of the variables of the goal, in order of appearance.
+    Lists are converted to tuples, so the rows can be compared.
+
+    A view which is not closed is closed when it is garbage collected.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self, goal: str, depends_on: Sequence[str], *, normalize: bool = True
+    ) -> None:
+        self.goal = strip_query(goal)
+        self.names = tuple(template_variables(self.goal))
+        self.normalize = normalize
+        self.refresh_count = 0
+        self.update_count = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.id = next(self._ids)
+        self._callbacks = []
+        self._feed = ChangeFeed(depends_on)
+        self._finalizer = weakref.finalize(self, _drop_view, self.id)
+        self._finalizer.atexit = False
+        dependencies = ", ".join(
+            "{}:({})".format(*indicator.split(":", 1))
+            for indicator in self._feed.predicates
+        )
+        result = Prolog.once(
+            f"pyswip_view_create(%p, %p, %p, [{dependencies}], Incremental)",
+            self.id,
+            self.goal,
+            [Atom(name) for name in self.names],
+        )
+        if result is None:
+            self.close()
+            raise ValueError(f"Invalid goal: {self.goal!r}")
+        self.incremental = result["Incremental"] == "true"
+        self._rows = set()
+        self._frozen = frozenset()
+        self.refresh()
+
+    @property
+    def rows(self) -> frozenset:
+        """The current rows"""
+        self._sync()
+        if self._frozen is None:
+            self._frozen = frozenset(self._rows)
+        return self._frozen
+
+    @property
+    def closed(self) -> bool:
+        """Whether the view was closed"""
+        return not self._finalizer.alive
+
+    def subscribe(self, callback: Callable[[frozenset, frozenset], typing.Any]) -> None:
+        """Adds a callback which is called with the added and removed rows when the view is updated"""
+        self._callbacks.append(callback)
+
+    def refresh(self) -> bool:
+        """Runs the goal again and replaces the rows
+
+        Returns whether the rows changed.
+        The time it took is recorded in :py:attr:`last_latency` and :py:attr:`max_latency`, in seconds,
+        like the time of the updates.
+        The rows of a closed view are not changed.
+        """
+        if self.closed:
+            return False
+        self._feed.poll()
+        start = time.perf_counter()
+        _, rows = Prolog.predicate("pyswip_view_full", 2).once(
+            self.id, None, normalize=False
+        )
+        return self._replace(start, rows)
+
+    def close(self) -> None:
+        """Stops updating the view, the current rows are kept"""
+        self._feed.close()
+        self._finalizer()
+
+    def _sync(self) -> None:
+        if self.closed or not len(self._feed):
+            return
+        start = time.perf_counter()
+        _, _, _, mode, added, removed = Prolog.predicate("pyswip_view_update", 6).once(
+            self.id,
+            self._feed.id,
+            Atom(self._feed.queue),
+            None,
+            None,
+            None,
+            normalize=False,
+        )
+        if mode.value == "full":
+            self._replace(start, added)
+            return
+        added = frozenset(self._row(row) for row in added)
+        removed = frozenset(self._row(row) for row in removed)
+        self._rows -= removed
+        self._rows |= added
+        self.update_count += 1
+        self._changed(start, added, removed)
+
+    def _replace(self, start: float, rows: list) -> bool:
+        rows = {self._row(row) for row in rows}
+        added = frozenset(rows - self._rows)
+        removed = frozenset(self._rows - rows)
+        self._rows = rows
+        self.refresh_count += 1
+        return self._changed(start, added, removed)
+
+    def _changed(self, start: float, added: frozenset, removed: frozenset) -> bool:
+        self.last_latency = time.perf_counter() - start
+        self.max_latency = max(self.max_latency, self.last_latency)
+        if added or removed:
+            self._frozen = None
+            for callback in self._callbacks:
+                callback(added, removed)
+            return True
+        return False
+
+    def _row(self, values: list) -> tuple:
+        if self.normalize:
+            values = normalize_values(values)
+        return _hashable(values)
+
+    def __contains__(self, row) -> bool:
+        return tuple(row) in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __enter__(self) -> "MaterializedView":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"MaterializedView({self.goal!r})"
+
+
+def _drop_view(view_id: int) -> None:
+    Prolog.predicate("pyswip_view_drop", 1).exists(view_id)
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+def _token_cancelled(term) -> bool:
+    token = CancelToken._tokens.get(term.get_int())
+    return token is not None and token.cancelled
+
+
+class Predicate:
+    """A handle to a Prolog predicate
+
+    Use :py:meth:`Prolog.predicate` to create a predicate handle.
+
+    The arguments are converted to Prolog terms as follows:
+
+    * ``None``: a fresh variable
+    * ``str``: an atom
+    * ``int``, ``list``, :py:class:`pyswip.easy.Variable`, :py:class:`pyswip.easy.Functor` and :py:class:`pyswip.easy.Term`:
+      the corresponding Prolog term
+    """
+
+    __slots__ = "name", "arity", "module", "handle"
+
+    def __init__(self, name: str, arity: int, *, module: str = "") -> None:
+        self.name = name
+        self.arity = arity
+        self.module = module
+        self.handle = PL_predicate(name, arity, module or None)
+
+    def __call__(
+        self,
+        *args,
+        maxresult: int = -1,
+        catcherrors: bool = True,
+        normalize: bool = True,
+    ) -> Generator:
+        """Calls the predicate and returns a generator of the arguments for each solution
+
+        :param args: Arguments of the predicate
+        :param maxresult: Maximum number of results to return
+        :param catcherrors: Catches the exception raised during goal execution
+        :param normalize: Return normalized values
+        """
+        self._check_args(args)
+        return Prolog._QueryWrapper().run(
+            self.handle,
+            functools.partial(self._put_args, args),
+            functools.partial(self._decode_args, normalize=normalize),
+            str(self),
+            maxresult,
+            catcherrors,
+        )
+
+    def once(
+        self, *args, catcherrors: bool = True, normalize: bool = True
+    ) -> Optional[tuple]:
+        """Calls the predicate and returns the arguments for the first solution, or ``None`` if there are no solutions
+
+        :param args: Arguments of the predicate
+        :param catcherrors: Catches the exception raised during goal execution
+        :param normalize: Return normalized values
+        """
+        self._check_args(args)
+        return Prolog._call_once(
+            self.handle,
+            functools.partial(self._put_args, args),
+            functools.partial(self._decode_args, normalize=normalize),
+            str(self),
+            catcherrors,
+        )
+
+    def exists(self, *args, catcherrors: bool = True) -> bool:
+        """Returns whether the predicate call has a solution
+
+        :param args: Arguments of the predicate
+        :param catcherrors: Catches the exception raised during goal execution
+        """
+        self._check_args(args)
+        r = Prolog._call_once(
+            self.handle,
+            functools.partial(self._put_args, args),
+            None,
+            str(self),
+            catcherrors,
+        )
+        return r is not None
+
+    def _check_args(self, args):
+        if len(args) != self.arity:
+            raise ValueError(
+                f"{self} expects {self.arity} arguments, but {len(args)} were given"
+            )
+
+    def _put_args(self, args):
+        swipl_args = PL_new_term_refs(self.arity)
+        for i, arg in enumerate(args):
+            if arg is not None:
+                putTerm(swipl_args + i, arg)
+        return swipl_args
+
+    def _decode_args(self, swipl_args, normalize):
+        if normalize:
+            return tuple(
+                normalize_values(getTerm(swipl_args + i)) for i in range(self.arity)
+            )
+        return tuple(getTerm(swipl_args + i) for i in range(self.arity))
+
+    def __str__(self):
+        if self.module:
+            return f"{self.module}:{self.name}/{self.arity}"
+        return f"{self.name}/{self.arity}"
+
+    def __repr__(self):
+        return f"Predicate({self})"
+
+
+class _QueryState(threading.local):
+    # Number of open queries in the current thread
+    open_queries = 0
+
+
+_query_state = _QueryState()
+
+
+class _EnginePool:
+    """Keeps the temporary engines used to run nested queries"""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._idle = []
+
+    def acquire(self):
+        try:
+            return self._idle.pop()
+        except IndexError:
+            pass
+        engine = PL_create_engine(None)
+        if not engine:
+            raise NestedQueryError(
+                "The last query was not closed and a temporary engine could not be created"
+            )
+        return engine
+
+    def release(self, engine) -> None:
+        if len(self._idle) < self.size:
+            self._idle.append(engine)
+        else:
+            PL_destroy_engine(engine)
+
+
+_engines = _EnginePool(4)
+
+
+class _ModulePool:
+    """Keeps the names of the private modules used for the query-scoped tables"""
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self._free = []
+        self._names = itertools.count(1)
+
+    def acquire(self) -> str:
+        try:
+            return self._free.pop()
+        except IndexError:
+            return f"{self.prefix}_{next(self._names)}"
+
+    def release(self, module: str) -> None:
+        self._free.append(module)
+
+
+_table_modules = _ModulePool("pyswip_tables")
+# Numbers the shadow modules, each predicate uses at most three of them, see replace_predicate
+_shadow_modules = itertools.count(1)
+
+
+class _TableScope:
+    """Loads the tables of a query in a private module, and removes them when the query is closed
+
+    Entering the scope returns the module, see :py:func:`prepare_query`.
+    """
+
+    def __init__(self, tables: Dict[str, Iterable]) -> None:
+        self.tables = [_table_rows(name, rows) for name, rows in tables.items()]
+        self.module = None
+
+    def __enter__(self) -> str:
+        self.module = _table_modules.acquire()
+        load = Prolog.predicate("pyswip_load_table", 4)
+        try:
+            for name, arity, rows in self.tables:
+                load.exists(self.module, name, arity, rows)
+        except BaseException:
+            self.__exit__()
+            raise
+        return self.module
+
+    def __exit__(self, *exc):
+        Prolog._init_prolog_thread()
+        for name, arity, _ in self.tables:
+            _call_goal(f"abolish({self.module}:{name}/{arity})")
+        _table_modules.release(self.module)
+        self.module = None
+
+    def run(self, query: Callable[[str], Generator]) -> Generator:
+        """Runs the query returned by ``query(module)`` in the scope
+
+        The module is acquired when the results are first requested,
+        so a generator which is never iterated holds no module.
+        """
+        with self as module:
+            yield from query(module)
+
+
+def _clear_shadow(shadow: str, name: str, arity: int) -> None:
+    # The predicate is emptied instead of abolished, so a query which was redirected
+    # to it but did not call it yet finds no facts instead of raising an error
+    Prolog._init_prolog_thread()
+    _call_goal(f"functor(H, {name}, {arity}), retractall({shadow}:H)")
+
+
+class _NoTables:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_TABLES = _NoTables()
+
+
+def _table_rows(
+    name: str, rows: Iterable, arity: Optional[int] = None
+) -> Tuple[str, int, List[list]]:
+    if not isinstance(name, str) or not RE_TABLE_NAME.fullmatch(name):
+        raise ValueError(f"Invalid table name: {name!r}")
+    rows = [list(row) if isinstance(row, (list, tuple)) else [row] for row in rows]
+    if arity is None:
+        arity = len(rows[0]) if rows else 1
+    for row in rows:
+        if len(row) != arity:
+            raise ValueError(
+                f"Table {name} expects rows of {arity} values, got: {row!r}"
+            )
+    return name, arity, rows
+
+
+class _EngineContext:
+    """Makes the engine current in the calling thread, does nothing if the engine is ``None``"""
+
+    __slots__ = "engine", "previous"
+
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        self.previous = None
+
+    def __enter__(self):
+        if self.engine is not None:
+            self.previous = PL_engine_t()
+            rc = PL_set_engine(self.engine, byref(self.previous))
+            if rc != PL_ENGINE_SET:
+                raise PrologError(f"Could not switch to a temporary engine: {rc}")
+
+    def __exit__(self, *exc):
+        if self.engine is not None:
+            PL_set_engine(self.previous, None)
+
+
+class _ContextPool:
+    """Keeps the state of running generator predicates, indexed by the handle passed to ``PL_retry``"""
+
+    def __init__(self) -> None:
+        self._items = {}
+        self._free = []
+        self._handles = itertools.count(1)
+
+    def add(self, item) -> int:
+        try:
+            handle = self._free.pop()
+        except IndexError:
+            handle = next(self._handles)
+        self._items[handle] = item
+        return handle
+
+    def get(self, handle: int):
+        return self._items[handle]
+
+    def release(self, handle: int):
+        item = self._items.pop(handle)
+        self._free.append(handle)
+        return item
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+_generator_contexts = _ContextPool()
+
+# Marks the end of a generator
+_END = object()
+
+
+def _unify_row(terms, row, unify: Callable) -> bool:
+    if len(terms) == 1:
+        return unify(terms[0], row)
+    if len(row) != len(terms):
+        raise ValueError(f"Expected a row of {len(terms)} values, got: {row!r}")
+    fid = PL_open_foreign_frame()
+    try:
+        for term, value in zip(terms, row):
+            if not unify(term, value):
+                PL_discard_foreign_frame(fid)
+                return False
+    except BaseException:
+        PL_discard_foreign_frame(fid)
+        raise
+    PL_close_foreign_frame(fid)
+    return True
+
+
+@functools.cache
+def _pyrun_predicate():
+    return PL_predicate("pyrun", 2, None)
+
+
+def _put_goal(query: str):
+    swipl_args = PL_new_term_refs(2)
+    PL_put_chars(swipl_args, PL_STRING | REP_UTF8, -1, query.encode("utf-8"))
+    return swipl_args
+
+
+def _decode_bindings(term, normalize):
+    t = getTerm(term)
+    if not normalize:
+        return t
+    try:
+        return t.value
+    except AttributeError:
+        v = {}
+        for r in [x.value for x in t]:
+            r = normalize_values(r)
+            v.update(r)
+        return v
+
+
+# Maps the exceptions thrown by the limit helpers to the error type and the counter to increment
+_LIMIT_ERRORS = {
+    "time_limit_exceeded": (QueryTimeout, "timeout"),
+    "inference_limit_exceeded": (InferenceLimitExceeded, "max_inferences"),
+    "pyswip_cancelled": (QueryCancelled, "cancelled"),
+}
+
+
+def _query_error(query: str, exception) -> PrologError:
+    term = getTerm(exception)
+    message = "".join(["Caused by: '", query, "'. ", "Returned: '", str(term), "'."])
+    if isinstance(term, Atom):
+        name = term.value
+    elif isinstance(term, Functor):
+        name = term.name.value
+    else:
+        name = None
+    limit_error = _LIMIT_ERRORS.get(name)
+    if limit_error is None:
+        return PrologError(message)
+    error_type, counter = limit_error
+    Prolog._limit_counters[counter] += 1
+    return error_type(message)
+
+
+def _typed_signature(func: Callable, nondeterministic: bool) -> List[Tuple]:
+    """Returns a ``(getter, expected_type, unify)`` tuple for each argument of a typed foreign predicate
+
+    ``unify`` is set only for ``Out[T]`` arguments, ``getter`` and ``expected_type`` only for the others.
+    """
+    getters = {
+        int: (getInt64, "integer"),
+        float: (getFloat, "float"),
+        str: (getText, "text"),
+        bool: (getBoolean, "bool"),
+        Atom: (getAtom, "atom"),
+        TermRef: (TermRef, None),
+    }
+    unifiers = {
+        int: PL_unify_int64,
+        float: PL_unify_float,
+        str: lambda t, value: PL_unify_string_chars(t, value.encode()),
+        bool: PL_unify_bool,
+        Atom: lambda t, value: PL_unify_atom(t, value.handle),
+    }
+    try:
+        hints = typing.get_type_hints(func)
+    except (TypeError, NameError):
+        hints = {}
+    params = list(inspect.signature(func).parameters.values())
+    if nondeterministic:
+        params = params[:-1]
+    specs = []
+    for param in params:
+        hint = hints.get(param.name, param.annotation)
+        if hint is Out or typing.get_origin(hint) is Out:
+            out_type = typing.get_args(hint)
+            unify = unifiers.get(out_type[0] if out_type else None, unifyTerm)
+            specs.append((None, None, unify))
+        else:
+            getter, expected = getters.get(hint, (getTerm, None))
+            specs.append((getter, expected, None))
+    return specs
+
+
+def _raise_type_error(expected: str, culprit) -> bool:
+    """Raises ``error(type_error(expected, culprit), _)`` in Prolog"""
+    error = PL_new_term_ref()
+    PL_chars_to_term(f"error(type_error({expected}, _), _)", error)
+    type_error = PL_new_term_ref()
+    PL_get_arg(1, error, type_error)
+    actual = PL_new_term_ref()
+    PL_get_arg(2, type_error, actual)
+    PL_unify(actual, culprit)
+    return PL_raise_exception(error)
+
+
+def prepare_query(
+    format: str,
+    args: Tuple,
+    timeout: Optional[float],
+    max_inferences: Optional[int],
+    cancel: Optional["CancelToken"],
+    module: Optional[str] = None,
+) -> Tuple[str, bool]:
+    """Formats the query and wraps it with the limits and the cancel token
+
+    Returns the query and whether it was wrapped.
+    The exceptions of a wrapped query must be caught, so they can be raised as the corresponding errors.
+    If a module is given, the predicates of the query are looked up in that module first.
+    The query keeps ``user`` as its context module, so e.g. the clauses it asserts still go to ``user``.
+    """
+    query = format_prolog(format, args) if args else format
+    if module is not None:
+        query = f"@({module}:({strip_query(query)}), user)"
+    guarded = False
+    if timeout is not None or max_inferences is not None:
+        query = with_limits(query, timeout, max_inferences)
+        guarded = True
+    if cancel is not None:
+        query = cancel.wrap(query)
+        guarded = True
+    return query, guarded
+
+
+def with_limits(
+    query: str, timeout: Optional[float], max_inferences: Optional[int]
+) -> str:
+    """Wraps the query to run with the given time and inference limits"""
+    if timeout is not None and timeout <= 0:
+        raise ValueError("timeout must be a positive number")
+    if max_inferences is not None and max_inferences <= 0:
+        raise ValueError("max_inferences must be a positive integer")
+    query = strip_query(query)
+    timeout = "inf" if timeout is None else repr(float(timeout))
+    max_inferences = "inf" if max_inferences is None else str(int(max_inferences))
+    return f"pyswip_call_with_limits(({query}), {timeout}, {max_inferences})"
+
+
+def strip_query(query: str) -> str:
+    """Removes the trailing full stop of the query, so it can be wrapped"""
+    query = query.rstrip()
+    if query.endswith("."):
+        query = query[:-1]
+    return query
+
+
+def normalize_values(values):
+    from pyswip.easy import Atom, Functor
+
+    if isinstance(values, Atom):
+        return values.value
+    if isinstance(values, Functor):
+        normalized = str(values.name.value)
+        if values.arity:
+            normalized_args = [str(normalize_values(arg)) for arg in values.args]
+            normalized = normalized + "(" + ", ".join(normalized_args) + ")"
+        return normalized
+    elif isinstance(values, dict):
+        return {key: normalize_values(v) for key, v in values.items()}
+    elif isinstance(values, (list, tuple)):
+        return [normalize_values(v) for v in values]
+    return values
+
+
+def make_prolog_str(value) -> str:
+    return text_encoder.text(value)
+
+
+def parse_aggregate(aggregate: str) -> Tuple[str, str]:
+    """Splits an aggregate specification, such as ``sum(X)``, to its functor and argument"""
+    m = RE_AGGREGATE.fullmatch(aggregate)
+    if not m or m.group(1) not in AGGREGATES:
+        raise ValueError(f"Unsupported aggregate: {aggregate}")
+    functor, arg = m.group(1), m.group(2)
+    if (functor == "count") != (arg is None):
+        raise ValueError(f"Invalid aggregate: {aggregate}")
+    return functor, arg or ""
+
+
+def template_variables(template: str) -> List[str]:
+    """Returns the names of the variables in the template, in order of appearance"""
+    names = []
+    for m in RE_VARIABLE.finditer(template):
+        name = m.group(1)
+        if name and name != "_" and name not in names:
+            names.append(name)
+    return names
+
+
+def compile_select(
+    template: str,
+    where: str,
+    *,
+    order_by: Union[str, Sequence[str], None] = None,
+    distinct: bool = False,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+) -> str:
+    """Wraps the goal with the solution sequence predicates for :py:meth:`Prolog.select`"""
+    goal = where
+    if distinct:
+        goal = f"distinct({template}, ({goal}))"
+    if order_by:
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        specs = []
+        for name in order_by:
+            if name.startswith("-"):
+                specs.append(f"desc({name[1:]})")
+            else:
+                specs.append(f"asc({name.lstrip('+')})")
+        goal = f"order_by([{','.join(specs)}], ({goal}))"
+    if offset is not None:
+        if offset < 0:
+            raise ValueError("offset must be zero or a positive integer")
+        if offset:
+            goal = f"offset({offset}, ({goal}))"
+    if limit is not None:
+        if limit < 0:
+            raise ValueError("limit must be zero or a positive integer")
+        goal = f"limit({limit}, ({goal}))"
+    return goal
 
 
 def format_prolog(fmt: str, args: Tuple) -> str:
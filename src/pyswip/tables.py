@@ -0,0 +1,407 @@
+# Copyright (c) 2007-2024 Yüce Tekol and PySwip Contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Data sources for predicates registered with :py:meth:`pyswip.Prolog.register_table`.
+
+A source yields the rows of a table as tuples. The data stays in Python, and lookups of bound arguments
+go through the source instead of scanning all rows.
+"""
+
+import abc
+import array
+import bisect
+import contextlib
+import heapq
+import itertools
+import mmap
+import pickle
+import struct
+import tempfile
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+__all__ = (
+    "TableSource",
+    "MappingSource",
+    "ColumnSource",
+    "FactFile",
+    "table_source",
+    "write_fact_file",
+)
+
+# Number of rows converted at once when enumerating columns
+CHUNK_SIZE = 4096
+
+# Number of rows sorted in memory at once by write_fact_file
+RUN_SIZE = 1_000_000
+
+
+class TableSource(abc.ABC):
+    """The rows of a table
+
+    Subclasses implement :py:meth:`rows`, and override :py:meth:`lookup` for the positions they can index.
+    """
+
+    arity = 0
+
+    @abc.abstractmethod
+    def rows(self) -> Iterator[Tuple]:
+        """Yields all rows of the table"""
+
+    def lookup(self, position: int, key: Any) -> Iterable[Tuple]:
+        """Returns the rows with the key at the given position. The default implementation scans all rows."""
+        return (row for row in self.rows() if row[position] == key)
+
+
+class MappingSource(TableSource):
+    """A table of the items of a mapping, indexed on the first position
+
+    For tables of more than two columns, the values of the mapping are tuples of the remaining columns.
+    """
+
+    def __init__(self, mapping: Mapping, arity: int = 2) -> None:
+        if arity < 2:
+            raise ValueError("The arity of a mapping table must be at least 2")
+        self.mapping = mapping
+        self.arity = arity
+
+    def _row(self, key, value) -> Tuple:
+        return (key, value) if self.arity == 2 else (key, *value)
+
+    def rows(self) -> Iterator[Tuple]:
+        for key, value in self.mapping.items():
+            yield self._row(key, value)
+
+    def lookup(self, position: int, key: Any) -> Iterable[Tuple]:
+        if position != 0:
+            return super().lookup(position, key)
+        try:
+            value = self.mapping[key]
+        except KeyError:
+            return ()
+        return (self._row(key, value),)
+
+
+class ColumnSource(TableSource):
+    """A table of columns of the same length, such as lists or one dimensional NumPy arrays
+
+    The index of a position maps each key to its row numbers. It is built when the position is first looked up.
+    """
+
+    def __init__(self, columns: Sequence[Sequence]) -> None:
+        if not columns:
+            raise ValueError("At least one column is required")
+        self.columns = list(columns)
+        self.arity = len(self.columns)
+        self.size = len(self.columns[0])
+        if any(len(column) != self.size for column in self.columns):
+            raise ValueError("Columns must have the same length")
+        self._indexes = {}
+
+    def _chunks(self, column: Sequence) -> Iterator[list]:
+        for start in range(0, self.size, CHUNK_SIZE):
+            chunk = column[start : start + CHUNK_SIZE]
+            yield chunk.tolist() if hasattr(chunk, "tolist") else list(chunk)
+
+    def rows(self) -> Iterator[Tuple]:
+        chunks = [self._chunks(column) for column in self.columns]
+        for parts in zip(*chunks):
+            yield from zip(*parts)
+
+    def row(self, i: int) -> Tuple:
+        return tuple(_scalar(column[i]) for column in self.columns)
+
+    def index(self, position: int) -> dict:
+        index = self._indexes.get(position)
+        if index is None:
+            index = {}
+            i = 0
+            for chunk in self._chunks(self.columns[position]):
+                for key in chunk:
+                    index.setdefault(key, []).append(i)
+                    i += 1
+            self._indexes[position] = index
+        return index
+
+    def lookup(self, position: int, key: Any) -> Iterable[Tuple]:
+        return (self.row(i) for i in self.index(position).get(key, ()))
+
+
+# Fact file layout, all integers are little endian:
+#   header: magic, version, arity, number of rows, offset and size of the string table
+#   column types: one byte per column, "q" for int64, "d" for float64, "s" for strings, padded to 8 bytes
+#   columns: one after the other, 8 bytes per row. A string is stored as its index in the string table.
+#   string table: number of strings + 1 offsets (uint64), followed by the UTF-8 text of the strings
+# The strings are sorted, and the rows are sorted by all columns, the first column being the key.
+_FACT_MAGIC = b"PYSWFACT"
+_FACT_VERSION = 1
+_FACT_HEADER = struct.Struct("<8sIIQQQ")
+
+
+class FactFile(TableSource):
+    """A read-only table in a memory mapped fact file, written by :py:func:`write_fact_file`
+
+    The file is shared through the page cache by the processes which open it, and opening it reads only the header.
+    Lookups of the first column are binary searches, lookups of the other columns scan the rows.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        magic, version, arity, size, strings_offset, strings_size = (
+            _FACT_HEADER.unpack_from(buffer)
+        )
+        if magic != _FACT_MAGIC or version != _FACT_VERSION:
+            buffer.release()
+            self._mmap.close()
+            raise ValueError(f"Not a fact file: {path}")
+        self.arity = arity
+        self.size = size
+        offset = _FACT_HEADER.size
+        self.types = bytes(buffer[offset : offset + arity]).decode()
+        offset += _padded(arity)
+        self._columns = []
+        for column_type in self.types:
+            end = offset + 8 * size
+            self._columns.append(
+                buffer[offset:end].cast("q" if column_type == "s" else column_type)
+            )
+            offset = end
+        count = struct.unpack_from("<Q", buffer, strings_offset)[0]
+        offsets_start = strings_offset + 8
+        offsets_end = offsets_start + 8 * (count + 1)
+        self._offsets = buffer[offsets_start:offsets_end].cast("Q")
+        self._text = buffer[offsets_end : strings_offset + strings_size]
+        self._strings = _Strings(self._offsets, self._text)
+        self._buffer = buffer
+
+    def close(self) -> None:
+        for view in (*self._columns, self._offsets, self._text, self._buffer):
+            view.release()
+        self._columns = []
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def row(self, i: int) -> Tuple:
+        strings = self._strings
+        return tuple(
+            strings[column[i]] if column_type == "s" else column[i]
+            for column, column_type in zip(self._columns, self.types)
+        )
+
+    def rows(self) -> Iterator[Tuple]:
+        for i in range(self.size):
+            yield self.row(i)
+
+    def lookup(self, position: int, key: Any) -> Iterable[Tuple]:
+        if position != 0:
+            return super().lookup(position, key)
+        key = self._encode_key(key)
+        if key is None:
+            return ()
+        column = self._columns[0]
+        start = bisect.bisect_left(column, key)
+        end = bisect.bisect_right(column, key, start)
+        return (self.row(i) for i in range(start, end))
+
+    def _encode_key(self, key: Any) -> Optional[Union[int, float]]:
+        key_type = self.types[0] if self.types else None
+        if key_type == "s":
+            if not isinstance(key, str):
+                return None
+            i = bisect.bisect_left(self._strings, key)
+            if i < len(self._strings) and self._strings[i] == key:
+                return i
+            return None
+        if isinstance(key, bool) or not isinstance(key, (int, float)):
+            return None
+        if key_type == "q":
+            return key if isinstance(key, int) else None
+        return float(key)
+
+
+class _Strings:
+    """The string table of a fact file, as a sequence"""
+
+    __slots__ = "_offsets", "_text"
+
+    def __init__(self, offsets: memoryview, text: memoryview) -> None:
+        self._offsets = offsets
+        self._text = text
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self._text[self._offsets[i] : self._offsets[i + 1]], "utf-8")
+
+
+def write_fact_file(
+    path: Union[str, Path], rows: Iterable[Sequence], arity: int
+) -> int:
+    """Writes the rows to a fact file, which can be opened with :py:class:`FactFile`
+
+    The values of a column must be all integers, all numbers or all strings.
+    The rows are sorted with an external merge sort: runs of :py:data:`RUN_SIZE` rows are sorted
+    and spilled to temporary files, which are merged while writing the columns.
+    Only the distinct strings are kept in memory. Returns the number of rows.
+    """
+    with contextlib.ExitStack() as stack:
+        runs = []
+        types = [None] * arity
+        strings = set()
+        size = 0
+        rows = iter(rows)
+        while True:
+            run = [tuple(row) for row in itertools.islice(rows, RUN_SIZE)]
+            if not run:
+                break
+            if any(len(row) != arity for row in run):
+                raise ValueError(f"Rows must have {arity} values")
+            for i in range(arity):
+                types[i] = _merge_column_types(
+                    types[i], _column_type([row[i] for row in run])
+                )
+                if types[i] == "s":
+                    strings.update(row[i] for row in run)
+            run.sort()
+            size += len(run)
+            if len(run) < RUN_SIZE and not runs:
+                runs.append(run)
+                break
+            runs.append(_spill(stack.enter_context(tempfile.TemporaryFile()), run))
+        types = "".join(column_type or "q" for column_type in types)
+        strings = sorted(strings)
+        string_ids = {text: i for i, text in enumerate(strings)}
+        text = [s.encode() for s in strings]
+        offsets = array.array("Q", [0])
+        for t in text:
+            offsets.append(offsets[-1] + len(t))
+        columns_offset = _FACT_HEADER.size + _padded(arity)
+        strings_offset = columns_offset + 8 * arity * size
+        strings_size = 8 + 8 * len(offsets) + offsets[-1]
+        with open(path, "wb") as f:
+            f.write(
+                _FACT_HEADER.pack(
+                    _FACT_MAGIC,
+                    _FACT_VERSION,
+                    arity,
+                    size,
+                    strings_offset,
+                    strings_size,
+                )
+            )
+            f.write(types.encode().ljust(_padded(arity), b"\0"))
+            # each column is written at its own position as the merged rows come in
+            positions = [columns_offset + 8 * size * i for i in range(arity)]
+            merged = heapq.merge(*runs)
+            while True:
+                chunk = list(itertools.islice(merged, CHUNK_SIZE))
+                if not chunk:
+                    break
+                for i, column_type in enumerate(types):
+                    if column_type == "s":
+                        column = array.array("q", [string_ids[row[i]] for row in chunk])
+                    else:
+                        column = array.array(column_type, [row[i] for row in chunk])
+                    f.seek(positions[i])
+                    positions[i] += f.write(column.tobytes())
+            f.seek(strings_offset)
+            f.write(struct.pack("<Q", len(strings)))
+            f.write(offsets.tobytes())
+            for t in text:
+                f.write(t)
+    return size
+
+
+def _spill(f, run: list) -> Iterator[Tuple]:
+    """Writes the sorted run to the file, and returns an iterator which reads it back"""
+    for start in range(0, len(run), CHUNK_SIZE):
+        pickle.dump(run[start : start + CHUNK_SIZE], f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return _unspill(f)
+
+
+def _unspill(f) -> Iterator[Tuple]:
+    while True:
+        try:
+            chunk = pickle.load(f)
+        except EOFError:
+            return
+        yield from chunk
+
+
+def _column_type(values: list) -> str:
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return "q"
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return "d"
+    if all(isinstance(v, str) for v in values):
+        return "s"
+    raise TypeError(
+        "The values of a column must be all integers, all numbers or all strings"
+    )
+
+
+def _merge_column_types(a: Optional[str], b: str) -> str:
+    if a is None or a == b:
+        return b
+    if {a, b} == {"q", "d"}:
+        return "d"
+    raise TypeError(
+        "The values of a column must be all integers, all numbers or all strings"
+    )
+
+
+def _padded(size: int) -> int:
+    return (size + 7) // 8 * 8
+
+
+def table_source(source: Any, arity: int) -> TableSource:
+    """Returns the source as a :py:class:`TableSource`
+
+    The source may be a table source, a mapping, a sequence of ``arity`` columns, or the path of a fact file.
+    """
+    if isinstance(source, TableSource):
+        table = source
+    elif isinstance(source, (str, Path)):
+        table = FactFile(source)
+    elif isinstance(source, Mapping):
+        table = MappingSource(source, arity)
+    elif isinstance(source, (list, tuple)):
+        table = ColumnSource(source)
+    else:
+        raise TypeError(f"Unsupported table source: {type(source)}")
+    if table.arity != arity:
+        raise ValueError(f"The source has {table.arity} columns, expected {arity}")
+    return table
+
+
+def _scalar(value):
+    item = getattr(value, "item", None)
+    return value if item is None else item()
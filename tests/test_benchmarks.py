@@ -0,0 +1,279 @@
+# Copyright (c) 2007-2024 Yüce Tekol and PySwip Contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmarks for the fast paths of the Prolog interface.
+
+These are marked as slow, run them with::
+
+    $ PYTHONPATH=src py.test tests/test_benchmarks.py -m slow -s
+"""
+
+import array
+import timeit
+
+import pytest
+
+from pyswip import (
+    Prolog,
+    Out,
+    PL_foreign_control,
+    PL_foreign_context,
+    PL_retry,
+    PL_FIRST_CALL,
+    PL_PRUNED,
+)
+
+
+def report(name, number, **timings):
+    print()
+    for label, seconds in timings.items():
+        print(f"{name}: {label}: {seconds / number * 1e6:.2f} us/call")
+
+
+@pytest.mark.slow
+def test_once_latency():
+    Prolog.dynamic("bench_once/2")
+    Prolog.assertz("bench_once(1, one)")
+    Prolog.assertz("bench_once(2, two)")
+    number = 20000
+    timings = {
+        "next(query)": timeit.timeit(
+            lambda: next(Prolog.query("bench_once(X, Y)")), number=number
+        ),
+        "once": timeit.timeit(lambda: Prolog.once("bench_once(X, Y)"), number=number),
+        "exists": timeit.timeit(
+            lambda: Prolog.exists("bench_once(X, Y)"), number=number
+        ),
+    }
+    report("once", number, **timings)
+    assert Prolog.once("bench_once(X, Y)") == next(Prolog.query("bench_once(X, Y)"))
+    Prolog.retractall("bench_once(_, _)")
+
+
+@pytest.mark.slow
+def test_predicate_handle_latency():
+    Prolog.dynamic("bench_edge/2")
+    for i in range(100):
+        Prolog.assertz(f"bench_edge({i}, {i + 1})")
+    edge = Prolog.predicate("bench_edge", 2)
+    number = 20000
+    timings = {
+        "once(query)": timeit.timeit(
+            lambda: Prolog.once("bench_edge(50, X)"), number=number
+        ),
+        "predicate.once": timeit.timeit(lambda: edge.once(50, None), number=number),
+    }
+    report("predicate", number, **timings)
+    assert edge.once(50, None) == (50, 51)
+    Prolog.retractall("bench_edge(_, _)")
+
+
+@pytest.mark.slow
+def test_typed_foreign_latency():
+    def bench_plain(x, name, out):
+        out.unify(x / len(name))
+
+    def bench_typed(x: int, name: str, out: Out[float]):
+        out.value = x / len(name)
+
+    Prolog.register_foreign(bench_plain)
+    Prolog.register_foreign(bench_typed, typed=True)
+    number = 20000
+    timings = {
+        "plain": timeit.timeit(
+            lambda: Prolog.once('bench_plain(10, "abcd", S)'), number=number
+        ),
+        "typed": timeit.timeit(
+            lambda: Prolog.once('bench_typed(10, "abcd", S)'), number=number
+        ),
+    }
+    report("foreign", number, **timings)
+    assert Prolog.once('bench_typed(10, "abcd", S)') == {"S": 2.5}
+
+
+@pytest.mark.slow
+def test_generator_foreign_answers():
+    def bench_generated(n, x):
+        for i in range(n):
+            yield n, i
+
+    def bench_retry(n, x, context):
+        control = PL_foreign_control(context)
+        i = 0 if control == PL_FIRST_CALL else PL_foreign_context(context)
+        if control == PL_PRUNED or i >= n:
+            return False
+        x.unify(i)
+        return PL_retry(i + 1)
+
+    Prolog.register_foreign(bench_generated)
+    Prolog.register_foreign(bench_retry, nondeterministic=True)
+    number = 1
+    n = 1_000_000
+    timings = {
+        "PL_retry": timeit.timeit(
+            lambda: Prolog.once(f"aggregate_all(count, bench_retry({n}, _), C)"),
+            number=number,
+        ),
+        "generator": timeit.timeit(
+            lambda: Prolog.once(f"aggregate_all(count, bench_generated({n}, _), C)"),
+            number=number,
+        ),
+    }
+    report(f"{n} answers", number, **timings)
+    assert Prolog.once(f"aggregate_all(count, bench_generated({n}, _), C)") == {"C": n}
+
+
+@pytest.mark.slow
+def test_batched_foreign_latency():
+    def bench_score(x):
+        return x * 0.5
+
+    def bench_element_score(x, score):
+        score.unify(bench_score(x))
+
+    def bench_batch_score(xs):
+        return [bench_score(x) for x in xs]
+
+    Prolog.register_foreign(bench_element_score)
+    Prolog.register_foreign(bench_batch_score, batched=True)
+    n = 100_000
+    number = 1
+    Prolog.once(f"numlist(1, {n}, Xs), nb_setval(bench_items, Xs)")
+    timings = {
+        "maplist": timeit.timeit(
+            lambda: Prolog.exists(
+                "nb_getval(bench_items, Xs), maplist(bench_element_score, Xs, _)"
+            ),
+            number=number,
+        ),
+        "batched": timeit.timeit(
+            lambda: Prolog.exists(
+                "nb_getval(bench_items, Xs), bench_batch_score(Xs, _)"
+            ),
+            number=number,
+        ),
+    }
+    report(f"{n} items", number, **timings)
+    assert Prolog.exists(
+        "nb_getval(bench_items, Xs), maplist(bench_element_score, Xs, S),"
+        "bench_batch_score(Xs, S)"
+    )
+
+
+@pytest.mark.slow
+def test_unify_float_list():
+    items = [i * 0.5 for i in range(1_000_000)]
+    buffer = array.array("d", items)
+
+    def bench_float_list(x):
+        x.unify(items)
+
+    def bench_float_array(x):
+        x.unify(buffer)
+
+    Prolog.register_foreign(bench_float_list)
+    Prolog.register_foreign(bench_float_array)
+    number = 1
+    timings = {
+        "list": timeit.timeit(
+            lambda: Prolog.exists("bench_float_list(X)"), number=number
+        ),
+        "array": timeit.timeit(
+            lambda: Prolog.exists("bench_float_array(X)"), number=number
+        ),
+    }
+    report(f"{len(items)} floats", number, **timings)
+    assert Prolog.exists("bench_float_list(X), bench_float_array(X)")
+
+
+@pytest.mark.slow
+def test_encoder_type_mixes():
+    eq = Prolog.predicate("=", 2)
+    mixes = {
+        "ints": list(range(1000)),
+        "floats": [i * 0.5 for i in range(1000)],
+        "strings": [f"s{i}" for i in range(1000)],
+        "mixed": [1, 2.5, "s", True, b"b", (1, 2)] * 160,
+        "nested": [[i, [i * 0.5, f"s{i}"]] for i in range(300)],
+        "dicts": [{"id": i, "name": f"s{i}", "score": i * 0.5} for i in range(300)],
+    }
+    number = 200
+    timings = {
+        name: timeit.timeit(lambda: eq.exists(value, None), number=number)
+        for name, value in mixes.items()
+    }
+    report("encode", number, **timings)
+
+
+@pytest.mark.slow
+def test_dict_conversion():
+    payload = {
+        f"key{i}": {"id": i, "name": f"n{i}", "score": i * 0.5} for i in range(5000)
+    }
+
+    def bench_dict(x):
+        x.unify(payload)
+
+    Prolog.register_foreign(bench_dict)
+    eq = Prolog.predicate("=", 2)
+    number = 20
+    timings = {
+        "encode": timeit.timeit(lambda: eq.exists(payload, None), number=number),
+        "encode and decode": timeit.timeit(
+            lambda: Prolog.once("bench_dict(X)"), number=number
+        ),
+    }
+    report(f"dict of {len(payload)} keys", number, **timings)
+    decoded = {
+        key: {**value, "name": value["name"].encode()} for key, value in payload.items()
+    }
+    assert Prolog.once("bench_dict(X)") == {"X": decoded}
+
+
+@pytest.mark.slow
+def test_keyed_table_throughput():
+    sessions = Prolog.keyed_table("bench_session", arity=2)
+    Prolog.dynamic("bench_naive_session/2")
+    sessions.bulk_upsert((f"s{i}", 0) for i in range(10000))
+    for i in range(10000):
+        Prolog.assertz("bench_naive_session(%p, 0)", f"s{i}")
+    keys = [f"s{i}" for i in range(0, 10000, 7)]
+
+    def naive():
+        for key in keys:
+            Prolog.retractall("bench_naive_session(%p, _)", key)
+            Prolog.assertz("bench_naive_session(%p, 1)", key)
+
+    def keyed():
+        for key in keys:
+            sessions.upsert(key, 1)
+
+    number = 5
+    timings = {
+        "retractall + assertz": timeit.timeit(naive, number=number),
+        "upsert": timeit.timeit(keyed, number=number),
+        "bulk_upsert": timeit.timeit(
+            lambda: sessions.bulk_upsert((key, 2) for key in keys), number=number
+        ),
+        "get": timeit.timeit(lambda: [sessions.get(k) for k in keys], number=number),
+    }
+    report(f"keyed table, {len(keys)} updates", number * len(keys), **timings)
+    assert sessions.get("s7") == ("s7", 2)
@@ -1,5 +1,8 @@
+import array
 import unittest
 
+import pyswip.objects
+
 from pyswip import (
     Prolog,
     registerForeign,
@@ -10,8 +13,14 @@ from pyswip import (
     PL_PRUNED,
     PL_retry,
     PL_FA_NONDETERMINISTIC,
+    PL_INTEGER,
+    PL_FLOAT,
     Variable,
+    Atom,
+    Out,
+    ObjectRef,
 )
+from pyswip.prolog import PrologError
 
 
 class MyTestCase(unittest.TestCase):
@@ -102,6 +111,245 @@ class MyTestCase(unittest.TestCase):
                 {"X": i} in result, "Expected result  X:{} not present".format(i)
             )
 
+    def test_raw_foreign(self):
+        def raw_add(a, b, result):
+            return result.unify(a.get_int() + b.get_int())
+
+        def raw_describe(t, kind):
+            if t.is_variable():
+                return kind.unify("var")
+            if t.type == PL_INTEGER:
+                return kind.unify(t.get_int())
+            if t.type == PL_FLOAT:
+                return kind.unify(t.get_float())
+            return kind.unify(t.get_str())
+
+        def raw_same(a, b):
+            return b.unify(a)
+
+        Prolog.register_foreign(raw_add, raw=True)
+        Prolog.register_foreign(raw_describe, raw=True)
+        Prolog.register_foreign(raw_same, raw=True)
+
+        self.assertEqual([{"X": 3}], list(Prolog.query("raw_add(1, 2, X)")))
+        self.assertEqual([], list(Prolog.query("raw_add(1, 2, 4)")))
+        self.assertEqual(
+            # str values are unified as Prolog strings, which are returned as bytes
+            [{"A": b"var", "B": 42, "C": 1.5, "D": b"foo", "E": b"bar"}],
+            list(
+                Prolog.query(
+                    "raw_describe(_, A), raw_describe(42, B), raw_describe(1.5, C),"
+                    'raw_describe(foo, D), raw_describe("bar", E)'
+                )
+            ),
+        )
+        self.assertEqual(
+            [{"X": ["a", "b"]}], list(Prolog.query("raw_same(f([a, b]), f(X))"))
+        )
+
+    def test_raw_foreign_type_error(self):
+        def raw_int(a):
+            a.get_int()
+
+        Prolog.register_foreign(raw_int, raw=True)
+        self.assertEqual([{}], list(Prolog.query("raw_int(1)")))
+        # exceptions raised in the callback make the predicate fail
+        self.assertEqual([], list(Prolog.query("raw_int(foo)")))
+
+    def test_typed_foreign(self):
+        def typed_score(x: int, name: str, out: Out[float]):
+            out.value = x / len(name)
+
+        def typed_describe(flag: bool, atom: Atom, term, out: Out[str], size: Out[int]):
+            out.value = f"{flag}:{atom.value}"
+            size.value = len(term)
+
+        def typed_unset(out: Out[int]):
+            pass
+
+        Prolog.register_foreign(typed_score, typed=True)
+        Prolog.register_foreign(typed_describe, typed=True)
+        Prolog.register_foreign(typed_unset, typed=True)
+
+        self.assertEqual([{"S": 2.5}], list(Prolog.query('typed_score(10, "abcd", S)')))
+        self.assertEqual([{"S": 5.0}], list(Prolog.query("typed_score(10, ab, S)")))
+        self.assertEqual([], list(Prolog.query("typed_score(10, ab, 1.0)")))
+        self.assertEqual(
+            [{"D": b"True:foo", "N": 3}],
+            list(Prolog.query("typed_describe(true, foo, [1, 2, 3], D, N)")),
+        )
+        self.assertEqual([{}], list(Prolog.query("typed_unset(X), var(X)")))
+
+    def test_typed_foreign_type_error(self):
+        def typed_double(x: int, out: Out[int]):
+            out.value = x * 2
+
+        Prolog.register_foreign(typed_double, typed=True)
+        self.assertEqual([{"Y": 42}], list(Prolog.query("typed_double(21, Y)")))
+        with self.assertRaises(PrologError) as cm:
+            list(Prolog.query("typed_double(foo, Y)"))
+        self.assertIn("type_error", str(cm.exception))
+        self.assertEqual(
+            [{"E": "integer"}],
+            list(
+                Prolog.query(
+                    "catch(typed_double(foo, _), error(type_error(E, foo), _), true)"
+                )
+            ),
+        )
+
+    def test_typed_and_raw(self):
+        def typed_raw(x: int):
+            pass
+
+        with self.assertRaises(ValueError):
+            Prolog.register_foreign(typed_raw, typed=True, raw=True)
+
+    def test_generator_foreign(self):
+        def gen_pairs(n, x, y):
+            for i in range(n):
+                yield n, i, i * i
+
+        def gen_letters(c):
+            yield from "abc"
+
+        def gen_empty(x):
+            yield from ()
+
+        Prolog.register_foreign(gen_pairs)
+        Prolog.register_foreign(gen_letters)
+        Prolog.register_foreign(gen_empty)
+
+        self.assertEqual(
+            [{"X": 0, "Y": 0}, {"X": 1, "Y": 1}, {"X": 2, "Y": 4}],
+            list(Prolog.query("gen_pairs(3, X, Y)")),
+        )
+        self.assertEqual([{"X": 2}], list(Prolog.query("gen_pairs(3, X, 4)")))
+        self.assertEqual([], list(Prolog.query("gen_pairs(3, X, 5)")))
+        # yielded str values are unified as Prolog strings
+        self.assertEqual(
+            [{"C": b"a"}, {"C": b"b"}, {"C": b"c"}],
+            list(Prolog.query("gen_letters(C)")),
+        )
+        self.assertEqual([{}], list(Prolog.query('gen_letters("c")')))
+        self.assertEqual([], list(Prolog.query("gen_empty(X)")))
+
+    def test_generator_foreign_cut(self):
+        closed = []
+
+        def gen_naturals(x):
+            try:
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            finally:
+                closed.append(True)
+
+        Prolog.register_foreign(gen_naturals)
+        self.assertEqual([{"X": 5}], list(Prolog.query("gen_naturals(X), X > 4, !")))
+        self.assertEqual([True], closed)
+        self.assertEqual({"X": 0}, Prolog.once("gen_naturals(X)"))
+        self.assertEqual([True, True], closed)
+
+    def test_generator_foreign_raw(self):
+        def gen_raw_upto(n, x):
+            for i in range(n.get_int()):
+                yield n, i
+
+        Prolog.register_foreign(gen_raw_upto, raw=True)
+        self.assertEqual([{"X": 0}, {"X": 1}], list(Prolog.query("gen_raw_upto(2, X)")))
+
+    def test_batched_foreign(self):
+        def batch_score(xs, names):
+            return [x / len(name) for x, name in zip(xs, names)]
+
+        def batch_double(xs):
+            return array.array("q", (x * 2 for x in xs))
+
+        def batch_check(xs):
+            return (x > 0 for x in xs)
+
+        Prolog.register_foreign(batch_score, batched=True)
+        Prolog.register_foreign(batch_double, batched=True)
+        Prolog.register_foreign(batch_check, batched=True)
+
+        self.assertEqual(
+            {"S": [5.0, 5.0]}, Prolog.once("batch_score([10, 20], [ab, abcd], S)")
+        )
+        self.assertEqual({"S": []}, Prolog.once("batch_score([], [], S)"))
+        self.assertEqual({"Y": [2, 4, 6]}, Prolog.once("batch_double([1, 2, 3], Y)"))
+        self.assertTrue(Prolog.exists("batch_double([1, 2, 3], [2, 4, 6])"))
+        self.assertFalse(Prolog.exists("batch_double([1, 2, 3], [2, 4, 7])"))
+        self.assertEqual(
+            {"Y": ["true", "false"]}, Prolog.once("batch_check([1, -1], Y)")
+        )
+        with self.assertRaises(PrologError):
+            Prolog.once("batch_double(foo, Y)")
+
+    def test_batched_foreign_atoms(self):
+        received = []
+
+        def batch_lengths(names):
+            received.extend(names)
+            return [len(name) for name in names]
+
+        Prolog.register_foreign(batch_lengths, batched=True)
+        self.assertEqual({"N": [2, 4]}, Prolog.once("batch_lengths([ab, abcd], N)"))
+        self.assertEqual(["ab", "abcd"], received)
+
+    def test_batched_foreign_invalid(self):
+        def batch_gen(xs):
+            yield xs
+
+        with self.assertRaises(ValueError):
+            Prolog.register_foreign(batch_gen, batched=True)
+
+    def test_unify_buffers(self):
+        def buffer_floats(x):
+            x.unify(array.array("d", [0.5, 1.5]))
+
+        def buffer_ints(x):
+            x.unify(array.array("Q", [1, 2**64 - 1]))
+
+        def buffer_bytes(x, y, z):
+            x.unify(b"abc")
+            y.unify(bytearray(b"de"))
+            z.unify(memoryview(b"xfgx")[1:3])
+
+        def buffer_nested(x):
+            x.unify([array.array("i", [1, 2]), "s", b"b"])
+
+        Prolog.register_foreign(buffer_floats)
+        Prolog.register_foreign(buffer_ints)
+        Prolog.register_foreign(buffer_bytes)
+        Prolog.register_foreign(buffer_nested)
+
+        self.assertEqual({"X": [0.5, 1.5]}, Prolog.once("buffer_floats(X)"))
+        self.assertTrue(Prolog.exists(f"buffer_ints(X), X == [1, {2**64 - 1}]"))
+        self.assertTrue(
+            Prolog.exists('buffer_bytes(X, Y, Z), X == "abc", Y == "de", Z == "fg"')
+        )
+        self.assertTrue(Prolog.exists('buffer_nested(X), X == [[1, 2], "s", "b"]'))
+        self.assertFalse(Prolog.exists("buffer_floats([0.5, 2.5])"))
+
+    def test_unify_encoding(self):
+        def encode_values(a, b, c, d, e):
+            a.unify((1, "s"))
+            b.unify({"k": 1.5, "a": Atom("x")})
+            c.unify(2**70)
+            d.unify(True)
+            e.unify(["n", 1.0, [False]])
+
+        Prolog.register_foreign(encode_values)
+        self.assertTrue(
+            Prolog.exists(
+                "encode_values(A, B, C, D, E), "
+                'A == [1, "s"], get_dict(k, B, 1.5), get_dict(a, B, x), '
+                'C =:= 2**70, D == true, E == ["n", 1.0, [false]]'
+            )
+        )
+
     def test_atoms_and_strings_distinction(self):
         test_string = "string"
 
@@ -167,6 +415,77 @@ class MyTestCase(unittest.TestCase):
             "Nested Dictionary should be returned as a nested dictionary object",
         )
 
+    def test_dictionary_integer_keys(self):
+        result = Prolog.once("X = _{1: one, 2: two, key: [1, 2]}")
+        self.assertEqual({1: "one", 2: "two", "key": [1, 2]}, result["X"])
+
+    def test_dictionary_roundtrip(self):
+        payload = {f"key{i}": {"id": i, "tags": [f"t{i}"]} for i in range(2000)}
+        payload["héllo"] = 1.5
+
+        def dict_payload(x):
+            x.unify(payload)
+
+        Prolog.register_foreign(dict_payload)
+        self.assertTrue(
+            Prolog.exists(
+                'dict_payload(X), get_dict(key42, X, _{id: 42, tags: ["t42"]})'
+            )
+        )
+        # str values are unified as Prolog strings, which are decoded as bytes
+        decoded = {
+            f"key{i}": {"id": i, "tags": [f"t{i}".encode()]} for i in range(2000)
+        }
+        decoded["héllo"] = 1.5
+        self.assertEqual({"X": decoded}, Prolog.once("dict_payload(X)"))
+        self.assertEqual(
+            {"X": {"s": b"text", "a": "atom", "l": [b"x", [b"y"]]}},
+            Prolog.once('X = _{s: "text", a: atom, l: ["x", ["y"]]}'),
+        )
+
+    def test_object_references(self):
+        features = [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+        seen = []
+
+        def obj_rows(matrix, n):
+            seen.append(matrix)
+            n.unify(len(matrix))
+
+        def obj_make(x):
+            x.unify(ObjectRef({"answer": 42}))
+
+        def obj_answer(d, x):
+            x.unify(d["answer"])
+
+        Prolog.register_foreign(obj_rows)
+        Prolog.register_foreign(obj_make)
+        Prolog.register_foreign(obj_answer)
+
+        set_value = Prolog.predicate("nb_setval", 2)
+        set_value.once("pyswip_features", ObjectRef(features))
+        result = Prolog.once("nb_getval(pyswip_features, M), obj_rows(M, N)")
+        self.assertEqual(3, result["N"])
+        self.assertIs(features, seen[0])
+        self.assertTrue(
+            Prolog.exists("nb_getval(pyswip_features, M), blob(M, python_object)")
+        )
+        self.assertEqual(42, Prolog.once("obj_make(D), obj_answer(D, A)")["A"])
+        # the same object is passed as the same blob
+        self.assertTrue(
+            Prolog.predicate("==", 2).exists(ObjectRef(features), ObjectRef(features))
+        )
+        with self.assertRaises(TypeError):
+            Prolog.once("obj_rows(%p, N)", ObjectRef(features))
+
+    def test_object_references_released(self):
+        objects = pyswip.objects.registry
+        Prolog.once("garbage_collect_atoms")
+        live = len(objects)
+        Prolog.predicate("nb_setval", 2).once("pyswip_released", ObjectRef(object()))
+        self.assertEqual(live + 1, len(objects))
+        Prolog.once("nb_setval(pyswip_released, []), garbage_collect_atoms")
+        self.assertEqual(live, len(objects))
+
 
 if __name__ == "__main__":
     unittest.main()
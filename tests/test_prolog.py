@@ -26,13 +26,32 @@
 Tests the Prolog class.
 """
 
+import array
+import asyncio
+import gc
 import os.path
+import tempfile
+import threading
 import unittest
 
 import pytest
 
 from pyswip import Atom, Variable
-from pyswip.prolog import Prolog, NestedQueryError, format_prolog
+from pyswip.tables import FactFile, write_fact_file
+from pyswip.prolog import (
+    Prolog,
+    PrologError,
+    QueryTimeout,
+    InferenceLimitExceeded,
+    QueryCancelled,
+    CancelToken,
+    format_prolog,
+    compile_select,
+    template_variables,
+    parse_aggregate,
+    with_limits,
+    _table_modules,
+)
 
 
 class TestProlog(unittest.TestCase):
@@ -43,11 +62,11 @@ class TestProlog(unittest.TestCase):
     def test_nested_queries(self):
         """
         SWI-Prolog cannot have nested queries called by the foreign function
-        interface, that is, if we open a query and are getting results from it,
-        we cannot open another query before closing that one.
+        interface on the same engine, that is, if we open a query and are getting
+        results from it, we cannot open another query before closing that one.
 
-        Since this is a user error, we just ensure that a appropriate error
-        message is thrown.
+        PySwip runs the nested query on a temporary engine, so the outer query
+        can be iterated lazily.
         """
 
         # Add something to the base
@@ -64,12 +83,31 @@ class TestProlog(unittest.TestCase):
         for _ in Prolog.query(otherquery):
             pass
 
-        with self.assertRaises(NestedQueryError):
-            for q in Prolog.query(somequery):
-                for j in Prolog.query(otherquery):
-                    # This should throw an error, because I opened the second
-                    # query
-                    pass
+        result = []
+        for q in Prolog.query(somequery):
+            for j in Prolog.query(otherquery):
+                result.append((q["Y"], j["X"]))
+            self.assertTrue(Prolog.exists(otherquery))
+        self.assertEqual([("mich", "jane"), ("gina", "jane")], result)
+
+    def test_interleaved_queries(self):
+        outer = Prolog.query("member(X, [1, 2, 3])")
+        inner = Prolog.query("member(Y, [a, b, c])")
+        result = [(o["X"], i["Y"]) for o, i in zip(outer, inner)]
+        self.assertEqual([(1, "a"), (2, "b"), (3, "c")], result)
+        inner.close()
+        self.assertEqual([{"Z": 1}], list(Prolog.query("Z = 1")))
+
+    def test_nested_query_in_foreign(self):
+        Prolog.assertz("nested_parent(john, mich)")
+        Prolog.assertz("nested_parent(john, gina)")
+
+        def nested_children(parent, count):
+            count.value = len(list(Prolog.query("nested_parent(%p, _)", parent)))
+
+        Prolog.register_foreign(nested_children)
+        result = list(Prolog.query("nested_children(john, N)"))
+        self.assertEqual([{"N": 2}], result)
 
     def test_prolog_functor_in_list(self):
         Prolog.assertz("f([g(a,b),h(a,b,c)])")
@@ -131,6 +169,685 @@ class TestProlog(unittest.TestCase):
         result = list(Prolog.query("user(%p,IDs)", joe))
         self.assertEqual([{"IDs": [1, 2, 3]}], result)
 
+    def test_once(self):
+        Prolog.dynamic("once_fact/1")
+        Prolog.assertz("once_fact(1)")
+        Prolog.assertz("once_fact(2)")
+        self.assertEqual({"X": 1}, Prolog.once("once_fact(X)"))
+        self.assertEqual({"X": 2}, Prolog.once("once_fact(X), X > %p", 1))
+        self.assertIsNone(Prolog.once("once_fact(3)"))
+        self.assertEqual({}, Prolog.once("once_fact(1)"))
+        with self.assertRaises(PrologError):
+            Prolog.once("atom_length(X, _)")
+        # the query must be closed after once
+        self.assertEqual([{"X": 1}, {"X": 2}], list(Prolog.query("once_fact(X)")))
+        Prolog.retractall("once_fact(_)")
+
+    def test_exists(self):
+        Prolog.dynamic("exists_fact/1")
+        Prolog.assertz("exists_fact(1)")
+        self.assertTrue(Prolog.exists("exists_fact(1)"))
+        self.assertTrue(Prolog.exists("exists_fact(%p)", 1))
+        self.assertFalse(Prolog.exists("exists_fact(2)"))
+        with self.assertRaises(PrologError):
+            Prolog.exists("atom_length(X, _)")
+        Prolog.retractall("exists_fact(_)")
+
+    def test_predicate(self):
+        Prolog.assertz("pred_graph:edge(a, b)")
+        Prolog.assertz("pred_graph:edge(a, c)")
+        Prolog.assertz("pred_graph:edge(b, c)")
+        edge = Prolog.predicate("edge", 2, module="pred_graph")
+        self.assertIs(edge, Prolog.predicate("edge", 2, module="pred_graph"))
+        self.assertEqual([("a", "b"), ("a", "c")], list(edge("a", None)))
+        self.assertEqual([("a", "c"), ("b", "c")], list(edge(None, "c")))
+        self.assertEqual([("a", "b")], list(edge(None, None, maxresult=1)))
+        self.assertEqual(("b", "c"), edge.once("b", None))
+        self.assertIsNone(edge.once("c", None))
+        self.assertTrue(edge.exists("a", "c"))
+        self.assertFalse(edge.exists("c", "a"))
+        with self.assertRaises(ValueError):
+            edge.once("a")
+
+    def test_predicate_variable(self):
+        Prolog.assertz("pred_number(42)")
+        pred_number = Prolog.predicate("pred_number", 1)
+        x = Variable()
+        self.assertTrue(pred_number.exists(x))
+
+    def test_predicate_error(self):
+        atom_length = Prolog.predicate("atom_length", 2)
+        with self.assertRaises(PrologError):
+            atom_length.once(None, None)
+
+    def test_predicate_buffers(self):
+        string_length = Prolog.predicate("string_length", 2)
+        self.assertEqual(3, string_length.once(b"abc", None)[1])
+        self.assertEqual(2, string_length.once(bytearray(b"de"), None)[1])
+        self.assertEqual(2, string_length.once(memoryview(b"xfgx")[1:3], None)[1])
+        sum_list = Prolog.predicate("sum_list", 2)
+        self.assertEqual(6, sum_list.once(array.array("i", [1, 2, 3]), None)[1])
+        self.assertEqual(2.0, sum_list.once(array.array("d", [0.5, 1.5]), None)[1])
+
+    def test_predicate_encoding(self):
+        to_atom = Prolog.predicate("term_to_atom", 2)
+        self.assertTrue(to_atom.exists(1.5, "1.5"))
+        # booleans are put as integers, like putTerm always did
+        self.assertTrue(to_atom.exists(True, "1"))
+        self.assertTrue(to_atom.exists(False, "0"))
+        self.assertTrue(to_atom.exists(2**70, str(2**70)))
+        self.assertTrue(to_atom.exists(-(2**70), str(-(2**70))))
+        self.assertTrue(to_atom.exists((1, "a", [2.5]), "[1,a,[2.5]]"))
+        self.assertTrue(to_atom.exists(b"ab", '"ab"'))
+        self.assertEqual(5, Prolog.predicate("atom_length", 2).once("héllo", None)[1])
+        get_dict = Prolog.predicate("get_dict", 3)
+        self.assertTrue(get_dict.exists("b", {"a": 1, "b": (2, 3)}, [2, 3]))
+        self.assertTrue(get_dict.exists(1, {1: "x"}, "x"))
+        self.assertTrue(get_dict.exists("k", {"k": {"n": 1}}, {"n": 1}))
+        self.assertFalse(get_dict.exists("c", {"a": 1}, None))
+        with self.assertRaises(TypeError):
+            to_atom.exists(object(), None)
+
+    def test_register_table_mapping(self):
+        prices = {"apple": 1.5, "pear": 2.0, "plum": 2.0}
+        Prolog.register_table("table_price", 2, prices)
+        self.assertEqual({"P": 2.0}, Prolog.once("table_price(pear, P)"))
+        self.assertEqual({"P": 1.5}, Prolog.once('table_price("apple", P)'))
+        self.assertIsNone(Prolog.once("table_price(kiwi, P)"))
+        self.assertIsNone(Prolog.once('table_price("kiwi", P)'))
+        self.assertEqual(
+            [{"F": "pear"}, {"F": "plum"}], list(Prolog.query("table_price(F, 2.0)"))
+        )
+        self.assertEqual(3, Prolog.count("table_price(_, _)"))
+        prices["kiwi"] = 3.0
+        self.assertEqual({"P": 3.0}, Prolog.once("table_price(kiwi, P)"))
+
+    def test_register_table_columns(self):
+        ids = array.array("q", [3, 1, 2, 1])
+        names = ["c", "a", "b", "a2"]
+        Prolog.register_table(
+            "table_item", 3, [ids, names, [0.5, 1.5, 2.5, 3.5]], index=[0, 1]
+        )
+        self.assertEqual(
+            [{"N": "a", "S": 1.5}, {"N": "a2", "S": 3.5}],
+            list(Prolog.query("table_item(1, N, S)")),
+        )
+        self.assertEqual({"I": 2, "S": 2.5}, Prolog.once("table_item(I, b, S)"))
+        self.assertEqual(4, Prolog.count("table_item(_, _, _)"))
+        self.assertTrue(Prolog.exists("table_item(3, c, 0.5), !"))
+        with self.assertRaises(ValueError):
+            Prolog.register_table("table_item", 3, [ids, names])
+        with self.assertRaises(ValueError):
+            Prolog.register_table("table_item", 2, [ids, names], index=[2])
+
+    def test_register_table_fact_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "edges.facts")
+            write_fact_file(path, [("a", "b"), ("a", "c"), ("b", "c")], 2)
+            facts = FactFile(path)
+            Prolog.register_table("table_edge", 2, facts)
+            self.assertEqual(
+                [{"X": "b"}, {"X": "c"}], list(Prolog.query("table_edge(a, X)"))
+            )
+            self.assertEqual(
+                [{"X": "a"}, {"X": "b"}], list(Prolog.query("table_edge(X, c)"))
+            )
+            self.assertFalse(Prolog.exists("table_edge(c, _)"))
+
+    def test_snapshot(self):
+        Prolog.dynamic("snap_stock/2")
+        Prolog.assertz("snap_stock(apple, 3)")
+        with Prolog.snapshot() as s:
+            s.retract("snap_stock(apple, _)")
+            s.assertz("snap_stock(apple, %p)", 0)
+            s.assertz("snap_stock(pear, 5)")
+            self.assertEqual(3, len(s))
+            self.assertEqual(
+                [{"F": "apple", "N": 0}, {"F": "pear", "N": 5}],
+                list(s.query("snap_stock(F, N)")),
+            )
+            self.assertEqual({"N": 5}, s.once("snap_stock(pear, N)"))
+            self.assertTrue(s.exists("snap_stock(apple, 0)"))
+            raw = list(s.query("snap_stock(F, N)", normalize=False))
+            self.assertEqual(
+                [["F", "N"]] * 2, [[str(b.args[0].value) for b in r] for r in raw]
+            )
+            self.assertEqual("pear", raw[1][0].args[1].value)
+            self.assertEqual(5, raw[1][1].args[1])
+            raw = s.once("snap_stock(pear, N)", normalize=False)
+            self.assertEqual(5, raw[0].args[1])
+            self.assertEqual([], list(s.query("snap_stock(kiwi, _)", normalize=False)))
+            # the updates are not visible outside the snapshot
+            self.assertEqual(
+                [{"F": "apple", "N": 3}], list(Prolog.query("snap_stock(F, N)"))
+            )
+        self.assertEqual(0, len(s))
+        self.assertEqual(
+            [{"F": "apple", "N": 3}], list(Prolog.query("snap_stock(F, N)"))
+        )
+        Prolog.retractall("snap_stock(_, _)")
+
+    def test_snapshot_streaming(self):
+        Prolog.dynamic("snap_seen/1")
+        with Prolog.snapshot() as s:
+            # the solutions are fetched one at a time
+            solutions = s.query("between(1, inf, X)")
+            self.assertEqual([1, 2, 3], [next(solutions)["X"] for _ in range(3)])
+            # the updates made while a query is open are applied once
+            for i in range(1000):
+                s.assertz("snap_seen(%p)", i)
+            self.assertEqual({"X": 4}, next(solutions))
+            self.assertEqual(
+                {"N": 1000}, s.once("aggregate_all(count, snap_seen(_), N)")
+            )
+            # a nested query is stopped when the outer query is advanced
+            nested = s.query("snap_seen(X)")
+            self.assertEqual({"X": 0}, next(nested))
+            self.assertEqual({"X": 5}, next(solutions))
+            self.assertEqual([], list(nested))
+            solutions.close()
+            self.assertTrue(s.exists("snap_seen(999)"))
+            with self.assertRaises(PrologError):
+                list(s.query("snap_undefined(_)"))
+            # the snapshot is still usable after an error
+            self.assertTrue(s.exists("snap_seen(0)"))
+            s.rollback()
+            self.assertFalse(s.exists("snap_seen(_)"))
+        self.assertFalse(Prolog.exists("snap_seen(_)"))
+
+    def test_transaction(self):
+        Prolog.dynamic("trans_stock/2")
+        with Prolog.transaction() as t:
+            t.assertz("trans_stock(apple, 3)")
+            t.assertz("trans_stock(pear, 5)")
+            self.assertEqual(2, len(list(t.query("trans_stock(_, _)"))))
+            self.assertFalse(Prolog.exists("trans_stock(_, _)"))
+        self.assertEqual(2, Prolog.count("trans_stock(_, _)"))
+        with self.assertRaises(RuntimeError):
+            with Prolog.transaction() as t:
+                t.retractall("trans_stock(_, _)")
+                raise RuntimeError
+        self.assertEqual(2, Prolog.count("trans_stock(_, _)"))
+        Prolog.retractall("trans_stock(_, _)")
+
+    def test_replace_predicate(self):
+        Prolog.dynamic("hot_rate/2")
+        Prolog.assertz("hot_rate(usd, 1.0)")
+        self.assertEqual(
+            2, Prolog.replace_predicate("hot_rate/2", [("usd", 1.1), ("eur", 0.9)])
+        )
+        self.assertEqual(
+            [{"C": "usd", "R": 1.1}, {"C": "eur", "R": 0.9}],
+            list(Prolog.query("hot_rate(C, R)")),
+        )
+        # a running query keeps the facts it started with
+        running = Prolog.query("hot_rate(C, R)")
+        self.assertEqual({"C": "usd", "R": 1.1}, next(running))
+        rows = ((f"c{i}", float(i)) for i in range(10000))
+        self.assertEqual(10000, Prolog.replace_predicate("hot_rate / 2", rows))
+        self.assertEqual([{"C": "eur", "R": 0.9}], list(running))
+        self.assertEqual(10000, Prolog.count("hot_rate(_, _)"))
+        self.assertEqual({"R": 42.0}, Prolog.once("hot_rate(c42, R)"))
+        self.assertEqual(0, Prolog.replace_predicate("hot_rate/2", []))
+        self.assertFalse(Prolog.exists("hot_rate(_, _)"))
+        # the previous generation is kept for the queries redirected before the swap
+        cleared, previous, current = Prolog._replaced["user", "hot_rate", 2]
+        self.assertEqual(10000, Prolog.count(f"{previous}:hot_rate(_, _)"))
+        self.assertEqual(0, Prolog.count(f"{cleared}:hot_rate(_, _)"))
+        with self.assertRaises(ValueError):
+            Prolog.replace_predicate("hot_rate", [])
+        with self.assertRaises(ValueError):
+            Prolog.replace_predicate("hot_rate/2", [("usd",)])
+        self.assertEqual(0, Prolog.count("hot_rate(_, _)"))
+        # the shadow modules are reused, so repeated replacements don't add modules
+        for i in range(10):
+            self.assertEqual(1, Prolog.replace_predicate("hot_rate/2", [("usd", i)]))
+        self.assertEqual({"R": 9}, Prolog.once("hot_rate(usd, R)"))
+        self.assertEqual(
+            3,
+            Prolog.count(
+                "current_module(M), sub_atom(M, 0, _, _, pyswip_shadow_), "
+                "current_predicate(M:hot_rate/2)"
+            ),
+        )
+
+    def test_keyed_table(self):
+        sessions = Prolog.keyed_table("kv_session", arity=3, key=1)
+        self.assertEqual("user:kv_session/3", str(sessions))
+        sessions.upsert(1, "s1", "active")
+        sessions.upsert(2, "s2", "active")
+        sessions.upsert(1, "s1", "closed")
+        self.assertEqual(2, len(sessions))
+        self.assertEqual((1, "s1", "closed"), sessions.get("s1"))
+        self.assertIsNone(sessions.get("s3"))
+        self.assertEqual("missing", sessions.get("s3", "missing"))
+        self.assertIn("s2", sessions)
+        self.assertTrue(sessions.delete("s2"))
+        self.assertFalse(sessions.delete("s2"))
+        self.assertNotIn("s2", sessions)
+        self.assertEqual(
+            5000,
+            sessions.bulk_upsert((i, f"s{i % 2500}", "bulk") for i in range(5000)),
+        )
+        self.assertEqual(2500, len(sessions))
+        self.assertEqual((2501, "s1", "bulk"), sessions.get("s1"))
+        self.assertTrue(Prolog.exists("kv_session(4999, s2499, bulk)"))
+        with self.assertRaises(ValueError):
+            sessions.upsert(1, "s1")
+        with self.assertRaises(ValueError):
+            Prolog.keyed_table("kv_session", arity=2, key=2)
+        Prolog.retractall("kv_session(_, _, _)")
+
+    def test_change_feed(self):
+        Prolog.dynamic("feed_session/2")
+        Prolog.assertz("feed_session(s0, active)")
+        feed = Prolog.changes("feed_session/2", "feed_other/1")
+        self.assertEqual(("user:feed_session/2", "user:feed_other/1"), feed.predicates)
+        Prolog.assertz("feed_session(s1, active)")
+        Prolog.retract("feed_session(s0, active)")
+        Prolog.assertz("feed_unwatched(1)")
+        # updates made by Prolog code are included
+        Prolog.exists("assertz(feed_other(x))")
+        self.assertEqual(3, len(feed))
+        batch = feed.poll()
+        self.assertEqual(
+            {"user:feed_session/2", "user:feed_other/1"}, set(batch.keys())
+        )
+        self.assertEqual(
+            ["assert", "retract"],
+            [action for action, _ in batch["user:feed_session/2"]],
+        )
+        self.assertEqual(("assert", ("s1", "active")), batch["user:feed_session/2"][0])
+        self.assertEqual({}, feed.poll())
+
+        received = []
+        feed.subscribe(lambda indicator, events: received.append((indicator, events)))
+        Prolog.retractall("feed_other(_)")
+        self.assertEqual(1, feed.flush())
+        self.assertEqual("user:feed_other/1", received[0][0])
+
+        async def collect():
+            batches = []
+            Prolog.assertz("feed_other(y)")
+            async for batch in feed:
+                batches.append(batch)
+                feed.close()
+            return batches
+
+        self.assertEqual(
+            [{"user:feed_other/1": [("assert", ("y",))]}],
+            asyncio.run(collect()),
+        )
+        self.assertTrue(feed.closed)
+        Prolog.assertz("feed_session(s2, active)")
+        self.assertEqual(0, len(feed))
+        with self.assertRaises(ValueError):
+            Prolog.changes("feed_session")
+        with self.assertRaises(ValueError):
+            Prolog.changes("feed_session/2", maxlen=0)
+
+        # the events over the limit are dropped and counted
+        with Prolog.changes("feed_session/2", maxlen=2, normalize=False) as bounded:
+            for i in range(3):
+                Prolog.assertz("feed_session(%p, %p)", i, "active")
+            self.assertEqual(2, len(bounded))
+            events = bounded.poll()["user:feed_session/2"]
+            self.assertEqual(1, bounded.dropped)
+            self.assertEqual([0, 1], [row[0] for _, row in events])
+            # strings are not converted to atoms in raw mode
+            self.assertEqual(b"active", events[0][1][1])
+
+        # a feed which is not closed stops listening when it is garbage collected
+        feed_id = Prolog.changes("feed_session/2").id
+        gc.collect()
+        self.assertFalse(
+            Prolog.exists("pyswip_feed_predicate(%p, _, _, _, _)", feed_id)
+        )
+        Prolog.retractall("feed_session(_, _)")
+        Prolog.retractall("feed_other(_)")
+
+    def test_materialize(self):
+        Prolog.dynamic("mv_edge/2")
+        Prolog.assertz("mv_edge(a, b)")
+        Prolog.assertz("mv_reach(X, Y) :- mv_edge(X, Y)")
+        Prolog.assertz("mv_reach(X, Y) :- mv_edge(X, Z), mv_reach(Z, Y)")
+        view = Prolog.materialize(
+            "mv_reach(%p, Y)", Atom("a"), depends_on=["mv_edge/2"]
+        )
+        self.assertEqual(("Y",), view.names)
+        # mv_reach/2 is not a dependency, so the goal runs again on updates
+        self.assertFalse(view.incremental)
+        self.assertEqual(frozenset({("b",)}), view.rows)
+        self.assertEqual(1, view.refresh_count)
+        changes = []
+        view.subscribe(lambda added, removed: changes.append((added, removed)))
+        # reading without updates does not run the goal again
+        self.assertIn(("b",), view)
+        self.assertEqual(1, view.refresh_count)
+        Prolog.assertz("mv_edge(b, c)")
+        self.assertEqual(2, len(view))
+        self.assertEqual(2, view.refresh_count)
+        self.assertEqual([(frozenset({("c",)}), frozenset())], changes)
+        self.assertGreaterEqual(view.max_latency, view.last_latency)
+        Prolog.retract("mv_edge(a, b)")
+        self.assertEqual(set(), set(view))
+        self.assertEqual((frozenset(), frozenset({("b",), ("c",)})), changes[-1])
+        view.close()
+        Prolog.assertz("mv_edge(a, d)")
+        self.assertEqual(0, len(view))
+        with Prolog.materialize(
+            "mv_edge(X, Y)", depends_on=["mv_edge/2"], normalize=False
+        ) as raw:
+            self.assertEqual({("a", "d")}, {(x.value, y.value) for x, y in raw})
+            Prolog.assertz("mv_edge(d, e)")
+            self.assertEqual(
+                {("a", "d"), ("d", "e")}, {(x.value, y.value) for x, y in raw}
+            )
+            self.assertEqual(1, raw.refresh_count)
+            self.assertEqual(1, raw.update_count)
+        Prolog.retractall("mv_edge(_, _)")
+
+    def test_materialize_incremental(self):
+        Prolog.dynamic("mv_order/2")
+        Prolog.dynamic("mv_customer/2")
+        Prolog.assertz("mv_customer(c1, alice)")
+        Prolog.assertz("mv_customer(c2, bob)")
+        Prolog.assertz("mv_order(o1, c1)")
+        view = Prolog.materialize(
+            "mv_order(O, C), mv_customer(C, N), O \\== o0",
+            depends_on=["mv_order/2", "mv_customer/2"],
+        )
+        self.assertTrue(view.incremental)
+        self.assertEqual({("o1", "c1", "alice")}, set(view))
+        changes = []
+        view.subscribe(lambda added, removed: changes.append((added, removed)))
+        Prolog.assertz("mv_order(o2, c2)")
+        Prolog.assertz("mv_order(o3, c2)")
+        Prolog.assertz("mv_order(o0, c2)")
+        self.assertEqual(
+            {("o1", "c1", "alice"), ("o2", "c2", "bob"), ("o3", "c2", "bob")},
+            set(view),
+        )
+        self.assertEqual(1, view.refresh_count)
+        self.assertEqual(1, view.update_count)
+        self.assertEqual(
+            (frozenset({("o2", "c2", "bob"), ("o3", "c2", "bob")}), frozenset()),
+            changes[-1],
+        )
+        # a retracted fact removes only the rows it contributed to
+        Prolog.retract("mv_customer(c2, bob)")
+        Prolog.assertz("mv_customer(c2, carol)")
+        self.assertEqual(
+            {("o1", "c1", "alice"), ("o2", "c2", "carol"), ("o3", "c2", "carol")},
+            set(view),
+        )
+        self.assertEqual(2, view.update_count)
+        # an asserted rule cannot be applied incrementally
+        Prolog.assertz("mv_customer(C, anonymous) :- C == c9")
+        self.assertEqual(3, len(view))
+        self.assertEqual(2, view.refresh_count)
+        Prolog.retractall("mv_customer(_, _)")
+        self.assertEqual(set(), set(view))
+
+        # a view which is not closed is dropped when it is garbage collected
+        view_id = view.id
+        del view
+        gc.collect()
+        self.assertFalse(Prolog.exists("pyswip_view(%p, _, _, _)", view_id))
+        Prolog.assertz("mv_customer(c1, alice)")
+        self.assertFalse(
+            Prolog.exists(
+                "current_predicate(pyswip_views:pyswip_view_rows_%p/3)", view_id
+            )
+        )
+        Prolog.retractall("mv_order(_, _)")
+        Prolog.retractall("mv_customer(_, _)")
+
+    def test_tabling(self):
+        Prolog.table("tbl_path/2", mode="subsumptive")
+        Prolog.assertz("tbl_edge(a, b)")
+        Prolog.assertz("tbl_edge(b, c)")
+        Prolog.assertz("tbl_path(X, Y) :- tbl_edge(X, Y)")
+        Prolog.assertz("tbl_path(X, Y) :- tbl_path(X, Z), tbl_edge(Z, Y)")
+        self.assertEqual(
+            [{"Y": "b"}, {"Y": "c"}], sorted(Prolog.query("tbl_path(a, Y)"), key=str)
+        )
+        stats = [s for s in Prolog.table_stats() if s["predicate"] == "tbl_path/2"]
+        self.assertTrue(stats)
+        self.assertEqual("user", stats[0]["module"])
+        self.assertGreaterEqual(sum(s["answers"] for s in stats), 2)
+        Prolog.abolish_tables(pred="tbl_path/2")
+        self.assertFalse(
+            [s for s in Prolog.table_stats() if s["predicate"] == "tbl_path/2"]
+        )
+        Prolog.table("tbl_inc/1", mode=["incremental"])
+        Prolog.abolish_tables()
+        self.assertEqual([], Prolog.table_stats())
+        with self.assertRaises(ValueError):
+            Prolog.table("tbl_path/2", mode="fast")
+        with self.assertRaises(ValueError):
+            Prolog.table()
+        with self.assertRaises(ValueError):
+            Prolog.abolish_tables(pred="tbl_path")
+
+    def test_index_report(self):
+        Prolog.dynamic("idx_rate/3")
+        for i in range(100):
+            Prolog.assertz("idx_rate(usd, %p, %p)", Atom(f"c{i}"), i / 100)
+        Prolog.assertz("idx_rate(eur, f(1), 1.0)")
+        report = Prolog.index_report("idx_rate/3")
+        self.assertEqual("user:idx_rate/3", report["predicate"])
+        self.assertEqual(101, report["clauses"])
+        self.assertTrue(report["dynamic"])
+        self.assertEqual(
+            [2, 101, 101], [argument["keys"] for argument in report["arguments"]]
+        )
+        self.assertEqual(1.0, report["arguments"][1]["selectivity"])
+        self.assertIsInstance(report["indexes"], list)
+        self.assertEqual(
+            2, Prolog.warm_indexes(["idx_rate(+, -, -)", "user:idx_rate(-, +, ?)"])
+        )
+        self.assertEqual(0, Prolog.warm_indexes(["idx_missing(+)"]))
+        self.assertEqual(0, Prolog.index_report("idx_missing/1")["clauses"])
+        with self.assertRaises(ValueError):
+            Prolog.index_report("idx_rate")
+        with self.assertRaises(ValueError):
+            Prolog.warm_indexes(["idx_rate(usd, -, -)"])
+        Prolog.retractall("idx_rate(_, _, _)")
+
+    def test_query_tables(self):
+        Prolog.assertz("scoped_user(1, alice)")
+        Prolog.assertz("scoped_user(2, bob)")
+        Prolog.assertz("scoped_user(3, carol)")
+        self.assertEqual(
+            [{"N": "alice"}, {"N": "carol"}],
+            list(
+                Prolog.query(
+                    "allowed(I), scoped_user(I, N)", tables={"allowed": [1, 3]}
+                )
+            ),
+        )
+        self.assertEqual(
+            {"N": "bob", "R": "admin"},
+            Prolog.once(
+                "role(I, R), scoped_user(I, N).",
+                tables={"role": [(2, "admin")]},
+            ),
+        )
+        self.assertTrue(
+            Prolog.exists(
+                "scoped_user(_, %p), blocked(%p)",
+                Atom("bob"),
+                Atom("bob"),
+                tables={"blocked": ["bob"]},
+            )
+        )
+        self.assertFalse(Prolog.exists("blocked(_)", tables={"blocked": []}))
+        # only the lookup of the tables changes, the clauses asserted by the query go to user
+        Prolog.once("allowed(I), assertz(scoped_seen(I))", tables={"allowed": [7]})
+        self.assertTrue(Prolog.exists("user:scoped_seen(7)"))
+        # a query which is never iterated doesn't hold a module
+        free = list(_table_modules._free)
+        Prolog.query("allowed(I)", tables={"allowed": [1]})
+        self.assertEqual(free, _table_modules._free)
+        # the tables are removed after the query is closed
+        self.assertFalse(Prolog.exists("current_predicate(allowed/1)"))
+        self.assertFalse(
+            Prolog.exists("current_module(M), current_predicate(M:role/2)")
+        )
+        with self.assertRaises(ValueError):
+            Prolog.once("allowed(_)", tables={"Allowed": [1]})
+        with self.assertRaises(ValueError):
+            Prolog.once("pair(_, _)", tables={"pair": [(1, 2), (3,)]})
+
+    def test_query_timeout(self):
+        Prolog.limit_counters(reset=True)
+        with self.assertRaises(QueryTimeout):
+            list(Prolog.query("repeat, fail", timeout=0.05))
+        with self.assertRaises(QueryTimeout):
+            Prolog.once("repeat, fail", timeout=0.05)
+        self.assertEqual([{"X": 1}], list(Prolog.query("X = 1", timeout=1)))
+        # the time limit keeps all the solutions
+        self.assertEqual(
+            [{"X": 1}, {"X": 2}, {"X": 3}],
+            list(Prolog.query("member(X, [1, 2, 3])", timeout=1)),
+        )
+        self.assertEqual(2, Prolog.limit_counters()["timeout"])
+
+    def test_query_inference_limit(self):
+        Prolog.limit_counters(reset=True)
+        with self.assertRaises(InferenceLimitExceeded):
+            list(Prolog.query("repeat, fail", max_inferences=10000))
+        with self.assertRaises(InferenceLimitExceeded):
+            Prolog.exists("repeat, fail", max_inferences=10000)
+        self.assertEqual(
+            [{"X": 1}, {"X": 2}, {"X": 3}],
+            list(Prolog.query("member(X, [1, 2, 3])", max_inferences=10000)),
+        )
+        counters = Prolog.limit_counters(reset=True)
+        self.assertEqual({"timeout": 0, "max_inferences": 2, "cancelled": 0}, counters)
+        self.assertEqual(
+            {"timeout": 0, "max_inferences": 0, "cancelled": 0},
+            Prolog.limit_counters(),
+        )
+
+    def test_cancel_query(self):
+        token = CancelToken()
+        timer = threading.Timer(0.1, token.cancel)
+        timer.start()
+        with self.assertRaises(QueryCancelled):
+            list(Prolog.query("repeat, fail", cancel=token))
+        timer.join()
+        self.assertTrue(token.cancelled)
+        # the query is closed after it is cancelled
+        self.assertTrue(Prolog.exists("true"))
+
+    def test_cancel_before_query(self):
+        token = CancelToken()
+        token.cancel()
+        with self.assertRaises(QueryCancelled):
+            Prolog.once("true", cancel=token)
+
+    def test_cancel_token_not_cancelled(self):
+        token = CancelToken()
+        self.assertEqual(
+            [{"X": 1}, {"X": 2}], list(Prolog.query("member(X, [1, 2])", cancel=token))
+        )
+        self.assertFalse(token.cancelled)
+        # cancelling a finished query leaves nothing behind in the database
+        token.cancel()
+        self.assertFalse(Prolog.exists("pyswip_running(%p, _)", token.id))
+        self.assertFalse(Prolog.exists("current_predicate(pyswip_cancelled_token/1)"))
+
+    def test_cancel_token_exported(self):
+        import pyswip
+
+        self.assertIs(CancelToken, pyswip.CancelToken)
+
+    def test_select(self):
+        Prolog.dynamic("select_person/2")
+        Prolog.assertz("select_person(jane, 32)")
+        Prolog.assertz("select_person(joe, 45)")
+        Prolog.assertz("select_person(jill, 27)")
+        Prolog.assertz("select_person(joe, 45)")
+        result = list(
+            Prolog.select(
+                "X",
+                where="select_person(X, Age)",
+                order_by="-Age",
+                distinct=True,
+                limit=2,
+            )
+        )
+        self.assertEqual([{"X": "joe"}, {"X": "jane"}], result)
+        result = list(
+            Prolog.select("X", where="select_person(X, _)", distinct=True, offset=1)
+        )
+        self.assertEqual([{"X": "joe"}, {"X": "jill"}], result)
+        result = list(
+            Prolog.select("X-A", 30, where="select_person(X, A), A > %p", limit=1)
+        )
+        self.assertEqual([{"X": "jane", "A": 32}], result)
+        result = list(
+            Prolog.select(
+                "X", where="select_person(X, Age)", order_by="Age", normalize=False
+            )
+        )
+        self.assertEqual(4, len(result))
+        self.assertEqual(
+            [["X"]] * 4, [[str(b.args[0].value) for b in r] for r in result]
+        )
+        self.assertEqual("jill", result[0][0].args[1].value)
+        Prolog.retractall("select_person(_, _)")
+
+    def test_aggregates(self):
+        Prolog.dynamic("agg_sale/3")
+        Prolog.assertz("agg_sale(apple, 3, 1.5)")
+        Prolog.assertz("agg_sale(pear, 2, 2.0)")
+        Prolog.assertz("agg_sale(apple, 5, 1.5)")
+        self.assertEqual(3, Prolog.count("agg_sale(_, _, _)"))
+        self.assertEqual(2, Prolog.count("agg_sale(%p, _, _)", Atom("apple")))
+        self.assertEqual(0, Prolog.count("agg_sale(banana, _, _)"))
+        self.assertEqual(10, Prolog.sum("N", "agg_sale(_, N, _)"))
+        self.assertEqual(5, Prolog.max("N", "agg_sale(_, N, _)"))
+        self.assertEqual(2, Prolog.min("N", "agg_sale(_, N, _)"))
+        self.assertIsNone(Prolog.max("N", "agg_sale(banana, N, _)"))
+        self.assertEqual(
+            ["apple", "pear", "apple"], Prolog.bag("I", "agg_sale(I, _, _)")
+        )
+        self.assertEqual(["apple", "pear"], Prolog.set("I", "agg_sale(I, _, _)"))
+        self.assertEqual(
+            {"apple": 2, "pear": 1},
+            Prolog.group_by("I", "count", "agg_sale(I, _, _)"),
+        )
+        self.assertEqual(
+            {"apple": 12.0, "pear": 4.0},
+            Prolog.group_by("I", "sum(N*P)", "agg_sale(I, N, P)"),
+        )
+        self.assertEqual(
+            {"apple": 5},
+            Prolog.group_by("I", "max(N)", "agg_sale(I, N, _), N > %p", 2),
+        )
+        # the same goal template is compiled once
+        compiled = len(Prolog._compiled_goals)
+        self.assertEqual(1, Prolog.count("agg_sale(%p, _, _)", Atom("pear")))
+        self.assertEqual(compiled, len(Prolog._compiled_goals))
+        # the helpers are kept out of the user module
+        self.assertFalse(Prolog.exists("current_predicate(user:pyswip_goal_0/_)"))
+        Prolog.retractall("agg_sale(_, _, _)")
+
+    def test_compiled_goals_bounded(self):
+        size = Prolog.compiled_goals_size
+        Prolog.compiled_goals_size = 2
+        try:
+            oldest = Prolog._compile_goal("true", 0, 0)
+            for i in range(3):
+                self.assertEqual(i, Prolog.count(f"between(1, {i}, _)"))
+            self.assertEqual(2, len(Prolog._compiled_goals))
+            self.assertFalse(Prolog.exists(f"current_predicate({oldest}/0)"))
+        finally:
+            Prolog.compiled_goals_size = size
+
 
 format_prolog_fixture = [
     ("", (), ""),
@@ -147,9 +864,81 @@ format_prolog_fixture = [
         (["foo", 38, 45.897, [1, 2, 3]],),
         'before["foo",38,45.897,[1,2,3]]after',
     ),
+    # tuples are lists, as in putTerm
+    ("before%pafter", ((1, "a"),), 'before[1,"a"]after'),
+    ("before%pafter", ((),), "before[]after"),
+    ("before%pafter", ({"a": 1, "b": [2]},), "before_{'a':1,'b':[2]}after"),
+    ("before%pafter", ({1: "x"},), 'before_{1:"x"}after'),
+    ("before%pafter", ('say "hi"',), r'before"say \"hi\""after'),
+    ("before%pafter", ("a\\b",), r'before"a\\b"after'),
+    ("before%pafter", ('x"), halt, ("',), r'before"x\"), halt, (\""after'),
+    ("before%pafter", ("line\n",), r'before"line\xa\"after'),
+    ("before%pafter", (Atom("it's"),), r"before'it\'s'after"),
+    ("before%pafter", ({"it's": 1},), r"before_{'it\'s':1}after"),
+    ("before%pafter", (b'ab"c',), r'before"ab\"c"after'),
 ]
 
 
 @pytest.mark.parametrize("format, args, target", format_prolog_fixture)
 def test_convert_to_prolog(format, args, target):
     assert format_prolog(format, args) == target
+
+
+compile_select_fixture = [
+    ("X", "p(X)", {}, "p(X)"),
+    ("X", "p(X)", {"distinct": True}, "distinct(X, (p(X)))"),
+    ("X", "p(X, Y)", {"order_by": "Y"}, "order_by([asc(Y)], (p(X, Y)))"),
+    (
+        "X",
+        "p(X, Y)",
+        {"order_by": ["-Y", "+X"]},
+        "order_by([desc(Y),asc(X)], (p(X, Y)))",
+    ),
+    ("X", "p(X)", {"limit": 10, "offset": 20}, "limit(10, (offset(20, (p(X)))))"),
+    ("X", "p(X)", {"offset": 0}, "p(X)"),
+    (
+        "X",
+        "p(X, Y)",
+        {"distinct": True, "order_by": "-Y", "limit": 1},
+        "limit(1, (order_by([desc(Y)], (distinct(X, (p(X, Y)))))))",
+    ),
+]
+
+
+@pytest.mark.parametrize("template, where, kwargs, target", compile_select_fixture)
+def test_compile_select(template, where, kwargs, target):
+    assert compile_select(template, where, **kwargs) == target
+
+
+def test_compile_select_invalid_limit():
+    with pytest.raises(ValueError):
+        compile_select("X", "p(X)", limit=-1)
+    with pytest.raises(ValueError):
+        compile_select("X", "p(X)", offset=-1)
+
+
+def test_template_variables():
+    assert template_variables("X") == ["X"]
+    assert template_variables("p(X, 'Atom', \"Str\", foo_Bar, _Y, _, X)") == ["X", "_Y"]
+
+
+def test_parse_aggregate():
+    assert parse_aggregate("count") == ("count", "")
+    assert parse_aggregate("sum(X*Y)") == ("sum", "X*Y")
+    assert parse_aggregate(" set( f(X) ) ") == ("set", " f(X) ")
+    for aggregate in ["avg(X)", "count(X)", "sum", "Sum(X)"]:
+        with pytest.raises(ValueError):
+            parse_aggregate(aggregate)
+
+
+def test_with_limits():
+    assert (
+        with_limits("p(X). ", 0.5, None) == "pyswip_call_with_limits((p(X)), 0.5, inf)"
+    )
+    assert (
+        with_limits("p(X)", None, 1000) == "pyswip_call_with_limits((p(X)), inf, 1000)"
+    )
+    with pytest.raises(ValueError):
+        with_limits("p(X)", 0, None)
+    with pytest.raises(ValueError):
+        with_limits("p(X)", None, -1)
@@ -0,0 +1,138 @@
+# pyswip -- Python SWI-Prolog bridge
+# Copyright (c) 2007-2024 Yüce Tekol and PySwip
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import array
+
+import pytest
+
+from pyswip.tables import (
+    MappingSource,
+    ColumnSource,
+    TableSource,
+    FactFile,
+    table_source,
+    write_fact_file,
+)
+
+
+def test_mapping_source():
+    source = MappingSource({"a": 1, "b": 2})
+    assert list(source.rows()) == [("a", 1), ("b", 2)]
+    assert list(source.lookup(0, "b")) == [("b", 2)]
+    assert list(source.lookup(0, "c")) == []
+    assert list(source.lookup(1, 1)) == [("a", 1)]
+
+
+def test_mapping_source_arity():
+    source = MappingSource({"a": (1, "x")}, 3)
+    assert list(source.rows()) == [("a", 1, "x")]
+    assert list(source.lookup(0, "a")) == [("a", 1, "x")]
+    with pytest.raises(ValueError):
+        MappingSource({}, 1)
+
+
+def test_column_source(monkeypatch):
+    monkeypatch.setattr("pyswip.tables.CHUNK_SIZE", 2)
+    source = ColumnSource([array.array("i", [1, 2, 1]), ["a", "b", "c"]])
+    assert list(source.rows()) == [(1, "a"), (2, "b"), (1, "c")]
+    assert list(source.lookup(0, 1)) == [(1, "a"), (1, "c")]
+    assert list(source.lookup(1, "b")) == [(2, "b")]
+    assert list(source.lookup(0, 3)) == []
+    with pytest.raises(ValueError):
+        ColumnSource([[1, 2], [1]])
+
+
+def test_table_source():
+    class Rows(TableSource):
+        arity = 1
+
+        def rows(self):
+            yield from [(1,), (2,)]
+
+    rows = Rows()
+    assert table_source(rows, 1) is rows
+    assert list(rows.lookup(0, 2)) == [(2,)]
+    assert isinstance(table_source({}, 2), MappingSource)
+    assert isinstance(table_source([[1], [2]], 2), ColumnSource)
+    with pytest.raises(ValueError):
+        table_source([[1], [2]], 3)
+    with pytest.raises(TypeError):
+        table_source(42, 1)
+    with pytest.raises(TypeError):
+        TableSource()
+
+
+def test_fact_file(tmp_path):
+    path = tmp_path / "items.facts"
+    rows = [("b", 2, 1.5), ("a", 1, 2.0), ("b", 1, 0.5), ("é", 3, 1)]
+    assert write_fact_file(path, rows, 3) == 4
+    with FactFile(path) as facts:
+        assert facts.arity == 3
+        assert facts.types == "sqd"
+        assert list(facts.rows()) == sorted(rows)
+        assert list(facts.lookup(0, "b")) == [("b", 1, 0.5), ("b", 2, 1.5)]
+        assert list(facts.lookup(0, "é")) == [("é", 3, 1.0)]
+        assert list(facts.lookup(0, "c")) == []
+        assert list(facts.lookup(0, 1)) == []
+        assert list(facts.lookup(1, 1)) == [("a", 1, 2.0), ("b", 1, 0.5)]
+
+
+def test_fact_file_integer_keys(tmp_path):
+    path = tmp_path / "edges.facts"
+    write_fact_file(path, ((i % 100, i) for i in range(10000)), 2)
+    with FactFile(path) as facts:
+        assert len(list(facts.lookup(0, 7))) == 100
+        assert list(facts.lookup(0, 7))[:2] == [(7, 7), (7, 107)]
+        assert list(facts.lookup(0, 100)) == []
+    assert isinstance(table_source(str(path), 2), FactFile)
+
+
+def test_fact_file_sorted_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr("pyswip.tables.RUN_SIZE", 3)
+    monkeypatch.setattr("pyswip.tables.CHUNK_SIZE", 2)
+    path = tmp_path / "runs.facts"
+    rows = [(f"k{i % 4}", (i * 7) % 10) for i in range(10)] + [("k0", 0.5)]
+    assert write_fact_file(path, iter(rows), 2) == 11
+    with FactFile(path) as facts:
+        assert facts.types == "sd"
+        assert list(facts.rows()) == sorted(rows)
+        assert list(facts.lookup(0, "k3")) == [("k3", 1.0), ("k3", 9.0)]
+    with pytest.raises(TypeError):
+        write_fact_file(path, [(1,), (2,), (3,), ("a",)], 1)
+
+
+def test_fact_file_empty(tmp_path):
+    path = tmp_path / "empty.facts"
+    assert write_fact_file(path, [], 2) == 0
+    with FactFile(path) as facts:
+        assert list(facts.rows()) == []
+        assert list(facts.lookup(0, 1)) == []
+
+
+def test_fact_file_invalid(tmp_path):
+    with pytest.raises(ValueError):
+        write_fact_file(tmp_path / "a.facts", [(1, 2), (3,)], 2)
+    with pytest.raises(TypeError):
+        write_fact_file(tmp_path / "b.facts", [(1, "a"), ("b", 2)], 2)
+    path = tmp_path / "c.facts"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        FactFile(path)